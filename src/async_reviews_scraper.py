@@ -0,0 +1,216 @@
+import asyncio
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Dict, List, Optional
+
+from .reviews_scraper import (
+    GoogleMapsAPIScraper,
+    default_n_retries,
+    default_pipeline,
+    default_request_interval,
+    default_retry_time,
+    default_review_parser,
+)
+from .rate_limiter import AdaptiveRateLimiter
+from .retry_policy import RetryPolicy
+from .review_state import Watermark
+from .scraper import (
+    finish_reviews,
+    get_finished_reviews,
+    get_review_watermark,
+    process_reviews,
+    update_review_watermark,
+)
+from .transport import Transport
+
+default_max_in_flight = 10
+
+
+class EventLoopThread:
+    """
+    Event loop running in a thread of its own, shared by the threads that
+    wait on coroutines: run() hands one to the loop and blocks until it is
+    done, instead of every call starting and tearing down a loop with
+    asyncio.run.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self.loop.run_forever, name="event-loop", daemon=True
+        )
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def run(self, coroutine: Awaitable) -> Any:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+class AsyncGoogleMapsAPIScraper(GoogleMapsAPIScraper):
+    """Paginates the reviews of many places concurrently on one event loop.
+
+    Parsing is shared with GoogleMapsAPIScraper, so the review dicts are the
+    same. At most `max_in_flight` page requests are running at any time.
+    """
+
+    def __init__(
+        self,
+        request_interval: float = default_request_interval,
+        n_retries: int = default_n_retries,
+        retry_time: float = default_retry_time,
+        max_in_flight: int = default_max_in_flight,
+        transport: Optional[Transport] = None,
+        review_parser: str = default_review_parser,
+        pipeline: bool = default_pipeline,
+        rate_limiter: Optional[AdaptiveRateLimiter] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+    ):
+        super().__init__(
+            request_interval,
+            n_retries,
+            retry_time,
+            transport,
+            review_parser,
+            pipeline,
+            rate_limiter,
+            retry_policy,
+        )
+        self.max_in_flight = max_in_flight
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        # The transport is blocking, so every in flight request gets its own
+        # thread
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        # Pages are parsed off the event loop so they don't delay requests
+        self._parser = ThreadPoolExecutor(max_workers=1) if pipeline else None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        self._executor.shutdown(wait=False)
+        if self._parser is not None:
+            self._parser.shutdown(wait=False)
+        self._reset_logger_filter()
+        # Unlike the sync scraper, errors are not swallowed: the failures of
+        # a place are caught by scrape_place_reviews, and a cancelled gather
+        # must not look like a scrape that returned nothing
+
+    async def _get_page_async(
+        self,
+        feature_id: str,
+        hl: str = "",
+        sort_by_id: str = "",
+        token: str = "",
+    ):
+        """Makes get request in google's api without blocking the event
+        loop, leaving the parsing for later"""
+        loop = asyncio.get_running_loop()
+        async with self._semaphore:
+            response = await loop.run_in_executor(
+                self._executor, self._fetch_page, feature_id, hl, sort_by_id, token
+            )
+
+        return self._read_page(response, hl)
+
+    async def scrape_reviews(
+        self,
+        url: str,
+        n_reviews: int,
+        hl: str = "en",
+        sort_by: str = "",
+        token: str = "",
+        watermark: Optional[Watermark] = None,
+    ):
+        """Scrape specified amount of reviews of a place, same as
+        GoogleMapsAPIScraper.scrape_reviews, awaiting the steps of
+        _paginate instead of blocking on them"""
+        loop = asyncio.get_running_loop()
+        steps = self._paginate(url, n_reviews, hl, sort_by, token, watermark)
+        outcome, error = None, None
+        while True:
+            try:
+                step, argument = self._next_step(steps, outcome, error)
+            except StopIteration as stop:
+                return stop.value
+            outcome, error = None, None
+            try:
+                if step == "sleep":
+                    await asyncio.sleep(argument)
+                elif step == "fetch":
+                    outcome = await self._get_page_async(*argument)
+                elif step == "parse":
+                    if self._parser is not None:
+                        outcome = loop.run_in_executor(self._parser, argument)
+                    else:
+                        outcome = argument()
+                elif step == "wait":
+                    outcome = await argument if self._parser is not None else argument
+            except Exception as e:
+                error = e
+
+
+async def scrape_reviews_async(
+    reviews_data: List[Dict[str, Any]],
+    max_in_flight: int = default_max_in_flight,
+) -> List[Dict[str, Any]]:
+    """
+    Scrape the reviews of every place in `reviews_data` concurrently.
+
+    :param reviews_data: Items as built by gmaps.create_reviews_data.
+    :param max_in_flight: Maximum number of page requests running at once.
+    :return: List of {"place_id", "reviews", "finished"} dicts, in the order
+    of `reviews_data`, like scraper.scrape_reviews. "finished" is False for
+    the places that failed.
+    """
+    async with AsyncGoogleMapsAPIScraper(max_in_flight=max_in_flight) as scraper:
+
+        async def scrape_place_reviews(data):
+            finished = get_finished_reviews(data["place_id"])
+            if finished is not None:
+                # The attempt that scraped them died before moving the
+                # watermark
+                update_review_watermark(data, finished)
+                return {
+                    "place_id": data["place_id"],
+                    "reviews": finished,
+                    "finished": True,
+                }
+
+            processed = []
+            finished = False
+            try:
+                result = await scraper.scrape_reviews(
+                    data["link"],
+                    data["max"],
+                    data["lang"],
+                    sort_by=data["reviews_sort"],
+                    watermark=get_review_watermark(data),
+                )
+                processed = process_reviews(result, data["convert_to_english"])
+                update_review_watermark(data, result)
+                finish_reviews(data["place_id"], processed)
+                finished = True
+            except Exception:
+                # A failing place must not cancel the others
+                traceback.print_exc()
+
+            return {
+                "place_id": data["place_id"],
+                "reviews": processed,
+                "finished": finished,
+            }
+
+        return await asyncio.gather(
+            *(scrape_place_reviews(data) for data in reviews_data)
+        )
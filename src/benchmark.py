@@ -0,0 +1,380 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from src.replay import Corpus
+from src.response_cache import cached_response
+from src.synthetic_server import SyntheticSite, place_link
+
+default_baseline_path = "benchmarks/baseline.json"
+# Throughput may drop by this share of the baseline before it is a regression
+default_threshold = 0.2
+default_repeat = 5
+default_places = 50
+default_min_reviews = 20
+default_max_reviews = 200
+
+
+class Case:
+    """One benchmark: `run` processes `items` items of the fixtures"""
+
+    def __init__(
+        self, name: str, run: Callable[[], Any], items: int, unit: str
+    ):
+        self.name = name
+        self.run = run
+        self.items = items
+        self.unit = unit
+
+    def measure(self, repeat: int) -> Dict:
+        self.run()  # warm up
+        durations = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            self.run()
+            durations.append(time.perf_counter() - started)
+        best = min(durations)
+        return {
+            "items": self.items,
+            "unit": self.unit,
+            "best_seconds": round(best, 6),
+            "median_seconds": round(statistics.median(durations), 6),
+            "items_per_second": round(self.items / best, 1),
+        }
+
+
+class Fixtures:
+    """
+    Place pages and reviewSort pages the benchmarks run on, with what the
+    scraper makes of them. They are recorded responses when a corpus is
+    given, synthetic pages otherwise.
+    """
+
+    def __init__(
+        self, place_pages: List[Tuple[str, str]], review_pages: List[bytes]
+    ):
+        from src.extract_data import extract_data, initialization_state
+        from src.reviews_scraper import GoogleMapsAPIScraper
+
+        self.place_pages = place_pages
+        self.states = [
+            (initialization_state(html), link) for html, link in place_pages
+        ]
+        self.review_pages = review_pages
+        self.scraper = GoogleMapsAPIScraper()
+        self.review_texts = [
+            self.scraper._cut_response_text(page.decode("utf-8"))
+            for page in review_pages
+        ]
+        self.reviews = [
+            self.scraper._parse_page(review_response(page), "en", "")
+            for page in review_pages
+        ]
+        self.places = []
+        for index, (state, link) in enumerate(self.states):
+            place = extract_data(state, link)
+            place["is_spending_on_ads"] = False
+            place["detailed_reviews"] = self.reviews[index % len(self.reviews)]
+            self.places.append(place)
+
+    @classmethod
+    def synthetic(cls, places: int, min_reviews: int, max_reviews: int):
+        site = SyntheticSite(min_reviews, max_reviews)
+        place_pages = []
+        review_pages = []
+        for index in range(places):
+            link = place_link(index)
+            html = site.place_page(link.split("google.com")[1].split("?")[0])
+            place_pages.append((html.decode("utf-8"), link))
+            place = site.get_place(link.split("!1s")[1].split("!")[0])
+            for page in range(-(-place.review_count // site.page_size)):
+                review_pages.append(
+                    site.review_page(
+                        f"async=feature_id:{place.feature_id},"
+                        f"next_page_token:{f'p{page}' if page else ''},_fmt:pc"
+                    )
+                )
+        return cls(place_pages, review_pages)
+
+    @classmethod
+    def recorded(cls, directory: str):
+        place_pages = []
+        review_pages = []
+        for meta, body in Corpus(directory).entries():
+            if meta["status"] != 200:
+                continue
+            if "/maps/place/" in meta["url"]:
+                place_pages.append((body.decode("utf-8"), meta["url"]))
+            elif "/async/reviewSort" in meta["url"]:
+                review_pages.append(body)
+        if not place_pages or not review_pages:
+            raise ValueError(f"{directory} lacks place pages or review pages")
+        return cls(place_pages, review_pages)
+
+
+def review_response(page: bytes):
+    return cached_response("https://www.google.com/async/reviewSort", page, "utf-8")
+
+
+def create_cases(fixtures: Fixtures, sink: str) -> List[Case]:
+    from src.extract_data import (
+        decode_place_payload,
+        extract_data,
+        extract_place_page,
+        parse,
+    )
+    from src.fields import DEFAULT_FIELDS_WITHOUT_SOCIAL_DATA
+    from src.gmaps import Gmaps, determine_place_fields
+    from src.scraper import process_reviews
+    from src.sort_filter import filter_places, sort_places
+    from src.utils import convert_unicode_dict_to_ascii_dict
+    from src.write_output import (
+        LocalStorageClient,
+        set_storage_client,
+        transform_detailed_reviews,
+        transform_places,
+        upload_df_to_gcs,
+    )
+
+    scraper = fixtures.scraper
+    places = fixtures.places
+    n_places = len(places)
+    n_pages = len(fixtures.review_pages)
+    n_reviews = sum(len(reviews) for reviews in fixtures.reviews)
+    trees = [
+        scraper._format_response_text(text)[2] for text in fixtures.review_texts
+    ]
+    bs4_soups = [
+        scraper._format_response_soup(text)[2] for text in fixtures.review_texts
+    ]
+    filter_data = {
+        "min_rating": 3.5,
+        "max_rating": None,
+        "min_reviews": 10,
+        "max_reviews": None,
+        "has_phone": True,
+        "has_website": None,
+        "category_in": ["Tourist attraction", "Museum"],
+    }
+    default_fields = determine_place_fields(list(DEFAULT_FIELDS_WITHOUT_SOCIAL_DATA))
+    set_storage_client(LocalStorageClient(sink))
+
+    def run_place_pages():
+        for html, link in fixtures.place_pages:
+            extract_place_page(html, link)
+
+    def run_review_pages():
+        for page in fixtures.review_pages:
+            scraper._parse_page(review_response(page), "en", "")
+
+    def run_parse():
+        for state, _ in fixtures.states:
+            parse(state)
+
+    def run_decode_place_payload():
+        for html, _ in fixtures.place_pages:
+            decode_place_payload(html)
+
+    def run_extract_data():
+        for state, link in fixtures.states:
+            extract_data(state, link)
+
+    def run_extract_default_fields():
+        for state, link in fixtures.states:
+            extract_data(state, link, default_fields)
+
+    def run_format_response_text():
+        for text in fixtures.review_texts:
+            scraper._format_response_text(text)
+
+    def run_parse_review_lxml():
+        for reviews in trees:
+            for review in reviews:
+                scraper._parse_review_lxml(review, "en")
+
+    def run_parse_review_bs4():
+        for reviews in bs4_soups:
+            for review in reviews:
+                scraper._parse_review(review, "en")
+
+    def run_process_reviews():
+        for reviews in fixtures.reviews:
+            process_reviews(reviews, False)
+
+    def run_convert_to_ascii():
+        convert_unicode_dict_to_ascii_dict(places)
+
+    def run_sort_places():
+        sort_places(places, Gmaps.DEFAULT_SORT)
+
+    def run_filter_places():
+        filter_places(places, filter_data)
+
+    def run_upload():
+        upload_df_to_gcs(
+            transform_places(places, []), "benchmark", "places.jsonl", "jsonl"
+        )
+        upload_df_to_gcs(
+            transform_detailed_reviews(places), "benchmark", "reviews.parquet"
+        )
+
+    return [
+        Case("macro.place_pages", run_place_pages, n_places, "pages"),
+        Case("macro.review_pages", run_review_pages, n_pages, "pages"),
+        Case("extract_data.parse", run_parse, n_places, "places"),
+        Case(
+            "extract_data.decode_place_payload",
+            run_decode_place_payload,
+            n_places,
+            "places",
+        ),
+        Case("extract_data.extract_data", run_extract_data, n_places, "places"),
+        Case(
+            "extract_data.extract_data_default_fields",
+            run_extract_default_fields,
+            n_places,
+            "places",
+        ),
+        Case(
+            "reviews.format_response_text",
+            run_format_response_text,
+            n_pages,
+            "pages",
+        ),
+        Case(
+            "reviews.parse_review_lxml", run_parse_review_lxml, n_reviews, "reviews"
+        ),
+        Case(
+            "reviews.parse_review_bs4", run_parse_review_bs4, n_reviews, "reviews"
+        ),
+        Case(
+            "scraper.process_reviews", run_process_reviews, n_reviews, "reviews"
+        ),
+        Case(
+            "utils.convert_unicode_dict_to_ascii_dict",
+            run_convert_to_ascii,
+            n_places,
+            "places",
+        ),
+        Case("sort_filter.sort_places", run_sort_places, n_places, "places"),
+        Case("sort_filter.filter_places", run_filter_places, n_places, "places"),
+        Case("write_output.upload_df_to_gcs", run_upload, n_places, "places"),
+    ]
+
+
+def environment() -> Dict[str, str]:
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+    }
+
+
+def load_baseline(path: str) -> Optional[Dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_baseline(path: str, results: Dict[str, Dict]):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    baseline = load_baseline(path) or {"results": {}}
+    baseline["environment"] = environment()
+    baseline["saved_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    baseline["results"].update(results)
+    with open(path, "w") as file:
+        json.dump(baseline, file, indent=2, sort_keys=True)
+
+
+def compare(
+    results: Dict[str, Dict], baseline: Optional[Dict], threshold: float
+) -> List[str]:
+    """Prints every result next to its baseline and returns the names of
+    the regressed benchmarks"""
+    regressions = []
+    baseline_results = baseline["results"] if baseline else {}
+    if baseline and baseline.get("environment") != environment():
+        print("Warning: the baseline was saved on another environment")
+    print(f"{'benchmark':<45}{'items/s':>14}{'baseline':>14}{'change':>9}")
+    for name, result in results.items():
+        throughput = result["items_per_second"]
+        expected = baseline_results.get(name, {}).get("items_per_second")
+        line = f"{name:<45}{throughput:>14,.1f}"
+        if expected:
+            change = throughput / expected - 1
+            line += f"{expected:>14,.1f}{change:>+9.1%}"
+            if change < -threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the parsing and output hot paths"
+    )
+    parser.add_argument(
+        "--corpus",
+        help="Directory recorded with GOOGLE_RECORD_DIR to run on, synthetic"
+        " pages otherwise",
+    )
+    parser.add_argument("--places", type=int, default=default_places)
+    parser.add_argument("--min-reviews", type=int, default=default_min_reviews)
+    parser.add_argument("--max-reviews", type=int, default=default_max_reviews)
+    parser.add_argument("--repeat", type=int, default=default_repeat)
+    parser.add_argument(
+        "--only", help="Only run the benchmarks with this in their name"
+    )
+    parser.add_argument("--baseline", default=default_baseline_path)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=default_threshold,
+        help="Throughput drop, as a share of the baseline, that fails the run",
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="Save the results as the baseline"
+    )
+    parser.add_argument("--output", help="Path of the JSON results")
+    args = parser.parse_args()
+
+    if args.corpus:
+        fixtures = Fixtures.recorded(args.corpus)
+    else:
+        fixtures = Fixtures.synthetic(
+            args.places, args.min_reviews, args.max_reviews
+        )
+
+    with tempfile.TemporaryDirectory() as sink:
+        results = {}
+        for case in create_cases(fixtures, sink):
+            if args.only and args.only not in case.name:
+                continue
+            results[case.name] = case.measure(args.repeat)
+
+    regressions = compare(results, load_baseline(args.baseline), args.threshold)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(
+                {"environment": environment(), "results": results}, file, indent=2
+            )
+    if args.save:
+        save_baseline(args.baseline, results)
+        print(f"Baseline saved to {args.baseline}")
+    elif regressions:
+        print(f"{len(regressions)} benchmarks regressed past {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional
+
+import psutil
+
+default_drivers = 1
+# Of the 4 GB of the container, what the Chromes may use together. The rest
+# is left to python, the parse workers and the place and review pages
+default_memory_budget_mb = 2560
+# Renderer processes of one Chrome, a search only needs the maps tab
+default_renderer_process_limit = 2
+
+# Number of Chromes searching queries at once
+browser_drivers_env = "BROWSER_DRIVERS"
+# Memory cap of every Chrome, the budget shared between the drivers when it
+# is not set
+browser_memory_mb_env = "BROWSER_MEMORY_MB"
+
+
+def chrome_memory_mb(driver) -> Optional[float]:
+    """Resident memory of the Chrome of `driver` and of all its processes,
+    None when they can't be found"""
+    try:
+        address = driver.capabilities["goog:chromeOptions"]["debuggerAddress"]
+    except (AttributeError, KeyError, TypeError):
+        return None
+    flag = f"--remote-debugging-port={address.rsplit(':', 1)[1]}"
+    for process in psutil.process_iter(["cmdline"]):
+        if flag not in (process.info["cmdline"] or []):
+            continue
+        try:
+            processes = [process] + process.children(recursive=True)
+            rss = 0
+            for child in processes:
+                try:
+                    rss += child.memory_info().rss
+                except psutil.NoSuchProcess:
+                    pass
+            return rss / 1024 / 1024
+        except psutil.NoSuchProcess:
+            return None
+    return None
+
+
+class _TaskInstance:
+    """Instance of a browser task only one search calls at a time, knowing
+    the last Chrome it started"""
+
+    def __init__(self, task: Callable):
+        self.driver = None
+        create_driver = task.options["create_driver"]
+
+        def track_driver(data, options, desired_capabilities):
+            self.driver = create_driver(data, options, desired_capabilities)
+            return self.driver
+
+        self.task = task.create_instance(create_driver=track_driver)
+
+    def close(self):
+        self.task.close()
+        self.driver = None
+
+
+class BrowserPool:
+    """
+    Warm Chromes searching queries concurrently, at most `drivers` at once.
+
+    Every Chrome belongs to an instance of the browser task of its own,
+    created with the create_instance of the task (scraper.browser_task).
+    botasaurus keeps the options of the last call of a task and its idle
+    drivers in state shared by all its callers, so a search takes an idle
+    instance, or creates one while there are fewer than `drivers`, and
+    hands it back when it returns. An instance keeps its Chrome alive
+    between its searches, so as many Chromes as concurrent searches are
+    ever started.
+
+    Every Chrome is started with its V8 heap and renderer processes capped,
+    and once a search returns, its Chrome is closed when it uses more than
+    `memory_mb`, the next search of its instance starting a fresh one.
+    """
+
+    def __init__(
+        self, drivers: int = default_drivers, memory_mb: Optional[int] = None
+    ):
+        self.drivers = drivers
+        self.memory_mb = memory_mb or default_memory_budget_mb // drivers
+        self._lock = threading.Lock()
+        self._counts = {"searches": 0, "recycled": 0, "peak_mb": 0.0}
+        # Instances of every task, and the idle ones
+        self._instances: Dict[Callable, List[_TaskInstance]] = {}
+        self._idle: Dict[Callable, queue.Queue] = {}
+
+    def chrome_arguments(self) -> List[str]:
+        return [
+            # Most of the memory of a maps tab is its javascript heap
+            f"--js-flags=--max-old-space-size={self.memory_mb // 2}",
+            f"--renderer-process-limit={default_renderer_process_limit}",
+        ]
+
+    def add_arguments(self, data, options):
+        """add_arguments hook of create_stealth_driver"""
+        for argument in self.chrome_arguments():
+            options.add_argument(argument)
+
+    def search(self, task: Callable, data: Any, **kwargs) -> Any:
+        """Calls an idle instance of the browser task `task`, waiting for
+        one when all `drivers` are searching"""
+        instance = self._take(task)
+        try:
+            return instance.task(data, **kwargs)
+        finally:
+            self._count("searches", 1)
+            self._recycle(instance)
+            self._idle[task].put(instance)
+
+    def map(self, task: Callable, items: Iterable, **kwargs) -> Iterator:
+        """Results of the browser task `task` on every item, in order,
+        searching up to `drivers` items ahead of the caller"""
+        if self.drivers <= 1:
+            return (self.search(task, item, **kwargs) for item in items)
+
+        def results():
+            with ThreadPoolExecutor(
+                self.drivers, thread_name_prefix="browser"
+            ) as executor:
+                searching: Deque[Future] = deque()
+                for item in items:
+                    if len(searching) == self.drivers:
+                        yield searching.popleft().result()
+                    searching.append(executor.submit(self.search, task, item, **kwargs))
+                while searching:
+                    yield searching.popleft().result()
+
+        return results()
+
+    def close(self):
+        """Closes the Chromes of every instance, once their searches are
+        done. The next searches start fresh ones"""
+        with self._lock:
+            instances = [
+                instance
+                for task_instances in self._instances.values()
+                for instance in task_instances
+            ]
+        for instance in instances:
+            instance.close()
+
+    def _take(self, task: Callable) -> _TaskInstance:
+        with self._lock:
+            idle = self._idle.setdefault(task, queue.Queue())
+            instances = self._instances.setdefault(task, [])
+            if idle.empty() and len(instances) < self.drivers:
+                instance = _TaskInstance(task)
+                instances.append(instance)
+                return instance
+        return idle.get()
+
+    def _recycle(self, instance: _TaskInstance):
+        """Closes the Chrome of `instance` when it is over the memory cap"""
+        if instance.driver is None:
+            return
+        # None once botasaurus closed it, as after a crash
+        memory_mb = chrome_memory_mb(instance.driver)
+        if memory_mb is None:
+            return
+        with self._lock:
+            self._counts["peak_mb"] = max(self._counts["peak_mb"], memory_mb)
+        if memory_mb <= self.memory_mb:
+            return
+        print(
+            f"Closing a Chrome using {memory_mb:.0f} MB, "
+            f"over its cap of {self.memory_mb} MB"
+        )
+        instance.close()
+        self._count("recycled", 1)
+
+    def _count(self, name: str, value: int):
+        with self._lock:
+            self._counts[name] += value
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "drivers": self.drivers,
+                "memory_mb": self.memory_mb,
+                "searches": self._counts["searches"],
+                "recycled": self._counts["recycled"],
+                "peak_mb": round(self._counts["peak_mb"]),
+            }
+
+
+_browser_pool: Optional[BrowserPool] = None
+_browser_pool_lock = threading.Lock()
+
+
+def get_browser_pool() -> BrowserPool:
+    """Returns the process wide browser pool, creating it on first use"""
+    global _browser_pool
+    with _browser_pool_lock:
+        if _browser_pool is None:
+            drivers = int(os.getenv(browser_drivers_env) or default_drivers)
+            memory_mb = os.getenv(browser_memory_mb_env)
+            _browser_pool = BrowserPool(
+                max(drivers, 1), int(memory_mb) if memory_mb else None
+            )
+        return _browser_pool
+
+
+def set_browser_pool(pool: BrowserPool):
+    """Replaces the process wide browser pool, its Chromes only get the caps
+    of the new one once they are restarted"""
+    global _browser_pool
+    with _browser_pool_lock:
+        _browser_pool = pool
+
+
+def add_browser_arguments(data, options):
+    """add_arguments of the browser tasks, the caps of the current pool"""
+    get_browser_pool().add_arguments(data, options)
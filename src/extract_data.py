@@ -1,12 +1,25 @@
 import re as rex
 import json
 from datetime import datetime
+from json.decoder import scanstring
 from hashlib import md5
 from src.scraper_utils import create_search_link
 from urllib.parse import urlparse, urlunparse
 import numpy as np
+
+from src.path_tree import PathTree
 # from botasaurus import bt
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+initialization_state_start = ";window.APP_INITIALIZATION_STATE="
+initialization_state_end = ";window.APP_FLAGS"
+# Opening of the JSON string of the place payload, as it is escaped in a page
+payload_marker = '")]}\'\\n'
+
 def toiso(date):
     return date.isoformat()
 
@@ -21,15 +34,15 @@ def extract_path_from_link(link):
         )
 
 
-def get_can_claim(data):
+def get_can_claim(values):
 
-    link = safe_get(data, 6, 226, 0)
+    link = values["claim_link"]
     if isinstance(link, str):
         path = extract_path_from_link(link)
         if path and path.rstrip("/").endswith("setup/create"):
             return True
 
-    text = safe_get(data, 6, 49, 1)
+    text = values["claim_text"]
     if isinstance(text, str) and (
         text.lower().startswith("claim") or " claim" in text.lower()
     ):
@@ -70,36 +83,36 @@ def safe_get(data, *keys):
     return data
 
 
-def get_categories(data):
-    return safe_get(data, 6, 13)
+def get_categories(values):
+    return values["categories"]
 
 
-def get_thumbnail(data):
-    return safe_get(data, 6, 72, 0, 1, 6, 0)
+def get_thumbnail(values):
+    return values["thumbnail"]
 
 
-def get_place_id(data):
-    return safe_get(data, 6, 78)
+def get_place_id(values):
+    return values["place_id"]
 
 
-def get_description(data):
-    return safe_get(data, 6, 154, 0, 0) or safe_get(data, 6, 32, 1, 1)
+def get_description(values):
+    return values["description"] or values["description_fallback"]
 
 
-def get_open_state(data):
-    return safe_get(data, 6, 34, 4, 4)
+def get_open_state(values):
+    return values["open_state"]
 
 
-def get_plus_code(data):
-    return safe_get(data, 6, 183, 2, 2, 0)
+def get_plus_code(values):
+    return values["plus_code"]
 
 
-def get_gps_coordinates(data):
-    return {"latitude": safe_get(data, 6, 9, 2), "longitude": safe_get(data, 6, 9, 3)}
+def get_gps_coordinates(values):
+    return {"latitude": values["latitude"], "longitude": values["longitude"]}
 
 
-def get_images(data):
-    images = safe_get(data, 6, 171, 0) or []
+def get_images(values):
+    images = values["images"] or []
     ls = []
     for element in images:
         title = element[2]
@@ -109,8 +122,8 @@ def get_images(data):
     return ls
 
 
-def extract_questions(data):
-    images = safe_get(data, 6, 126) or []
+def extract_questions(values):
+    images = values["questions"] or []
     ls = []
     for element in images:
         question_data = safe_get(element, 0, 0)
@@ -153,7 +166,7 @@ def extract_questions(data):
                 "link": answered_by_link,
             }
         else:
-            ownerd = get_owner(data)
+            ownerd = get_owner(values)
             answered_by = {
                 "name": ownerd.get("name", None),
                 "link": ownerd.get("link", None),
@@ -197,8 +210,8 @@ def competitor_sorting_key(item):
     return (1, value) if isinstance(value, int) else (2, value)
 
 
-def extract_competitors(data, link):
-    images = safe_get(data, 6, 99, 0, 0, 1) or []
+def extract_competitors(values, link):
+    images = values["competitors"] or []
     ls = []
     hl = get_hl_from_link_competitors(link)
     for element in images:
@@ -262,8 +275,8 @@ def extract_time_data(data):
     return ls
 
 
-def extract_popular_times(data):
-    images = safe_get(data, 6, 84, 0) or []
+def extract_popular_times(values):
+    images = values["popular_times"] or []
 
     if not images:
         return np.nan #"Not Present"
@@ -284,8 +297,8 @@ def extract_popular_times(data):
     return rs
 
 
-def get_reservations(data):
-    images = safe_get(data, 6, 46) or []
+def get_reservations(values):
+    images = values["reservations"] or []
     ls = []
     for element in images:
         link, source = element[0], element[1]
@@ -293,8 +306,8 @@ def get_reservations(data):
     return ls
 
 
-def get_order_online_link(data):
-    images = safe_get(data, 6, 75, 0, 1, 2) or safe_get(data, 6, 75, 0, 0, 2) or []
+def get_order_online_link(values):
+    images = values["order_online"] or values["order_online_fallback"] or []
     ls = []
     for element in images:
         source, link = safe_get(element, 0, 0), safe_get(element, 1, 2, 0)
@@ -302,8 +315,8 @@ def get_order_online_link(data):
     return ls
 
 
-def get_hours(data):
-    images = safe_get(data, 6, 34, 1) or []
+def get_hours(values):
+    images = values["hours"] or []
     ls = []
     for element in images:
         day, times = element[0], element[1]
@@ -311,8 +324,8 @@ def get_hours(data):
     return ls
 
 
-def get_review_keywords(data):
-    images = safe_get(data, 6, 153, 0) or []
+def get_review_keywords(values):
+    images = values["review_keywords"] or []
     ls = []
     for element in images:
         keyword, count = element[1], element[3][4]
@@ -327,8 +340,8 @@ def get_options(data):
     ]
 
 
-def get_about(data):
-    rvs = safe_get(data, 6, 100, 1) or []
+def get_about(values):
+    rvs = values["about"] or []
     ls = []
     for element in rvs:
         id, name, options = element[0], element[1], get_options(element[2] or [])
@@ -336,9 +349,9 @@ def get_about(data):
     return ls
 
 
-def get_menu(data):
-    link = safe_get(data, 6, 38, 0)
-    source = safe_get(data, 6, 38, 1)
+def get_menu(values):
+    link = values["menu_link"]
+    source = values["menu_source"]
     return {"link": clean_link(link), "source": source}
 
 
@@ -374,21 +387,21 @@ def generate_google_reviews_url(placeid, query, authuser, hl, gl):
     return full_url
 
 
-def get_owner(data):
-    name = safe_get(data, 6, 57, 1)
-    id = safe_get(data, 6, 57, 2)
+def get_owner(values):
+    name = values["owner_name"]
+    id = values["owner_id"]
     link = f"https://www.google.com/maps/contrib/{id}" if id else None
     return {"id": id, "name": name, "link": clean_link(link) if link else None}
     # if id else {'name': name}
 
 
-def get_complete_address(data):
-    ward = safe_get(data, 6, 183, 1, 0)
-    street = safe_get(data, 6, 183, 1, 1)
-    city = safe_get(data, 6, 183, 1, 3)
-    postal_code = safe_get(data, 6, 183, 1, 4)
-    state = safe_get(data, 6, 183, 1, 5)
-    country_code = safe_get(data, 6, 183, 1, 6)
+def get_complete_address(values):
+    ward = values["ward"]
+    street = values["street"]
+    city = values["city"]
+    postal_code = values["postal_code"]
+    state = values["state"]
+    country_code = values["country_code"]
 
     result = {
         "ward": ward,
@@ -401,71 +414,181 @@ def get_complete_address(data):
     return result
 
 
-def get_time_zone(data):
-    return safe_get(data, 6, 30)
+def get_time_zone(values):
+    return values["time_zone"]
 
 
-def get_reviews_link(data):
-    return clean_link(safe_get(data, 6, 4, 3, 0))
+def get_reviews_link(values):
+    return clean_link(values["reviews_link"])
 
 
-def get_rating(data):
-    return safe_get(data, 6, 4, 7) or 0
+def get_rating(values):
+    return values["rating"] or 0
 
 
-def get_reviews(data):
-    return safe_get(data, 6, 4, 8) or 0
+def get_reviews(values):
+    return values["reviews"] or 0
 
 
-def get_phone(data):
-    return safe_get(data, 6, 178, 0, 0)
+def get_phone(values):
+    return values["phone"]
 
 
-def get_price_range(data):
-    rs = safe_get(data, 6, 4, 2)
+def get_price_range(values):
+    rs = values["price_range"]
 
     if rs is not None:
         return len(rs) * "$"
 
 
-def get_title(data):
-    return safe_get(data, 6, 11)
-
-
-def get_address(data):
-    return safe_get(data, 6, 39) or safe_get(data, 6, 37,0,0,17,0)
-
+def get_title(values):
+    return values["title"]
+
+
+def get_address(values):
+    return values["address"] or values["address_fallback"]
+
+
+def get_website(values):
+    return clean_link(values["website"])
+
+
+def get_main_category(values):
+    return values["main_category"]
+
+
+def get_cid(values):
+    return values["cid"]
+
+
+def get_data_id(values):
+    return values["data_id"]
+
+
+def get_reviews_per_rating(values):
+    return {f"rating_{i}": values[f"rating_{i}"] for i in range(1, 6)}
+
+
+# Where every value of a place sits in its payload
+place_paths = {
+    "claim_link": (6, 226, 0),
+    "claim_text": (6, 49, 1),
+    "categories": (6, 13),
+    "main_category": (6, 13, 0),
+    "thumbnail": (6, 72, 0, 1, 6, 0),
+    "place_id": (6, 78),
+    "description": (6, 154, 0, 0),
+    "description_fallback": (6, 32, 1, 1),
+    "open_state": (6, 34, 4, 4),
+    "hours": (6, 34, 1),
+    "latitude": (6, 9, 2),
+    "longitude": (6, 9, 3),
+    "images": (6, 171, 0),
+    "questions": (6, 126),
+    "competitors": (6, 99, 0, 0, 1),
+    "popular_times": (6, 84, 0),
+    "reservations": (6, 46),
+    "order_online": (6, 75, 0, 1, 2),
+    "order_online_fallback": (6, 75, 0, 0, 2),
+    "review_keywords": (6, 153, 0),
+    "about": (6, 100, 1),
+    "menu_link": (6, 38, 0),
+    "menu_source": (6, 38, 1),
+    "owner_name": (6, 57, 1),
+    "owner_id": (6, 57, 2),
+    "plus_code": (6, 183, 2, 2, 0),
+    "ward": (6, 183, 1, 0),
+    "street": (6, 183, 1, 1),
+    "city": (6, 183, 1, 3),
+    "postal_code": (6, 183, 1, 4),
+    "state": (6, 183, 1, 5),
+    "country_code": (6, 183, 1, 6),
+    "time_zone": (6, 30),
+    "price_range": (6, 4, 2),
+    "reviews_link": (6, 4, 3, 0),
+    "rating": (6, 4, 7),
+    "reviews": (6, 4, 8),
+    "phone": (6, 178, 0, 0),
+    "title": (6, 11),
+    "address": (6, 39),
+    "address_fallback": (6, 37, 0, 0, 17, 0),
+    "website": (6, 7, 0),
+    "data_id": (6, 10),
+    "cid": (25, 3, 0, 13, 0, 0, 1),
+    **{f"rating_{i}": (6, 175, 3, i - 1) for i in range(1, 6)},
+}
+place_path_tree = PathTree(place_paths)
+
+
+def loads(data):
+    """json.loads, with orjson when it is installed"""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson refuses some valid JSON, like integers past 64 bits
+            pass
+    return json.loads(data)
 
-def get_website(data):
-    return clean_link(safe_get(data, 6, 7, 0))
 
+def parse(data):
+    # Assuming 'input_string' is provided to the function in some way
+    input_string = loads(data)[3][6]  # Replace with actual input
+    substring_to_remove = ")]}'"
 
-def get_main_category(data):
-    return safe_get(data, 6, 13, 0)
+    modified_string = input_string
+    if input_string.startswith(substring_to_remove):
+        modified_string = input_string[len(substring_to_remove) :]
 
+    return loads(modified_string)
 
-def get_cid(data):
-    return safe_get(data, 25, 3, 0, 13, 0, 0, 1)
 
+def find_initialization_state(html):
+    """
+    Bounds of APP_INITIALIZATION_STATE in a place page, found without
+    copying the page.
 
-def get_data_id(data):
-    return safe_get(data, 6, 10)
+    :return: Start and end index of the state in `html`.
+    """
+    start = html.find(initialization_state_start)
+    if start == -1:
+        raise ValueError("Page has no APP_INITIALIZATION_STATE")
+    start += len(initialization_state_start)
+    end = html.find(initialization_state_end, start)
+    return start, end if end != -1 else len(html)
 
 
-def get_reviews_per_rating(data):
-    return {f"rating_{i}": safe_get(data, 6, 175, 3, i - 1) for i in range(1, 6)}
+def initialization_state(html):
+    start, end = find_initialization_state(html)
+    return html[start:end]
 
 
-def parse(data):
-    # Assuming 'input_string' is provided to the function in some way
-    input_string = json.loads(data)[3][6]  # Replace with actual input
-    substring_to_remove = ")]}'"
+def is_place_payload(data):
+    return isinstance(data, list) and len(data) > 6 and isinstance(data[6], list)
 
-    modified_string = input_string
-    if input_string.startswith(substring_to_remove):
-        modified_string = input_string[len(substring_to_remove) :]
 
-    return json.loads(modified_string)
+def decode_place_payload(html):
+    """
+    Place payload of a place page, what parse returns for its
+    APP_INITIALIZATION_STATE.
+
+    The payload is a JSON string inside the state. It is located with index
+    searches and only that string is unescaped and decoded, instead of
+    copying the state out of the page and decoding all of it first. Pages
+    where it can't be found that way, or where more than one string looks
+    like it, fall back to parse, which reads the one at [3][6].
+    """
+    start, end = find_initialization_state(html)
+    marker = html.find(payload_marker, start, end)
+    if marker != -1 and html.find(payload_marker, marker + 1, end) == -1:
+        try:
+            payload, _ = scanstring(html, marker + 1)
+            data = loads(payload[len(")]}'") :])
+        except ValueError:
+            data = None
+        if is_place_payload(data):
+            return data
+    return parse(html[start:end])
 
 
 def get_hl_from_link(link):
@@ -620,7 +743,7 @@ def extract_most_popular_times(data):
 
 def parse_extract_possible_map_link(data):
     # Assuming 'input_string' is provided to the function in some way
-    loaded = json.loads(data)
+    loaded = loads(data)
 
     input_string = safe_get(loaded, 3, -1)  # Replace with actual input
     substring_to_remove = ")]}'"
@@ -629,7 +752,7 @@ def parse_extract_possible_map_link(data):
     if input_string.startswith(substring_to_remove):
         modified_string = input_string[len(substring_to_remove) :]
 
-    return json.loads(modified_string)
+    return loads(modified_string)
 
 
 def perform_extract_possible_map_link(input_str):
@@ -637,97 +760,160 @@ def perform_extract_possible_map_link(input_str):
     return safe_get(data, 6, 27) or safe_get(data, 0, 1, 0, 14, 27)
 
 
-def extract_data(input_str, link):
-    data = parse(input_str)
-
-    categories = get_categories(data)
-    place_id = get_place_id(data)
-    order_online_links = get_order_online_link(data)
-    thumbnail = get_thumbnail(data)
-    coordinates = get_gps_coordinates(data)
-    images = get_images(data)
-    description = get_description(data)
-    status = get_open_state(data)
-    plus_code = get_plus_code(data)
-    reservations = get_reservations(data)
-    menu = get_menu(data)
-    owner = get_owner(data)
-    time_zone = get_time_zone(data)
-    complete_address = get_complete_address(data)
-    reviews_link = get_reviews_link(data)
+def get_reviews_link_or_generated(values, link, get):
+    reviews_link = get_reviews_link(values)
     if reviews_link is None:
-        gl = complete_address["country_code"]
+        gl = get("detailed_address")["country_code"]
         hl = get_hl_from_link(link)
         query = extract_business_name(link)
-        reviews_link = generate_google_reviews_url(place_id, query, 0, hl, gl)
+        reviews_link = generate_google_reviews_url(get("place_id"), query, 0, hl, gl)
+    return reviews_link
 
-    price_range = get_price_range(data)
-    reviews_per_rating = get_reviews_per_rating(data)
-    cid = get_cid(data)
-    data_id = get_data_id(data)
-    about = get_about(data)
-    title = get_title(data)
 
-    hours = get_hours(data)
+def get_reordered_hours(values):
+    hours = get_hours(values)
     if hours:
-        hours = reorder_hours_list(hours)
-    else:
-        hours = []
-
-    rating = get_rating(data)
-    reviews = get_reviews(data)
-    phone = get_phone(data)
-    address = get_address(data)
-    website = get_website(data)
-    main_category = get_main_category(data)
-
-    review_keywords = get_review_keywords(data)
-
-    first_question = extract_questions(data)
-
-    # competitors = extract_competitors(data, link)
-    popular_times = extract_popular_times(data)
-    most_popular_times = extract_most_popular_times(popular_times)
-    is_claimed = get_can_claim(data)
-    
-    # from botasaurus import bt
-    # bt.write_temp_json(data)
-    return {
-        "place_id": place_id,
-        "name": title,
-        "description": description,
-        "reviews": reviews,
-        # "competitors": competitors,
-        "website": website,
-        "can_claim": is_claimed,
-        "owner": owner,
-        "featured_image": thumbnail,
-        "main_category": main_category,
-        "categories": categories,
-        "rating": rating,
-        "workday_timing": extract_work_day_time(hours),
-        "closed_on": find_close_days(hours),
-        "phone": phone,
-        "address": address,
-        "review_keywords": review_keywords,
-        "link": link,
-        "status": status,
-        "price_range": price_range,
-        "reviews_per_rating": reviews_per_rating,
-        "featured_question": first_question,
-        "reviews_link": reviews_link,
-        "coordinates": coordinates,
-        "plus_code": plus_code,
-        "detailed_address": complete_address,
-        "time_zone": time_zone,
-        "cid": cid,
-        "data_id": data_id,
-        "menu": menu,
-        "reservations": reservations,
-        "order_online_links": order_online_links,
-        "about": about,
-        "images": images,
-        "hours": hours,
-        "most_popular_times": most_popular_times,
-        "popular_times": popular_times,
-    }
\ No newline at end of file
+        return reorder_hours_list(hours)
+    return []
+
+
+def from_values(getter):
+    return lambda values, link, get: getter(values)
+
+
+# Extractor of every field of a place, in the order of the place dict. Each
+# one gets the values of place_paths, the link and `get`, which returns
+# another field, so the fields derived from others reuse them.
+field_extractors = {
+    "place_id": from_values(get_place_id),
+    "name": from_values(get_title),
+    "description": from_values(get_description),
+    "reviews": from_values(get_reviews),
+    # "competitors": lambda values, link, get: extract_competitors(values, link),
+    "website": from_values(get_website),
+    "can_claim": from_values(get_can_claim),
+    "owner": from_values(get_owner),
+    "featured_image": from_values(get_thumbnail),
+    "main_category": from_values(get_main_category),
+    "categories": from_values(get_categories),
+    "rating": from_values(get_rating),
+    "workday_timing": lambda values, link, get: extract_work_day_time(get("hours")),
+    "closed_on": lambda values, link, get: find_close_days(get("hours")),
+    "phone": from_values(get_phone),
+    "address": from_values(get_address),
+    "review_keywords": from_values(get_review_keywords),
+    "link": lambda values, link, get: link,
+    "status": from_values(get_open_state),
+    "price_range": from_values(get_price_range),
+    "reviews_per_rating": from_values(get_reviews_per_rating),
+    "featured_question": from_values(extract_questions),
+    "reviews_link": get_reviews_link_or_generated,
+    "coordinates": from_values(get_gps_coordinates),
+    "plus_code": from_values(get_plus_code),
+    "detailed_address": from_values(get_complete_address),
+    "time_zone": from_values(get_time_zone),
+    "cid": from_values(get_cid),
+    "data_id": from_values(get_data_id),
+    "menu": from_values(get_menu),
+    "reservations": from_values(get_reservations),
+    "order_online_links": from_values(get_order_online_link),
+    "about": from_values(get_about),
+    "images": from_values(get_images),
+    "hours": from_values(get_reordered_hours),
+    "most_popular_times": lambda values, link, get: extract_most_popular_times(
+        get("popular_times")
+    ),
+    "popular_times": from_values(extract_popular_times),
+}
+
+
+address_paths = ("ward", "street", "city", "postal_code", "state", "country_code")
+
+# Paths of place_paths every field reads, with those of the fields it derives
+# from. A path missing here raises a KeyError when only some fields are
+# extracted.
+field_paths = {
+    "place_id": ("place_id",),
+    "name": ("title",),
+    "description": ("description", "description_fallback"),
+    "reviews": ("reviews",),
+    "website": ("website",),
+    "can_claim": ("claim_link", "claim_text"),
+    "owner": ("owner_name", "owner_id"),
+    "featured_image": ("thumbnail",),
+    "main_category": ("main_category",),
+    "categories": ("categories",),
+    "rating": ("rating",),
+    "workday_timing": ("hours",),
+    "closed_on": ("hours",),
+    "phone": ("phone",),
+    "address": ("address", "address_fallback"),
+    "review_keywords": ("review_keywords",),
+    "link": (),
+    "status": ("open_state",),
+    "price_range": ("price_range",),
+    "reviews_per_rating": tuple(f"rating_{i}" for i in range(1, 6)),
+    "featured_question": ("questions", "owner_name", "owner_id"),
+    "reviews_link": ("reviews_link", "place_id", *address_paths),
+    "coordinates": ("latitude", "longitude"),
+    "plus_code": ("plus_code",),
+    "detailed_address": address_paths,
+    "time_zone": ("time_zone",),
+    "cid": ("cid",),
+    "data_id": ("data_id",),
+    "menu": ("menu_link", "menu_source"),
+    "reservations": ("reservations",),
+    "order_online_links": ("order_online", "order_online_fallback"),
+    "about": ("about",),
+    "images": ("images",),
+    "hours": ("hours",),
+    "most_popular_times": ("popular_times",),
+    "popular_times": ("popular_times",),
+}
+
+
+def get_resolver(fields):
+    if fields is None:
+        return place_path_tree.resolve
+    return place_path_tree.resolver(
+        path for field in fields for path in field_paths.get(field, ())
+    )
+
+
+def extract_data(input_str, link, fields=None):
+    """
+    Extracts a place out of its APP_INITIALIZATION_STATE.
+
+    :param fields: Fields to extract, every field when None.
+    """
+    return extract_payload(parse(input_str), link, fields)
+
+
+def extract_place_page(html, link, fields=None):
+    """
+    Extracts a place out of its page, decoding only its payload.
+
+    :param fields: Fields to extract, every field when None.
+    """
+    return extract_payload(decode_place_payload(html), link, fields)
+
+
+def extract_payload(data, link, fields=None):
+    """
+    Extracts a place out of its decoded payload.
+
+    :param fields: Fields to extract, every field when None. Only the
+    extractors of these fields, and of the fields they derive from, run.
+    :return: Dict of the selected fields, in the order of field_extractors.
+    """
+    values = get_resolver(fields)(data)
+
+    extracted = {}
+
+    def get(field):
+        if field not in extracted:
+            extracted[field] = field_extractors[field](values, link, get)
+        return extracted[field]
+
+    selected = field_extractors if fields is None else set(fields)
+    return {field: get(field) for field in field_extractors if field in selected}
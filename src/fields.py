@@ -70,6 +70,20 @@ DEFAULT_FIELDS_WITHOUT_SOCIAL_DATA = [
     Fields.ADDRESS,
 ]
 
+# Fields every place gets whatever was selected, as the filters, the sorts,
+# the review scraping and the output read them
+PIPELINE_FIELDS = [
+    Fields.PLACE_ID,
+    Fields.NAME,
+    Fields.LINK,
+    Fields.MAIN_CATEGORY,
+    Fields.RATING,
+    Fields.REVIEWS,
+    Fields.REVIEWS_PER_RATING,
+    Fields.WEBSITE,
+    Fields.PHONE,
+]
+
 DEFAULT_SOCIAL_FIELDS = [
     Fields.EMAILS,
     Fields.PHONES,
@@ -1,7 +1,20 @@
-from typing import Dict, List, Optional, Union
+import asyncio
+import threading
+from typing import Callable, Dict, List, Optional, Union
 
 from src import scraper
+from src.async_reviews_scraper import EventLoopThread, scrape_reviews_async
+from src.browser_pool import get_browser_pool
+from src.extract_data import place_path_tree
+from src.hedging import get_hedger
+from src.parse_pool import get_parse_pool
+from src.pipeline import Pipeline, Stage
+from src.rate_limiter import get_rate_limiter
+from src.response_cache import get_response_cache
+from src.review_state import get_review_state
+from src.run_journal import current_run_id, start_run_journal
 from src.sort_filter import filter_places, sort_places
+from src.transport import get_transport
 from src.write_output import write_output
 
 from .fields import (
@@ -9,6 +22,7 @@ from .fields import (
     ALL_SOCIAL_FIELDS,
     DEFAULT_FIELDS,
     DEFAULT_FIELDS_WITHOUT_SOCIAL_DATA,
+    PIPELINE_FIELDS,
     Fields,
 )
 
@@ -21,6 +35,7 @@ def create_place_data(
     geo_coordinates,
     zoom,
     convert_to_english,
+    fields=None,
 ):
     place_data = {
         "query": query,
@@ -30,11 +45,14 @@ def create_place_data(
         "geo_coordinates": geo_coordinates,
         "zoom": zoom,
         "convert_to_english": convert_to_english,
+        "fields": fields,
     }
     return place_data
 
 
-def create_reviews_data(places, reviews_max, reviews_sort, convert_to_english, lang):
+def create_reviews_data(
+    places, reviews_max, reviews_sort, convert_to_english, lang, incremental=False
+):
     reviews_data = []
 
     chosen_lang = lang if lang else "en"
@@ -52,12 +70,37 @@ def create_reviews_data(places, reviews_max, reviews_sort, convert_to_english, l
             "max": max_r,
             "reviews_sort": reviews_sort,
             "lang": chosen_lang,
+            "incremental": incremental,
         }
         reviews_data.append(review_data)
 
     return reviews_data
 
 
+def filter_changed_places(places):
+    """Drops the places whose review count and rating histogram did not
+    move since their reviews were last scraped"""
+    review_state = get_review_state()
+    changed = [place for place in places if not review_state.is_unchanged(place)]
+    print(f"Skipping reviews of {len(places) - len(changed)} unchanged places")
+    return changed
+
+
+def save_review_snapshots(places, reviews):
+    """Remembers the review count and rating histogram of the places whose
+    reviews were all scraped, once the output is written. Failed places are
+    left out, so the next run scrapes them again"""
+    review_state = get_review_state()
+    scraped_ids = {
+        review["place_id"]
+        for review in reviews
+        if review is not None and review.get("finished")
+    }
+    for place in places:
+        if place["place_id"] in scraped_ids:
+            review_state.defer_snapshot(place)
+
+
 def merge_reviews(places, reviews):
     for place in places:
         # Find the reviews for the current place based on place_id
@@ -101,6 +144,14 @@ def determine_fields(fields, scrape_reviews):
     return fields #ls
 
 
+def determine_place_fields(fields):
+    """Fields to extract out of the place pages, None to extract them all
+    when every field is selected"""
+    if all(field in fields for field in ALL_FIELDS_WITHOUT_SOCIAL_DATA):
+        return None
+    return fields + [field for field in PIPELINE_FIELDS if field not in fields]
+
+
 def process_result(
     min_reviews,
     max_reviews,
@@ -118,6 +169,10 @@ def process_result(
     convert_to_english,
     cache,
     places_obj,
+    reviews_max_in_flight=None,
+    reviews_incremental=False,
+    reviews_skip_unchanged=False,
+    run_coroutine: Callable = asyncio.run,
 ):
     places = places_obj["places"]
     query = places_obj["query"]
@@ -136,14 +191,27 @@ def process_result(
     # 3. Scrape Reviews
     if scrape_reviews:
         placed_with_reviews = filter_places(cleaned_places, {"min_reviews": 1})
+        if reviews_skip_unchanged:
+            placed_with_reviews = filter_changed_places(placed_with_reviews)
         reviews_data = create_reviews_data(
             placed_with_reviews,
             reviews_max,
             reviews_sort,
             convert_to_english,
             lang,
+            reviews_incremental,
         )
-        reviews_details = scraper.scrape_reviews(reviews_data, cache=cache)
+        if reviews_max_in_flight:
+            reviews_details = run_coroutine(
+                scrape_reviews_async(reviews_data, max_in_flight=reviews_max_in_flight)
+            )
+        else:
+            # A cached result would hide the reviews posted since
+            reviews_details = scraper.thread_task(scraper.scrape_reviews)(
+                reviews_data, metadata={"cache": cache and not reviews_incremental}
+            )
+        if reviews_skip_unchanged:
+            save_review_snapshots(placed_with_reviews, reviews_details)
         # print_social_errors
         cleaned_places = merge_reviews(cleaned_places, reviews_details)
 
@@ -157,6 +225,155 @@ def process_result(
     return result_item
 
 
+# Workers of every stage of Gmaps.places(pipeline_workers=...). Discovery
+# gets one per driver of the browser pool, BROWSER_DRIVERS
+default_pipeline_workers = {"discovery": 1, "details": 2, "reviews": 2, "output": 1}
+# Links of a query handed to the details stage at once
+default_pipeline_batch_size = 20
+
+
+def scrape_queries_pipelined(
+    queries: List[str],
+    place_data_of: Callable[[str], Dict],
+    process: Callable[..., Dict],
+    sort,
+    pipeline_workers: Dict[str, int],
+    use_cache: bool,
+    convert_to_english: bool,
+    place_fields,
+    journal=None,
+    batch_size: int = default_pipeline_batch_size,
+) -> List[Dict]:
+    """
+    Scrapes `queries` through four stages running concurrently: discovery
+    searches a query for its place links, details scrapes them by batches,
+    reviews runs `process` (filters, sorts and scrapes the reviews) on every
+    batch, and output gathers the batches of every query. The reviews of the
+    first query are scraped while the next ones are still searched.
+
+    The workers of a stage call the botasaurus tasks concurrently, each
+    through instances of its own (scraper.thread_task), and the reviews
+    workers share one event loop for their coroutines.
+
+    :param place_data_of: Returns the scrape_places data of a query.
+    :param process: process_result of a {"query", "places"} batch, taking
+    the run_coroutine of process_result as second argument.
+    :param pipeline_workers: Workers of each stage, by stage name, the
+    others have their default_pipeline_workers, and discovery one per
+    driver of the browser pool.
+    :return: Result item of every query with places, in the order of
+    `queries`.
+    """
+    browser_pool = get_browser_pool()
+    workers = {
+        **default_pipeline_workers,
+        "discovery": browser_pool.drivers,
+        **pipeline_workers,
+    }
+    queries = list(dict.fromkeys(queries))
+    lock = threading.Lock()
+    # Progress of every query, to know when its last batch is out
+    progress = {
+        query: {"batches": None, "done": 0, "places": [], "sponsored": []}
+        for query in queries
+    }
+    failed_queries = set()
+    results = {}
+
+    def finish_batch(query, places=(), batches=None, failed=False):
+        with lock:
+            state = progress[query]
+            if batches is not None:
+                state["batches"] = batches
+            else:
+                state["done"] += 1
+                state["places"].extend(places)
+            if failed:
+                failed_queries.add(query)
+            if state["batches"] is None or state["done"] < state["batches"]:
+                return
+        if state["batches"] == 0:
+            if query not in failed_queries:
+                print(f"No places found for query: {query}")
+            return
+        places = scraper.merge_sponsored_links(state["places"], state["sponsored"])
+        result_item = {"query": query, "places": sort_places(places, sort)}
+        results[query] = result_item
+        if query in failed_queries:
+            # Not journaled, so the next attempt does it again
+            print(f"Query done, missing the batches that failed: {query}")
+        else:
+            if journal is not None:
+                journal.finish_query(query, result_item)
+            print(f"Query done: {query}")
+
+    def discover(query, emit):
+        print(f"query: {query}")
+        data = dict(place_data_of(query), links_only=True)
+        found = browser_pool.search(
+            scraper.scrape_places, data, metadata={"cache": use_cache}
+        )
+        links = found["links"]
+        progress[query]["sponsored"] = found["sponsored_links"]
+        batches = [
+            links[start : start + batch_size]
+            for start in range(0, len(links), batch_size)
+        ]
+        finish_batch(query, batches=len(batches))
+        for batch in batches:
+            emit({"query": query, "links": batch})
+
+    def scrape_details(item, emit):
+        places = scraper.scrape_place_batch(
+            item["links"], place_fields, use_cache, convert_to_english
+        )
+        emit({"query": item["query"], "places": places})
+
+    def process_batch(item, emit):
+        if item["places"]:
+            item = process(item, event_loop.run)
+        emit(item)
+
+    def output(item, emit):
+        finish_batch(item["query"], item["places"])
+
+    def on_discovery_failure(query, error):
+        finish_batch(query, batches=0, failed=True)
+
+    def on_batch_failure(item, error):
+        finish_batch(item["query"], failed=True)
+
+    pipeline = Pipeline(
+        [
+            Stage(
+                "discovery",
+                discover,
+                workers["discovery"],
+                on_failure=on_discovery_failure,
+            ),
+            Stage(
+                "details",
+                scrape_details,
+                workers["details"],
+                on_failure=on_batch_failure,
+            ),
+            Stage(
+                "reviews",
+                process_batch,
+                workers["reviews"],
+                on_failure=on_batch_failure,
+            ),
+            Stage("output", output, workers["output"], on_failure=on_batch_failure),
+        ]
+    )
+    with EventLoopThread() as event_loop, pipeline:
+        for query in queries:
+            pipeline.put(query)
+    pipeline.log_stats()
+
+    return [results[query] for query in queries if query in results]
+
+
 def merge_places(places):
     merged_places = []
     for place_group in places:
@@ -220,6 +437,10 @@ class Gmaps:
         scrape_reviews: bool = False,
         reviews_max: Optional[int] = ALL_REVIEWS,
         reviews_sort: str = NEWEST,
+        reviews_max_in_flight: Optional[int] = None,
+        reviews_incremental: bool = False,
+        reviews_skip_unchanged: bool = False,
+        pipeline_workers: Optional[Dict[str, int]] = None,
         fields: Optional[Union[str, List[str]]] = ALL_FIELDS,
         lang: Optional[str] = None,
         geo_coordinates: Optional[str] = None,
@@ -247,7 +468,23 @@ class Gmaps:
         scraped.
         :param reviews_max: Maximum number of reviews to scrape per place.
         :param reviews_sort: Sort order for reviews.
-        :param fields: List of fields to return in the result.
+        :param reviews_max_in_flight: When set, reviews of all places are
+        paginated concurrently on one event loop with at most this many
+        requests in flight, instead of one place at a time.
+        :param reviews_incremental: Only scrape the reviews posted since the
+        previous run that wrote its output, which are kept per place in
+        REVIEW_STATE_DB. Needs reviews_sort=NEWEST.
+        :param reviews_skip_unchanged: Don't scrape the reviews of places
+        whose review count and rating histogram are the same as when their
+        reviews were last scraped. These places get no detailed_reviews.
+        :param pipeline_workers: When set, the queries go through a pipeline
+        whose discovery, details, reviews and output stages run at once,
+        with this many workers per stage name (default_pipeline_workers for
+        the missing ones). The reviews of a query are then scraped while the
+        next queries are searched.
+        :param fields: List of fields to return in the result. Only these
+        fields, and the ones filtering, sorting and review scraping need, are
+        extracted out of the place pages.
         :param lang: Language in which to return the results.
         :param geo_coordinates: Geographical coordinates to scrape around.
         :param zoom: Zoom level for scraping.
@@ -257,12 +494,16 @@ class Gmaps:
         result = []
 
         fields = determine_fields(fields, scrape_reviews)
+        place_fields = determine_place_fields(fields)
 
-        for query in queries:
-            print(f"query: {query}")
+        # A retry of the same run resumes where the former attempt died
+        journal = start_run_journal(current_run_id(f"{bucket_name}/{blob_name}"))
+        if reviews_incremental or reviews_skip_unchanged:
+            # Left by a former call that failed before writing its output
+            get_review_state().discard_updates()
 
-            # 1. Scrape Places
-            place_data = create_place_data(
+        def place_data_of(query):
+            return create_place_data(
                 query,
                 is_spending_on_ads,
                 max,
@@ -270,15 +511,11 @@ class Gmaps:
                 geo_coordinates,
                 zoom,
                 convert_to_english,
+                place_fields,
             )
-            places_obj = scraper.scrape_places(place_data, cache=use_cache)
 
-            # Check if the places are empty
-            if places_obj["places"] == []:
-                print(f"No places found for query: {query}")
-                continue
-
-            result_item = process_result(
+        def process(places_obj, run_coroutine=asyncio.run):
+            return process_result(
                 min_reviews,
                 max_reviews,
                 category_in,
@@ -295,15 +532,92 @@ class Gmaps:
                 convert_to_english,
                 use_cache,
                 places_obj,
+                reviews_max_in_flight,
+                reviews_incremental,
+                reviews_skip_unchanged,
+                run_coroutine,
             )
 
-            result.append(result_item)
+        pending = []
+        for query in queries:
+            finished = journal.get_query(query) if journal is not None else None
+            if finished is not None:
+                print(f"Query already done by a former attempt: {query}")
+                result.append(finished)
+            else:
+                pending.append(query)
+
+        if pipeline_workers is not None:
+            result.extend(
+                scrape_queries_pipelined(
+                    pending,
+                    place_data_of,
+                    process,
+                    sort,
+                    pipeline_workers,
+                    use_cache,
+                    convert_to_english,
+                    place_fields,
+                    journal,
+                )
+            )
+            pending = []
+
+        # 1. Scrape Places, with as many queries searched at once as the
+        # browser pool has drivers
+        browser_pool = get_browser_pool()
+        searches = browser_pool.map(
+            scraper.scrape_places,
+            [place_data_of(query) for query in pending],
+            metadata={"cache": use_cache},
+        )
+        for query, places_obj in zip(pending, searches):
+            print(f"query: {query}")
+
+            # Check if the places are empty
+            if places_obj["places"] == []:
+                print(f"No places found for query: {query}")
+                continue
 
+            result_item = process(places_obj)
+
+            result.append(result_item)
+            if journal is not None:
+                journal.finish_query(query, result_item)
 
         if result:
             all_places = sort_places(merge_places(result), sort)
 
             write_output(bucket_name, blob_name, all_places, fields)
 
-        scraper.scrape_places.close()
+        if reviews_incremental or reviews_skip_unchanged:
+            # The watermarks and snapshots are only saved once the reviews
+            # are written, the next run would not scrape them again
+            get_review_state().commit_updates()
+
+        if journal is not None:
+            journal.clear()
+
+        print(f"Rate limiter: {get_rate_limiter().stats()}")
+        hedger = get_hedger()
+        if hedger is not None:
+            hedger.log_stats()
+        # Paths missing on most places hint google moved them
+        print(f"Place path miss rates: {place_path_tree.miss_rates()}")
+        parse_pool = get_parse_pool()
+        if parse_pool is not None:
+            print(f"Parse pool: {parse_pool.stats()}")
+        response_cache = get_response_cache()
+        if response_cache is not None:
+            print(f"Response cache: {response_cache.stats()}")
+        if scraper.is_place_streaming():
+            stats = get_transport().stats.as_dict()
+            print(
+                f"Place pages cut short: {stats['cut_short']}, "
+                f"bytes saved: {stats['bytes_saved']}"
+            )
+
+        print(f"Browser pool: {browser_pool.stats()}")
+
+        browser_pool.close()
         return result
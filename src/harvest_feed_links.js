@@ -0,0 +1,63 @@
+function harvest_feed_links(selector) {
+  // The links of the feed items rendered since the previous call. The
+  // first call on a feed starts a MutationObserver buffering the links of
+  // the items the feed adds, so the items already returned are never read
+  // again.
+  const feed = document.querySelector('[role="feed"]')
+  if (!feed) {
+    return []
+  }
+
+  let harvest = feed.harvest
+  if (!harvest) {
+    harvest = { seen: new Set(), pending: [] }
+
+    const collect = (link) => {
+      const href = link.href
+      if (href && !harvest.seen.has(href)) {
+        harvest.seen.add(href)
+        harvest.pending.push(href)
+      }
+    }
+
+    harvest.collectRecords = (records) => {
+      for (const record of records) {
+        if (record.type === 'attributes') {
+          // Links added before their href is set
+          if (record.target.matches(selector)) {
+            collect(record.target)
+          }
+          continue
+        }
+        for (const node of record.addedNodes) {
+          if (node.nodeType !== Node.ELEMENT_NODE) {
+            continue
+          }
+          if (node.matches(selector)) {
+            collect(node)
+          }
+          node.querySelectorAll(selector).forEach(collect)
+        }
+      }
+    }
+
+    harvest.observer = new MutationObserver(harvest.collectRecords)
+    harvest.observer.observe(feed, {
+      childList: true,
+      subtree: true,
+      attributes: true,
+      attributeFilter: ['href'],
+    })
+    feed.querySelectorAll(selector).forEach(collect)
+    feed.harvest = harvest
+  }
+
+  // Mutations not handed to the observer yet
+  harvest.collectRecords(harvest.observer.takeRecords())
+
+  const links = harvest.pending
+  harvest.pending = []
+  return links
+}
+
+return harvest_feed_links(arguments[0])
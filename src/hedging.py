@@ -0,0 +1,182 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Optional, Sequence, TypeVar
+
+T = TypeVar("T")
+
+default_percentile = 95
+default_max_hedge_ratio = 0.1  # at most one extra request per ten
+default_min_samples = 20
+default_window = 500
+default_max_workers = 16
+default_stats_interval = 60
+
+# Percentile of recent latency after which a place request is hedged,
+# e.g. 95. Hedging is off when it is not set
+hedge_percentile_env = "PLACE_HEDGE_PERCENTILE"
+
+
+def latency_percentile(samples: Sequence[float], q: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class HedgedFetcher:
+    """
+    Sends a duplicate of a request that is slower than the `percentile` of
+    recent latencies, and keeps whichever answers first. The loser can't be
+    cancelled mid flight, its answer is dropped.
+
+    Hedges are capped to `max_hedge_ratio` of the requests, so a slow day
+    for google does not double our traffic. stats() compares the latency of
+    the first request alone with the latency we actually got.
+    """
+
+    def __init__(
+        self,
+        percentile: float = default_percentile,
+        max_hedge_ratio: float = default_max_hedge_ratio,
+        min_samples: int = default_min_samples,
+        window: int = default_window,
+        max_workers: int = default_max_workers,
+        stats_interval: float = default_stats_interval,
+    ):
+        self.percentile = percentile
+        self.max_hedge_ratio = max_hedge_ratio
+        self.min_samples = min_samples
+        self.stats_interval = stats_interval
+        self._logged_at = time.monotonic()
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        # Latency of the first request alone, whether or not it was hedged
+        self._primary_latencies: deque = deque(maxlen=window)
+        # Latency of the answer we used
+        self._latencies: deque = deque(maxlen=window)
+        self._executor = ThreadPoolExecutor(max_workers, "hedged-fetch")
+        self._lock = threading.Lock()
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds after which a request gets hedged, None until enough
+        latencies were seen"""
+        with self._lock:
+            if len(self._primary_latencies) < self.min_samples:
+                return None
+            return latency_percentile(self._primary_latencies, self.percentile)
+
+    def _take_hedge_budget(self) -> bool:
+        with self._lock:
+            if self.hedges + 1 > self.requests * self.max_hedge_ratio:
+                return False
+            self.hedges += 1
+            return True
+
+    def _submit_timed(self, fetch: Callable[[], T], primary: bool):
+        started_at = time.monotonic()
+
+        def timed():
+            result = fetch()
+            if primary:
+                with self._lock:
+                    self._primary_latencies.append(time.monotonic() - started_at)
+            return result
+
+        return self._executor.submit(timed)
+
+    def fetch(
+        self, fetch: Callable[[], T], hedge: Optional[Callable[[], T]] = None
+    ) -> T:
+        """
+        Runs `fetch`, and `hedge` (same as `fetch` by default) if it takes
+        longer than the hedge delay. `fetch` should only be the request:
+        its time sets the hedge delay, a wait for the rate limiter in it
+        would hedge requests when there is the least room for them.
+        """
+        with self._lock:
+            self.requests += 1
+        started_at = time.monotonic()
+        delay = self.hedge_delay()
+        primary = self._submit_timed(fetch, primary=True)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._take_hedge_budget():
+            result = primary.result()
+            self._record(started_at)
+            return result
+
+        secondary = self._submit_timed(hedge or fetch, primary=False)
+        pending = {primary, secondary}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                if future is secondary:
+                    with self._lock:
+                        self.hedge_wins += 1
+                self._record(started_at)
+                return future.result()
+        raise error
+
+    def _record(self, started_at: float):
+        now = time.monotonic()
+        with self._lock:
+            self._latencies.append(now - started_at)
+            if now - self._logged_at < self.stats_interval:
+                return
+            self._logged_at = now
+        self.log_stats()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            primary_p99 = latency_percentile(self._primary_latencies, 99)
+            p99 = latency_percentile(self._latencies, 99)
+            return {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_rate": round(self.hedges / max(self.requests, 1), 4),
+                "hedge_wins": self.hedge_wins,
+                "p50": latency_percentile(self._latencies, 50),
+                "p99": p99,
+                "p99_without_hedging": primary_p99,
+                "p99_saved": (
+                    primary_p99 - p99
+                    if primary_p99 is not None and p99 is not None
+                    else None
+                ),
+            }
+
+    def log_stats(self):
+        print(f"Hedged requests: {self.stats()}")
+
+
+_hedger: Optional[HedgedFetcher] = None
+_hedger_created = False
+_hedger_lock = threading.Lock()
+
+
+def get_hedger() -> Optional[HedgedFetcher]:
+    """Returns the process wide hedger, or None when hedging is off"""
+    global _hedger, _hedger_created
+    with _hedger_lock:
+        if not _hedger_created:
+            value = os.getenv(hedge_percentile_env)
+            if value:
+                _hedger = HedgedFetcher(percentile=float(value))
+            _hedger_created = True
+        return _hedger
+
+
+def set_hedger(hedger: Optional[HedgedFetcher]):
+    """Replaces the process wide hedger, None turning hedging off"""
+    global _hedger, _hedger_created
+    with _hedger_lock:
+        _hedger = hedger
+        _hedger_created = True
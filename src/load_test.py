@@ -0,0 +1,175 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import time
+from typing import Dict, List, Optional
+
+from src import synthetic_server
+from src.rate_limiter import AdaptiveRateLimiter, set_rate_limiter
+from src.transport import google_base_url_env
+
+default_places = 1000
+default_levels = "1,4,16,64"
+default_rate = 1000.0
+
+
+def memory_mb() -> Dict[str, float]:
+    """Current and peak resident memory of the process"""
+    # ru_maxrss is in kilobytes on linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    current = None
+    try:
+        with open("/proc/self/statm") as file:
+            pages = int(file.read().split()[1])
+        current = pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (OSError, ValueError):
+        pass
+    return {
+        "rss_mb": round(current, 1) if current is not None else None,
+        "max_rss_mb": round(peak, 1),
+    }
+
+
+class Phase:
+    """Times a phase of the load test and measures what it did"""
+
+    def __init__(
+        self,
+        name: str,
+        server: Optional[synthetic_server.SyntheticServer],
+        rate: float,
+    ):
+        self.name = name
+        self.server = server
+        self.rate = rate
+        self.report: Dict = {"phase": name}
+
+    def __enter__(self):
+        # Phases don't inherit the slowdowns of the former ones
+        set_rate_limiter(
+            AdaptiveRateLimiter(initial_rate=self.rate, max_rate=self.rate)
+        )
+        self._server_stats = self.server.stats() if self.server else {}
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        seconds = time.perf_counter() - self._started
+        self.report["seconds"] = round(seconds, 2)
+        if self.server is not None:
+            stats = self.server.stats()
+            for name, value in stats.items():
+                self.report[name] = value - self._server_stats.get(name, 0)
+            pages = self.report["place_pages"] + self.report["review_pages"]
+            self.report["requests_per_second"] = round(pages / seconds, 1)
+        self.report.update(memory_mb())
+
+
+def scrape_place_links(links: List[str]) -> List[Dict]:
+    """Scrapes the place pages of `links` the way Gmaps.places does once the
+    search collected them"""
+    from botasaurus import bt
+
+    from src.scraper import retry_failed_places, scrape_place
+
+    scrape_place_obj = scrape_place(metadata={"cache": False})
+    scrape_place_obj.put(links)
+    places = scrape_place_obj.get()
+    return bt.remove_nones(retry_failed_places(links, places))
+
+
+def scrape_reviews_at(reviews_data: List[Dict], level: str) -> List[Dict]:
+    """Scrapes the reviews with the async scraper and `level` requests in
+    flight, or with the botasaurus workers of Gmaps.places when `level` is
+    "sync" """
+    if level == "sync":
+        from src.scraper import scrape_reviews
+
+        return scrape_reviews(reviews_data, metadata={"cache": False})
+
+    from src.async_reviews_scraper import scrape_reviews_async
+
+    return asyncio.run(scrape_reviews_async(reviews_data, int(level)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load test the place and review scraping against the"
+        " synthetic google"
+    )
+    parser.add_argument("--places", type=int, default=default_places)
+    parser.add_argument(
+        "--levels",
+        default=default_levels,
+        help="Comma separated requests in flight to scrape the reviews with,"
+        " sync for the botasaurus workers",
+    )
+    parser.add_argument("--reviews-max", type=int, default=None)
+    parser.add_argument(
+        "--skip-places",
+        action="store_true",
+        help="Scrape the reviews of the links without scraping their pages",
+    )
+    parser.add_argument(
+        "--rate", type=float, default=default_rate, help="Requests per second"
+    )
+    parser.add_argument(
+        "--base-url", help="Synthetic server already running, else one is started"
+    )
+    parser.add_argument("--output", help="Path of the JSON report")
+    synthetic_server.add_arguments(parser)
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.base_url
+    if base_url is None:
+        server = synthetic_server.from_arguments(args, "127.0.0.1", 0)
+        server.start()
+        base_url = server.base_url
+    os.environ[google_base_url_env] = base_url
+
+    from src.gmaps import create_reviews_data
+
+    links = [synthetic_server.place_link(index) for index in range(args.places)]
+    report = {"config": vars(args), "phases": []}
+    print(f"Load testing {len(links)} places on {base_url}")
+
+    if args.skip_places:
+        places = [
+            {"place_id": link, "link": link, "reviews": args.max_reviews}
+            for link in links
+        ]
+    else:
+        with Phase("places", server, args.rate) as phase:
+            places = scrape_place_links(links)
+        phase.report["places"] = len(places)
+        print(json.dumps(phase.report))
+        report["phases"].append(phase.report)
+
+    reviews_max = args.reviews_max if args.reviews_max is not None else "None"
+    reviews_data = create_reviews_data(places, reviews_max, "newest", False, "en")
+    for level in args.levels.split(","):
+        with Phase(f"reviews@{level}", server, args.rate) as phase:
+            results = scrape_reviews_at(reviews_data, level.strip())
+        reviews = sum(len(result["reviews"]) for result in results)
+        phase.report["reviews"] = reviews
+        phase.report["reviews_per_second"] = round(
+            reviews / phase.report["seconds"], 1
+        )
+        print(json.dumps(phase.report))
+        report["phases"].append(phase.report)
+        del results
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Report written to {args.output}")
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
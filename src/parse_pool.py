@@ -0,0 +1,146 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence
+
+default_workers = os.cpu_count() or 1
+
+# Number of processes parsing place and review pages, e.g. 15 on a 16 core
+# host. Pages are parsed on the threads that fetched them when it is not set
+parse_workers_env = "PARSE_WORKERS"
+
+# Scraper of the worker process, only its parsing methods are used
+_review_parser = None
+
+
+def parse_place_page(content: bytes, encoding: Optional[str], link: str, fields):
+    """Runs in a worker: extracts a place out of the bytes of its page, and
+    returns it with the path counts of the worker since its last place"""
+    from src.extract_data import extract_place_page, place_path_tree
+    from src.response_cache import cached_response
+
+    html = cached_response(link, content, encoding).text
+    place = extract_place_page(html, link, fields)
+    return place, place_path_tree.take_counts()
+
+
+def parse_review_page(
+    content: bytes, encoding: Optional[str], hl: str, token: str, review_parser: str
+) -> List[dict]:
+    """Runs in a worker: parses every review of a reviewSort page"""
+    global _review_parser
+    from src.response_cache import cached_response
+    from src.reviews_scraper import GoogleMapsAPIScraper
+
+    if _review_parser is None:
+        # Built without __init__, so the worker doesn't set up the transport,
+        # rate limiter and caches the parsing never touches
+        _review_parser = GoogleMapsAPIScraper.__new__(GoogleMapsAPIScraper)
+    _review_parser.review_parser = review_parser
+    response = cached_response("", content, encoding)
+    return _review_parser._parse_page(response, hl, token)
+
+
+class ParsePool:
+    """
+    Processes parsing place pages and reviewSort pages, so the threads
+    fetching them are not held by the GIL while another page is parsed.
+
+    Pages are sent as raw bytes and come back as the dicts the scraper
+    would have made of them. Workers are spawned, not forked, since the
+    scraper has threads holding locks by the time pages come in.
+    """
+
+    def __init__(self, workers: int = default_workers):
+        self.workers = workers
+        self._executor = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self._lock = threading.Lock()
+        self._counts = {"place_pages": 0, "review_pages": 0, "seconds": 0.0}
+
+    def _count(self, name: str, started_at: float):
+        with self._lock:
+            self._counts[name] += 1
+            self._counts["seconds"] += time.monotonic() - started_at
+
+    def place(self, response, link: str, fields: Optional[Sequence[str]]) -> Dict:
+        """Place of a place page response, as extract_place_page returns it"""
+        from src.extract_data import place_path_tree
+
+        started_at = time.monotonic()
+        place, counts = self._executor.submit(
+            parse_place_page,
+            response.content,
+            response.encoding,
+            link,
+            fields,
+        ).result()
+        place_path_tree.add_counts(*counts)
+        self._count("place_pages", started_at)
+        return place
+
+    def review_page(
+        self, response, hl: str, token: str, review_parser: str
+    ) -> List[dict]:
+        """Reviews of a reviewSort response, as
+        GoogleMapsAPIScraper._parse_page returns them"""
+        started_at = time.monotonic()
+        reviews = self._executor.submit(
+            parse_review_page,
+            response.content,
+            response.encoding,
+            hl,
+            token,
+            review_parser,
+        ).result()
+        self._count("review_pages", started_at)
+        return reviews
+
+    def stats(self) -> Dict:
+        with self._lock:
+            pages = self._counts["place_pages"] + self._counts["review_pages"]
+            return {
+                "workers": self.workers,
+                "place_pages": self._counts["place_pages"],
+                "review_pages": self._counts["review_pages"],
+                # Includes the wait for a free worker and the transfers
+                "mean_seconds": round(self._counts["seconds"] / pages, 4)
+                if pages
+                else None,
+            }
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+_parse_pool: Optional[ParsePool] = None
+_parse_pool_created = False
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool() -> Optional[ParsePool]:
+    """Returns the process wide parse pool, or None when pages are parsed
+    in the threads fetching them"""
+    global _parse_pool, _parse_pool_created
+    with _parse_pool_lock:
+        if not _parse_pool_created:
+            value = os.getenv(parse_workers_env)
+            if value and int(value) > 0:
+                _parse_pool = ParsePool(int(value))
+            _parse_pool_created = True
+        return _parse_pool
+
+
+def set_parse_pool(pool: Optional[ParsePool]):
+    """Replaces the process wide parse pool, None parsing in the fetching
+    threads"""
+    global _parse_pool, _parse_pool_created
+    with _parse_pool_lock:
+        previous = _parse_pool
+        _parse_pool = pool
+        _parse_pool_created = True
+    if previous is not None and previous is not pool:
+        previous.close()
@@ -0,0 +1,185 @@
+from typing import Any, Callable, Dict, FrozenSet, Hashable, Iterable, List
+from typing import Optional, Sequence, Tuple
+
+
+class _Node:
+    __slots__ = ("children", "names", "names_below")
+
+    def __init__(self):
+        self.children: Dict[Hashable, "_Node"] = {}
+        # Indexes of the paths ending at this node
+        self.names: List[int] = []
+        # Indexes of the paths ending at this node or under it, all of them
+        # miss when the node can't be reached
+        self.names_below: List[int] = []
+
+    def collect_names(self) -> List[int]:
+        self.names_below = list(self.names)
+        for child in self.children.values():
+            self.names_below.extend(child.collect_names())
+        return self.names_below
+
+
+class PathTree:
+    """
+    Named paths into nested lists and dicts, compiled into a prefix tree so
+    paths sharing a prefix walk it once. Every node of the tree becomes a
+    closure looking its children up and handing each one to the closure of
+    that child, so the whole tree is resolved in a single call, without
+    looping over the keys of every path like safe_get.
+
+    A path that can't be walked resolves to None, like safe_get. Every such
+    miss is counted per path, so a change in the layout of the data shows up
+    as a jump of the miss rate of the paths it moved. The counts are not
+    locked, so they are approximate when several threads resolve at once.
+    """
+
+    def __init__(self, paths: Dict[str, Sequence[Hashable]]):
+        self.paths = {name: tuple(path) for name, path in paths.items()}
+        self.names = list(self.paths)
+        self.indexes = {name: index for index, name in enumerate(self.names)}
+        self.misses = [0] * len(self.names)
+        # Lookups made elsewhere, e.g. in another process, see add_counts
+        self._added_lookups = [0] * len(self.names)
+        # Calls of every resolver, and the paths each one resolves
+        self._calls: List[List[int]] = []
+        self._resolved: List[List[int]] = []
+        self._resolvers: Dict[FrozenSet[str], Callable] = {}
+        self._resolve = self.resolver()
+
+    def resolve(self, data: Any) -> Dict[str, Any]:
+        """Value of every path in `data`, None for the missing ones"""
+        return self._resolve(data)
+
+    def resolver(
+        self, names: Optional[Iterable[str]] = None
+    ) -> Callable[[Any], Dict[str, Any]]:
+        """
+        Function resolving the paths `names`, every path when None.
+
+        :return: Function of the data returning the dict of those paths only,
+        so reading any other path raises a KeyError.
+        """
+        names = frozenset(self.names if names is None else names)
+        if names not in self._resolvers:
+            indexes = sorted(self.indexes[name] for name in names)
+            self._resolvers[names] = self._compile(indexes)
+        return self._resolvers[names]
+
+    def _compile(self, indexes: List[int]) -> Callable[[Any], Dict[str, Any]]:
+        root = _Node()
+        for index in indexes:
+            node = root
+            for key in self.paths[self.names[index]]:
+                node = node.children.setdefault(key, _Node())
+            node.names.append(index)
+        root.collect_names()
+
+        walk = self._walker(root)
+        template = {self.names[index]: None for index in indexes}
+        found = [self.names[index] for index in root.names]
+        calls = [0]
+        self._calls.append(calls)
+        self._resolved.append(indexes)
+
+        def resolve(data: Any) -> Dict[str, Any]:
+            calls[0] += 1
+            values = template.copy()
+            for name in found:
+                values[name] = data
+            if walk is not None:
+                walk(data, values)
+            return values
+
+        return resolve
+
+    def _walker(self, node: _Node) -> Optional[Callable[[Any, Dict], None]]:
+        """Function walking the children of `node` out of its value, and
+        setting the paths ending on each of them in the values. None for a
+        leaf"""
+        if not node.children:
+            return None
+        misses = self.misses
+        children = []
+        for key, child in node.children.items():
+            # A chain of nodes with one child and no path ending on them is
+            # looked up at once, its paths all miss together
+            keys = [key]
+            while len(child.children) == 1 and not child.names:
+                key, child = next(iter(child.children.items()))
+                keys.append(key)
+            children.append(
+                (
+                    keys[0],
+                    tuple(keys[1:]),
+                    [self.names[index] for index in child.names],
+                    child.names_below,
+                    self._walker(child),
+                )
+            )
+
+        def walk(value: Any, values: Dict[str, Any]):
+            for key, chain, found, names_below, walk_child in children:
+                try:
+                    child = value[key]
+                    for key in chain:
+                        child = child[key]
+                except (IndexError, TypeError, KeyError):
+                    # Every path under the child misses along with it
+                    for index in names_below:
+                        misses[index] += 1
+                    continue
+                for name in found:
+                    values[name] = child
+                if walk_child is not None:
+                    walk_child(child, values)
+
+        return walk
+
+    def lookups(self) -> List[int]:
+        """How many times every path was resolved"""
+        lookups = list(self._added_lookups)
+        for calls, indexes in zip(self._calls, self._resolved):
+            for index in indexes:
+                lookups[index] += calls[0]
+        return lookups
+
+    def stats(self) -> Dict[str, Dict]:
+        """Lookups and misses of every path"""
+        return {
+            name: {
+                "lookups": lookups,
+                "misses": misses,
+                "miss_rate": round(misses / lookups, 4) if lookups else None,
+            }
+            for name, lookups, misses in zip(self.names, self.lookups(), self.misses)
+        }
+
+    def miss_rates(self, min_rate: float = 0.0) -> Dict[str, float]:
+        """Miss rate of the paths missing at least `min_rate` of the time,
+        the most missed first"""
+        rates = [
+            (name, stats["miss_rate"])
+            for name, stats in self.stats().items()
+            if stats["miss_rate"] and stats["miss_rate"] >= min_rate
+        ]
+        return dict(sorted(rates, key=lambda rate: rate[1], reverse=True))
+
+    def take_counts(self) -> Tuple[List[int], List[int]]:
+        """Lookups and misses of every path since the last call, to hand
+        them to the tree of another process with add_counts"""
+        counts = self.lookups(), list(self.misses)
+        self.reset_stats()
+        return counts
+
+    def add_counts(self, lookups: List[int], misses: List[int]):
+        for index, (looked_up, missed) in enumerate(zip(lookups, misses)):
+            self._added_lookups[index] += looked_up
+            self.misses[index] += missed
+
+    def reset_stats(self):
+        # Reset in place, the compiled resolvers hold on to these lists
+        for calls in self._calls:
+            calls[0] = 0
+        self._added_lookups[:] = [0] * len(self.names)
+        self.misses[:] = [0] * len(self.names)
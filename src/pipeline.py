@@ -0,0 +1,162 @@
+import queue
+import threading
+import traceback
+from typing import Any, Callable, Dict, List, Optional
+
+default_workers = 1
+default_queue_size = 8
+default_stats_interval = 60
+
+# Tells a worker that no more items will come
+_closed = object()
+
+
+class Stage:
+    """
+    Step of a Pipeline: `workers` threads take items from a queue of at most
+    `queue_size` items and call `process(item, emit)`, `emit` handing an
+    item to the next stage. Emitting blocks while the next queue is full,
+    so a slow stage holds back the ones before it instead of piling up
+    their output.
+
+    An item whose processing raises is dropped, and `on_failure(item,
+    error)` is called with it.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        process: Callable[[Any, Callable[[Any], None]], None],
+        workers: int = default_workers,
+        queue_size: int = default_queue_size,
+        on_failure: Optional[Callable[[Any, Exception], None]] = None,
+    ):
+        self.name = name
+        self.process = process
+        self.workers = workers
+        self.queue: queue.Queue = queue.Queue(queue_size)
+        self.on_failure = on_failure
+        self._lock = threading.Lock()
+        self._counts = {"busy": 0, "done": 0, "failed": 0, "peak_queued": 0}
+        self._running = workers
+        self._threads: List[threading.Thread] = []
+
+    def put(self, item: Any):
+        self.queue.put(item)
+        with self._lock:
+            self._counts["peak_queued"] = max(
+                self._counts["peak_queued"], self.queue.qsize()
+            )
+
+    def start(self, emit: Callable[[Any], None], on_stopped: Callable[[], None]):
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self._work,
+                args=(emit, on_stopped),
+                name=f"{self.name}-{index}",
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        for _ in range(self.workers):
+            self.queue.put(_closed)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self, emit, on_stopped):
+        while True:
+            item = self.queue.get()
+            if item is _closed:
+                break
+            self._count("busy", 1)
+            try:
+                self.process(item, emit)
+                self._count("done", 1)
+            except Exception as error:
+                traceback.print_exc()
+                self._count("failed", 1)
+                if self.on_failure is not None:
+                    self.on_failure(item, error)
+            finally:
+                self._count("busy", -1)
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        # The next stage closes once every worker of this one stopped
+        if last:
+            on_stopped()
+
+    def _count(self, name: str, value: int):
+        with self._lock:
+            self._counts[name] += value
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queued": self.queue.qsize(),
+                "queue_size": self.queue.maxsize,
+                **self._counts,
+            }
+
+
+class Pipeline:
+    """
+    Stages connected by bounded queues, each item going through them in
+    order while the stages work concurrently on different items.
+
+    put() feeds the first stage and close() waits for every item to go
+    through. The queue depth and counts of every stage are printed every
+    `stats_interval` seconds, and returned by stats().
+    """
+
+    def __init__(
+        self, stages: List[Stage], stats_interval: float = default_stats_interval
+    ):
+        self.stages = stages
+        self.stats_interval = stats_interval
+        self._stopped = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def start(self):
+        for index, stage in enumerate(self.stages):
+            if index + 1 < len(self.stages):
+                next_stage = self.stages[index + 1]
+                stage.start(next_stage.put, next_stage.close)
+            else:
+                stage.start(self._drop, lambda: None)
+        threading.Thread(target=self._log_stats_periodically, daemon=True).start()
+
+    def _drop(self, item: Any):
+        raise RuntimeError(f"Last stage {self.stages[-1].name} can't emit items")
+
+    def put(self, item: Any):
+        """Hands an item to the first stage, waiting while its queue is full"""
+        self.stages[0].put(item)
+
+    def close(self):
+        """Waits for every item put to go through every stage"""
+        self.stages[0].close()
+        for stage in self.stages:
+            stage.join()
+        self._stopped.set()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def log_stats(self):
+        print(f"Pipeline: {self.stats()}")
+
+    def _log_stats_periodically(self):
+        while not self._stopped.wait(self.stats_interval):
+            self.log_stats()
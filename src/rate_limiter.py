@@ -0,0 +1,260 @@
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+default_initial_rate = 5.0  # requests per second, same as the former 0.2s interval
+default_min_rate = 0.2
+default_max_rate = 20.0
+default_increase = 0.05  # added to the rate on every healthy response
+default_decrease_factor = 0.5  # rate is multiplied by it when throttled
+default_decrease_cooldown = 2.0  # one decrease per throttling episode
+default_max_retry_after = 300
+default_stats_interval = 60
+
+# Path of the sqlite file through which co-located processes share one budget
+rate_limiter_db_env = "RATE_LIMITER_DB"
+
+# Bodies Google serves instead of reviews when it wants a captcha solved
+throttle_markers = (b"/sorry/", b"unusual traffic", b"g-recaptcha", b"captcha-form")
+
+
+class ThrottledError(Exception):
+    """Raised for a successful response whose body is a captcha or empty"""
+
+
+def is_throttled(response) -> bool:
+    """Tells if a response means google is throttling us"""
+    if response.status_code == 429 or response.status_code >= 500:
+        return True
+    # Other client errors are about the request, not about the load
+    if response.status_code >= 400:
+        return False
+    content = response.content
+    if not content or not content.strip():
+        return True
+    head = content[:4096].lower()
+    return any(marker in head for marker in throttle_markers)
+
+
+def get_retry_after(response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    try:
+        return min(float(value), default_max_retry_after)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Hands out `rate` tokens per second, with bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self.tokens = self.capacity
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self._updated_at = now
+
+    def increase_rate(self, increase: float, max_rate: float):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = min(max_rate, self.rate + increase)
+
+    def decrease_rate(
+        self, factor: float, min_rate: float, cooldown: float
+    ) -> Optional[float]:
+        """Multiplies the rate by `factor`, unless it was already decreased
+        less than `cooldown` seconds ago. Returns the new rate, if any"""
+        with self._lock:
+            now = time.monotonic()
+            if now - self.last_decrease < cooldown:
+                return None
+            self.last_decrease = now
+            self._refill(now)
+            self.rate = max(min_rate, self.rate * factor)
+            return self.rate
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self) -> float:
+        """Takes a token, sleeping until it is available. Returns the time
+        waited"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # Tokens may go negative, which queues the callers up in order
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            wait = max(wait, self.paused_until - now)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class _HostState:
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.window_started_at = time.monotonic()
+        self.window_requests = 0
+        self.window_throttled = 0
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket per host whose rate follows AIMD: it grows a little with
+    every healthy response and is halved when google throttles (HTTP 429 or
+    5xx, empty or captcha pages, timeouts). A Retry-After header pauses the
+    host altogether.
+
+    Share a single limiter between every scraper of a process through
+    get_rate_limiter/set_rate_limiter. `bucket_factory(host, rate)` creates
+    the bucket of each host; buckets of shared_rate_limiter extend the
+    sharing to every process of the machine.
+    """
+
+    def __init__(
+        self,
+        initial_rate: float = default_initial_rate,
+        min_rate: float = default_min_rate,
+        max_rate: float = default_max_rate,
+        increase: float = default_increase,
+        decrease_factor: float = default_decrease_factor,
+        decrease_cooldown: float = default_decrease_cooldown,
+        stats_interval: float = default_stats_interval,
+        bucket_factory: Optional[Callable[[str, float], TokenBucket]] = None,
+    ):
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self.stats_interval = stats_interval
+        self.bucket_factory = bucket_factory or (lambda host, rate: TokenBucket(rate))
+        # Effective rate samples, one per host and stats_interval
+        self.history: List[Dict] = []
+        self._hosts: Dict[str, _HostState] = {}
+        self._lock = threading.Lock()
+
+    def _host(self, host: str) -> _HostState:
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None:
+                state = _HostState(self.bucket_factory(host, self.initial_rate))
+                self._hosts[host] = state
+            return state
+
+    def acquire(self, host: str) -> float:
+        state = self._host(host)
+        waited = state.bucket.acquire()
+        with self._lock:
+            state.requests += 1
+            state.window_requests += 1
+            self._sample(host, state)
+        return waited
+
+    def on_response(self, host: str, response) -> bool:
+        """Adjusts the host rate to a response. Returns True when it was a
+        throttling response. Client errors other than 429 leave the rate
+        as it is"""
+        state = self._host(host)
+        if not is_throttled(response):
+            if response.status_code < 400:
+                self._increase(state)
+            return False
+
+        retry_after = get_retry_after(response)
+        if retry_after:
+            state.bucket.pause(retry_after)
+        self._decrease(host, state)
+        return True
+
+    def on_error(self, host: str):
+        """Timeouts and dropped connections count as throttling"""
+        state = self._host(host)
+        with self._lock:
+            state.errors += 1
+        self._decrease(host, state)
+
+    def _increase(self, state: _HostState):
+        state.bucket.increase_rate(self.increase, self.max_rate)
+
+    def _decrease(self, host: str, state: _HostState):
+        with self._lock:
+            state.throttled += 1
+            state.window_throttled += 1
+        # Responses of the same episode arrive together, decrease once
+        rate = state.bucket.decrease_rate(
+            self.decrease_factor, self.min_rate, self.decrease_cooldown
+        )
+        if rate is not None:
+            print(f"Throttled by {host}, slowing down to {rate:.2f} requests/s")
+
+    def _sample(self, host: str, state: _HostState):
+        now = time.monotonic()
+        elapsed = now - state.window_started_at
+        if elapsed < self.stats_interval:
+            return
+        sample = {
+            "time": str(datetime.now()),
+            "host": host,
+            "rate": round(state.bucket.rate, 3),
+            "effective_rate": round(state.window_requests / elapsed, 3),
+            "throttled": state.window_throttled,
+        }
+        self.history.append(sample)
+        print(f"Rate limiter: {sample}")
+        state.window_started_at = now
+        state.window_requests = 0
+        state.window_throttled = 0
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {
+                host: {
+                    "rate": round(state.bucket.rate, 3),
+                    "requests": state.requests,
+                    "throttled": state.throttled,
+                    "errors": state.errors,
+                }
+                for host, state in self._hosts.items()
+            }
+
+
+_rate_limiter: Optional[AdaptiveRateLimiter] = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> AdaptiveRateLimiter:
+    """Returns the process wide rate limiter, creating it on first use"""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            path = os.getenv(rate_limiter_db_env)
+            if path:
+                from .shared_rate_limiter import create_shared_rate_limiter
+
+                _rate_limiter = create_shared_rate_limiter(path)
+            else:
+                _rate_limiter = AdaptiveRateLimiter()
+        return _rate_limiter
+
+
+def set_rate_limiter(rate_limiter: AdaptiveRateLimiter):
+    """Replaces the process wide rate limiter"""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        _rate_limiter = rate_limiter
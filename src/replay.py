@@ -0,0 +1,233 @@
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, Optional, Tuple
+from urllib.parse import urlsplit
+
+default_port = 8765
+default_content_type = "text/html; charset=UTF-8"
+
+# Directory where real google responses are recorded. Nothing is recorded
+# when it is not set
+record_dir_env = "GOOGLE_RECORD_DIR"
+
+_record_lock = threading.Lock()
+
+
+def fixture_key(url: str) -> str:
+    """Key of a response in the corpus. Only the path and query count, so
+    the corpus is served the same under any base url"""
+    parts = urlsplit(url)
+    return md5(f"{parts.path}?{parts.query}".encode("utf-8")).hexdigest()
+
+
+def record_response(url: str, response):
+    """Saves a response to the corpus, when recording is on"""
+    directory = os.getenv(record_dir_env)
+    if not directory:
+        return
+    key = fixture_key(url)
+    meta = {
+        "url": url,
+        "status": response.status_code,
+        "content_type": response.headers.get("Content-Type", default_content_type),
+        "recorded_at": time.time(),
+    }
+    with _record_lock:
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{key}.body"), "wb") as file:
+            file.write(response.content)
+        with open(os.path.join(directory, f"{key}.json"), "w") as file:
+            json.dump(meta, file)
+
+
+class Corpus:
+    """Recorded responses, read from disk on first use"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._cache: Dict[str, Tuple[Dict, bytes]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> Optional[Tuple[Dict, bytes]]:
+        key = fixture_key(url)
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+        path = os.path.join(self.directory, key)
+        if not os.path.exists(f"{path}.json"):
+            return None
+        with open(f"{path}.json") as file:
+            meta = json.load(file)
+        with open(f"{path}.body", "rb") as file:
+            body = file.read()
+        with self._lock:
+            self._cache[key] = (meta, body)
+        return meta, body
+
+    def entries(self) -> Iterator[Tuple[Dict, bytes]]:
+        """Every recorded response, in no particular order"""
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(".json"):
+                with open(os.path.join(self.directory, name)) as file:
+                    meta = json.load(file)
+                yield self.get(meta["url"])
+
+    def __len__(self):
+        return sum(1 for name in os.listdir(self.directory) if name.endswith(".json"))
+
+
+class Latency:
+    """
+    Delay of a stand-in response: `latency` seconds plus up to `jitter`
+    seconds. With `tail_ratio`, that share of the responses is `tail_factor`
+    times slower, like the tail of google's latencies.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        tail_ratio: float = 0.0,
+        tail_factor: float = 10.0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.tail_ratio = tail_ratio
+        self.tail_factor = tail_factor
+
+    def sample(self) -> float:
+        delay = self.latency + random.uniform(0, self.jitter)
+        if self.tail_ratio and random.random() < self.tail_ratio:
+            delay *= self.tail_factor
+        return delay
+
+    @staticmethod
+    def add_arguments(parser: argparse.ArgumentParser):
+        parser.add_argument("--latency", type=float, default=0.0, help="Seconds")
+        parser.add_argument("--jitter", type=float, default=0.0, help="Seconds")
+        parser.add_argument("--tail-ratio", type=float, default=0.0)
+        parser.add_argument("--tail-factor", type=float, default=10.0)
+
+    @classmethod
+    def from_arguments(cls, args) -> "Latency":
+        return cls(args.latency, args.jitter, args.tail_ratio, args.tail_factor)
+
+
+class StandInServer(ThreadingHTTPServer):
+    """HTTP server answering in place of google, in its own threads"""
+
+    daemon_threads = True
+
+    def __init__(self, handler, host: str, port: int, latency: Latency):
+        super().__init__((host, port), handler)
+        self.latency = latency
+        self._stats_lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name: str, value: int = 1):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def handle_error(self, request, client_address):
+        # Clients reading place pages as a stream hang up mid body
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+    def start(self) -> threading.Thread:
+        """Serves in a background thread, e.g. from a benchmark"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_body(
+        self,
+        status: int,
+        content_type: str,
+        body: bytes,
+        headers: Optional[Dict[str, str]] = None,
+    ):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ReplayHandler(StandInHandler):
+    server: "ReplayServer"
+
+    def do_GET(self):
+        time.sleep(self.server.latency.sample())
+        found = self.server.corpus.get(self.path)
+        if found is None:
+            self.server.count("missing")
+            self.send_body(404, default_content_type, b"Not recorded")
+            return
+        meta, body = found
+        self.server.count("served")
+        self.send_body(meta["status"], meta["content_type"], body)
+
+
+class ReplayServer(StandInServer):
+    """Serves a recorded corpus in place of google"""
+
+    def __init__(
+        self,
+        corpus: Corpus,
+        host: str = "127.0.0.1",
+        port: int = default_port,
+        latency: Optional[Latency] = None,
+    ):
+        super().__init__(ReplayHandler, host, port, latency or Latency())
+        self.corpus = corpus
+        self.served = 0
+        self.missing = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve recorded google responses in place of google"
+    )
+    parser.add_argument("corpus", help="Directory recorded with GOOGLE_RECORD_DIR")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=default_port)
+    Latency.add_arguments(parser)
+    args = parser.parse_args()
+
+    corpus = Corpus(args.corpus)
+    server = ReplayServer(
+        corpus, args.host, args.port, Latency.from_arguments(args)
+    )
+    print(f"Replaying {len(corpus)} responses on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Served {server.served}, not recorded {server.missing}")
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Optional, Tuple
+
+import requests
+
+default_ttl = 7 * 24 * 60 * 60
+default_max_bytes = 1024**3
+default_compression_level = 6
+default_busy_timeout = 30
+# Eviction frees a bit more than needed, so it doesn't run on every put
+default_evict_to = 0.9
+# Puts keep a running total of the cache size, read again from the file every
+# that many puts to count the pages other processes stored
+default_size_refresh_puts = 1000
+
+# Path of the sqlite file caching reviewSort pages. Pages are not cached
+# when it is not set
+response_cache_db_env = "RESPONSE_CACHE_DB"
+response_cache_ttl_env = "RESPONSE_CACHE_TTL"
+response_cache_max_bytes_env = "RESPONSE_CACHE_MAX_BYTES"
+
+
+def page_cache_key(feature_id: str, hl: str, sort_by_id: str, token: str) -> str:
+    return f"{feature_id}|{hl}|{sort_by_id}|{token}"
+
+
+def cached_response(url: str, content: bytes, encoding: Optional[str]):
+    """Rebuilds a response out of a cached body"""
+    response = requests.models.Response()
+    response.status_code = 200
+    response.url = url
+    response.encoding = encoding
+    response._content = content
+    return response
+
+
+class ResponseCache:
+    """
+    Compressed reviewSort pages, in a local sqlite file, so re-runs and
+    reprocessing after a parser fix don't go to the network.
+
+    Pages expire after `ttl` seconds. Once the bodies take more than
+    `max_bytes`, the least recently used pages are evicted. Their size is
+    kept as a running total, so puts don't add up every page.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = default_ttl,
+        max_bytes: int = default_max_bytes,
+        compression_level: int = default_compression_level,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.compression_level = compression_level
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.bytes_saved = 0  # network bytes the hits spared
+        self.bytes_written = 0  # compressed bytes stored
+        self._size: Optional[int] = None  # of the bodies, None until read
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        db = self._connection()
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                " key TEXT PRIMARY KEY,"
+                " body BLOB NOT NULL,"
+                " encoding TEXT,"
+                " size INTEGER NOT NULL,"
+                " raw_size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " used_at REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS pages_used_at ON pages (used_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=default_busy_timeout)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def get(self, key: str) -> Optional[Tuple[bytes, Optional[str]]]:
+        """Returns the body and encoding of a cached page, if fresh"""
+        db = self._connection()
+        row = db.execute(
+            "SELECT body, encoding, raw_size, created_at FROM pages WHERE key = ?",
+            (key,),
+        ).fetchone()
+        now = time.time()
+        if row is not None and now - row[3] > self.ttl:
+            with db:
+                db.execute("DELETE FROM pages WHERE key = ?", (key,))
+            self._count("expired")
+            row = None
+        if row is None:
+            self._count("misses")
+            return None
+
+        body, encoding, raw_size, _ = row
+        with db:
+            db.execute("UPDATE pages SET used_at = ? WHERE key = ?", (now, key))
+        self._count("hits")
+        self._count("bytes_saved", raw_size)
+        return zlib.decompress(body), encoding
+
+    def put(self, key: str, content: bytes, encoding: Optional[str]):
+        body = zlib.compress(content, self.compression_level)
+        now = time.time()
+        db = self._connection()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, body, encoding, len(body), len(content), now, now),
+            )
+        self._count("bytes_written", len(body))
+        with self._lock:
+            self._puts += 1
+            if self._size is not None:
+                # Replaced pages are counted twice, which only evicts sooner
+                self._size += len(body)
+            evict = (
+                self._size is None
+                or self._size > self.max_bytes
+                or self._puts % default_size_refresh_puts == 0
+            )
+        if evict:
+            self._evict()
+
+    def _evict(self):
+        """Reads the size of the pages, and evicts the least recently used
+        ones when it is past max_bytes"""
+        db = self._connection()
+        evicted = 0
+        with db:
+            size = db.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+            if size > self.max_bytes:
+                target = self.max_bytes * default_evict_to
+                for key, page_size in db.execute(
+                    "SELECT key, size FROM pages ORDER BY used_at"
+                ).fetchall():
+                    if size <= target:
+                        break
+                    db.execute("DELETE FROM pages WHERE key = ?", (key,))
+                    size -= page_size
+                    evicted += 1
+        with self._lock:
+            self._size = size
+        self._count("evictions", evicted)
+
+    def stats(self) -> Dict:
+        entries, size = (
+            self._connection()
+            .execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages")
+            .fetchone()
+        )
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "bytes_saved": self.bytes_saved,
+                "bytes_written": self.bytes_written,
+                "entries": entries,
+                "size": size,
+            }
+
+
+_response_cache: Optional[ResponseCache] = None
+_response_cache_created = False
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Returns the process wide page cache, or None when pages aren't
+    cached"""
+    global _response_cache, _response_cache_created
+    with _response_cache_lock:
+        if not _response_cache_created:
+            path = os.getenv(response_cache_db_env)
+            if path:
+                _response_cache = ResponseCache(
+                    path,
+                    ttl=float(os.getenv(response_cache_ttl_env, default_ttl)),
+                    max_bytes=int(
+                        os.getenv(response_cache_max_bytes_env, default_max_bytes)
+                    ),
+                )
+            _response_cache_created = True
+        return _response_cache
+
+
+def set_response_cache(response_cache: Optional[ResponseCache]):
+    """Replaces the process wide page cache, None turning caching off"""
+    global _response_cache, _response_cache_created
+    with _response_cache_lock:
+        _response_cache = response_cache
+        _response_cache_created = True
@@ -0,0 +1,351 @@
+import argparse
+import importlib
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from functools import wraps
+from hashlib import md5
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from botasaurus.cache import is_dont_cache
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Raised by entries that can't be read back: written with zstd where
+# zstandard is missing, or truncated
+decode_errors: Tuple = (ValueError, zlib.error)
+if zstandard is not None:
+    decode_errors += (zstandard.ZstdError,)
+
+default_cache_path = "cache/results.db"
+default_max_bytes = 2 * 1024**3
+default_busy_timeout = 30
+default_zstd_level = 10
+default_zlib_level = 6
+# Eviction frees a bit more than needed, so it doesn't run on every put
+default_evict_to = 0.9
+# Puts keep a running total of the cache size, read again from the file every
+# that many puts to count the results other processes stored
+default_size_refresh_puts = 1000
+
+result_cache_db_env = "RESULT_CACHE_DB"
+result_cache_max_bytes_env = "RESULT_CACHE_MAX_BYTES"
+
+
+def source_version(*module_names: str) -> str:
+    """Hash of the source of the modules, so results cached by another
+    version of the parsing code are not used"""
+    digest = md5()
+    for module_name in module_names:
+        module = importlib.import_module(module_name)
+        digest.update(inspect.getsource(module).encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+
+def compress(data: bytes) -> Tuple[str, bytes]:
+    if zstandard is not None:
+        compressor = zstandard.ZstdCompressor(level=default_zstd_level)
+        return "zstd", compressor.compress(data)
+    return "zlib", zlib.compress(data, default_zlib_level)
+
+
+def decompress(codec: str, body: bytes) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise ValueError("Entry is zstd compressed but zstandard is missing")
+        return zstandard.ZstdDecompressor().decompress(body)
+    return zlib.decompress(body)
+
+
+class ResultCache:
+    """
+    Cache of the results of the scraping functions, in one sqlite file.
+
+    Entries are compressed JSON, zstd when zstandard is installed and zlib
+    otherwise. Each one expires after the ttl of its function, and once the
+    cache takes more than `max_bytes` the least recently used entries are
+    evicted, its size being kept as a running total so puts don't add up
+    every entry. Keys include the version of the code that produced the
+    result.
+    """
+
+    def __init__(
+        self,
+        path: str = default_cache_path,
+        max_bytes: int = default_max_bytes,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+        self._size: Optional[int] = None  # of the bodies, None until read
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = self._connection()
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " key TEXT PRIMARY KEY,"
+                " function TEXT NOT NULL,"
+                " version TEXT NOT NULL,"
+                " codec TEXT NOT NULL,"
+                " body BLOB NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " raw_size INTEGER NOT NULL,"
+                " expires_at REAL,"
+                " used_at REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS results_used_at ON results (used_at)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=default_busy_timeout)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    def key(self, function: str, version: str, data: Any) -> str:
+        serialized = json.dumps([function, version, data], sort_keys=True)
+        return md5(serialized.encode("utf-8")).hexdigest()
+
+    def _count(self, counter: Dict[str, int], function: str):
+        with self._lock:
+            counter[function] = counter.get(function, 0) + 1
+
+    def get(self, function: str, key: str) -> Optional[Any]:
+        """Returns the cached result, or None when missing, expired or
+        unreadable"""
+        db = self._connection()
+        row = db.execute(
+            "SELECT codec, body, expires_at FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        now = time.time()
+        if row is not None and row[2] is not None and row[2] < now:
+            self._delete(key)
+            row = None
+        result = None
+        if row is not None:
+            codec, body, _ = row
+            try:
+                result = json.loads(decompress(codec, body))
+            except decode_errors:
+                # Scraped again and overwritten
+                self._delete(key)
+                row = None
+        if row is None:
+            self._count(self.misses, function)
+            return None
+
+        with db:
+            db.execute("UPDATE results SET used_at = ? WHERE key = ?", (now, key))
+        self._count(self.hits, function)
+        return result
+
+    def _delete(self, key: str):
+        db = self._connection()
+        with db:
+            db.execute("DELETE FROM results WHERE key = ?", (key,))
+
+    def put(
+        self,
+        function: str,
+        version: str,
+        key: str,
+        result: Any,
+        ttl: Optional[float] = None,
+    ):
+        raw = json.dumps(result).encode("utf-8")
+        codec, body = compress(raw)
+        now = time.time()
+        db = self._connection()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    function,
+                    version,
+                    codec,
+                    body,
+                    len(body),
+                    len(raw),
+                    now + ttl if ttl is not None else None,
+                    now,
+                ),
+            )
+        with self._lock:
+            self._puts += 1
+            if self._size is not None:
+                # Replaced results are counted twice, which only evicts sooner
+                self._size += len(body)
+            evict = (
+                self._size is None
+                or self._size > self.max_bytes
+                or self._puts % default_size_refresh_puts == 0
+            )
+        if evict:
+            self._evict()
+
+    def _evict(self):
+        """Reads the size of the results, and evicts the expired then the
+        least recently used ones when it is past max_bytes"""
+        db = self._connection()
+        with db:
+            size = db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM results"
+            ).fetchone()[0]
+            if size > self.max_bytes:
+                # Expired entries go first, then the least recently used ones
+                db.execute(
+                    "DELETE FROM results WHERE expires_at < ?", (time.time(),)
+                )
+                size = db.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM results"
+                ).fetchone()[0]
+                target = self.max_bytes * default_evict_to
+                for key, entry_size in db.execute(
+                    "SELECT key, size FROM results ORDER BY used_at"
+                ).fetchall():
+                    if size <= target:
+                        break
+                    db.execute("DELETE FROM results WHERE key = ?", (key,))
+                    size -= entry_size
+        with self._lock:
+            self._size = size
+
+    def clear(self, function: Optional[str] = None):
+        db = self._connection()
+        with db:
+            if function is None:
+                db.execute("DELETE FROM results")
+            else:
+                db.execute("DELETE FROM results WHERE function = ?", (function,))
+        db.execute("VACUUM")
+        with self._lock:
+            self._size = None
+
+    def stats(self) -> Dict[str, Dict]:
+        """Entries, sizes and hit counts of every function"""
+        rows = self._connection().execute(
+            "SELECT function, COUNT(*), SUM(size), SUM(raw_size),"
+            " COUNT(DISTINCT version), SUM(expires_at < ?)"
+            " FROM results GROUP BY function",
+            (time.time(),),
+        ).fetchall()
+        with self._lock:
+            return {
+                function: {
+                    "entries": entries,
+                    "size": size,
+                    "uncompressed_size": raw_size,
+                    "versions": versions,
+                    "expired": expired,
+                    "hits": self.hits.get(function, 0),
+                    "misses": self.misses.get(function, 0),
+                }
+                for function, entries, size, raw_size, versions, expired in rows
+            }
+
+
+_result_cache: Optional[ResultCache] = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> ResultCache:
+    """Returns the process wide result cache, creating it on first use"""
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache(
+                os.getenv(result_cache_db_env, default_cache_path),
+                int(os.getenv(result_cache_max_bytes_env, default_max_bytes)),
+            )
+        return _result_cache
+
+
+def set_result_cache(result_cache: ResultCache):
+    """Replaces the process wide result cache"""
+    global _result_cache
+    with _result_cache_lock:
+        _result_cache = result_cache
+
+
+def cached(ttl: Optional[float] = None, depends_on: Sequence[str] = ()):
+    """
+    Caches the results of a botasaurus scraping function in the result
+    cache, when it is called with metadata={"cache": True}. Results wrapped
+    in DontCache are not cached. Functions taking a third parameter get the
+    metadata, whose other entries are then part of the key.
+
+    :param ttl: Seconds a result is kept, forever when None.
+    :param depends_on: Names of the modules whose code shapes the result.
+    Changing any of them, or the module of the function, invalidates its
+    entries.
+    """
+
+    def decorator(func):
+        version = source_version(func.__module__, *depends_on)
+        function = func.__name__
+        takes_metadata = len(inspect.signature(func).parameters) > 2
+
+        def call(driver, data, metadata):
+            if takes_metadata:
+                return func(driver, data, metadata)
+            return func(driver, data)
+
+        @wraps(func)
+        def wrapper(driver, data, metadata=None):
+            if not (metadata and metadata.get("cache")):
+                return call(driver, data, metadata)
+
+            result_cache = get_result_cache()
+            options = {
+                name: value for name, value in metadata.items() if name != "cache"
+            }
+            if takes_metadata and options:
+                key = result_cache.key(function, version, [data, options])
+            else:
+                key = result_cache.key(function, version, data)
+            result = result_cache.get(function, key)
+            if result is not None:
+                return result
+
+            result = call(driver, data, metadata)
+            if result is not None and not is_dont_cache(result):
+                result_cache.put(function, version, key, result, ttl)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect the result cache")
+    parser.add_argument("command", choices=["stats", "clear"])
+    parser.add_argument("--function", help="Only clear this function")
+    args = parser.parse_args()
+
+    result_cache = get_result_cache()
+    if args.command == "clear":
+        result_cache.clear(args.function)
+    print(json.dumps(result_cache.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+import random
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set
+
+from .rate_limiter import ThrottledError
+from .transport import network_errors
+
+default_base_delay = 1
+default_place_failure_threshold = 3
+default_place_reset_timeout = 30 * 60
+default_outage_failure_threshold = 5
+default_outage_pause = 30
+default_max_outage_pause = 10 * 60
+# Failed place pages are retried later rather than by a sleeping worker
+default_retry_max_attempts = 5
+default_retry_base_delay = 10
+default_retry_max_delay = 2 * 60
+
+
+class PlaceCircuitOpenError(Exception):
+    """Raised instead of scraping a place that keeps failing"""
+
+
+def backoff_delay(
+    attempt: int, max_delay: float, base_delay: float = default_base_delay
+) -> float:
+    """Exponential backoff with full jitter, so failing workers don't retry
+    in lockstep"""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+def is_outage_error(error: Exception) -> bool:
+    """Tells failures of google (throttling, 5xx, network) apart from
+    failures of a single place (4xx, unexpected page)"""
+    if isinstance(error, (ThrottledError, *network_errors)):
+        return True
+    response = getattr(error, "response", None)
+    status_code = getattr(response, "status_code", None)
+    return status_code is not None and (status_code == 429 or status_code >= 500)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and stays open for
+    `reset_timeout` seconds. After that a failure opens it again right away,
+    for twice as long (up to `max_reset_timeout`), while a success closes it.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int,
+        reset_timeout: float,
+        max_reset_timeout: Optional[float] = None,
+    ):
+        self.failure_threshold = failure_threshold
+        self.initial_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout or reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.reset_timeout = self.initial_reset_timeout
+
+    def record_failure(self, force: bool = False) -> bool:
+        """Counts a failure, `force` opening the breaker at once. Returns
+        True when the breaker opens"""
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None:
+                if time.monotonic() < self.opened_at + self.reset_timeout:
+                    # Already open, e.g. requests that were in flight
+                    return False
+                # Failed again after the pause, back off for longer
+                self.reset_timeout = min(
+                    self.reset_timeout * 2, self.max_reset_timeout
+                )
+            elif not force and self.failures < self.failure_threshold:
+                return False
+            self.opened_at = time.monotonic()
+            return True
+
+    def remaining(self) -> float:
+        """Seconds until the breaker lets requests through again"""
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    @property
+    def is_open(self) -> bool:
+        return self.remaining() > 0
+
+
+class RetryPolicy:
+    """
+    Circuit breakers shared by every review scraper of the process.
+
+    Outage failures (throttling, 5xx, network) feed one global breaker:
+    when it opens, every worker pauses instead of each one sleeping on its
+    own. Other failures feed a breaker per feature_id, which gives up on a
+    broken place after a few attempts and skips it for a while.
+    """
+
+    def __init__(
+        self,
+        place_failure_threshold: int = default_place_failure_threshold,
+        place_reset_timeout: float = default_place_reset_timeout,
+        outage_failure_threshold: int = default_outage_failure_threshold,
+        outage_pause: float = default_outage_pause,
+        max_outage_pause: float = default_max_outage_pause,
+    ):
+        self.place_failure_threshold = place_failure_threshold
+        self.place_reset_timeout = place_reset_timeout
+        self.outage_breaker = CircuitBreaker(
+            outage_failure_threshold, outage_pause, max_outage_pause
+        )
+        self._place_breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def _place_breaker(self, feature_id: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._place_breakers.get(feature_id)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    self.place_failure_threshold, self.place_reset_timeout
+                )
+                self._place_breakers[feature_id] = breaker
+            return breaker
+
+    def outage_delay(self) -> float:
+        """Seconds every worker has to wait before its next request"""
+        return self.outage_breaker.remaining()
+
+    def is_place_open(self, feature_id: str) -> bool:
+        return self._place_breaker(feature_id).is_open
+
+    def check_place(self, feature_id: str):
+        if self.is_place_open(feature_id):
+            raise PlaceCircuitOpenError(
+                f"Skipping {feature_id}, it failed too many times recently"
+            )
+
+    def record_success(self, feature_id: str):
+        self.outage_breaker.record_success()
+        self._place_breaker(feature_id).record_success()
+
+    def record_failure(self, feature_id: str, error: Exception):
+        if is_outage_error(error):
+            if self.outage_breaker.record_failure():
+                print(
+                    "Google seems to be down or throttling, pausing all workers "
+                    f"for {self.outage_breaker.reset_timeout}s"
+                )
+            return
+
+        response = getattr(error, "response", None)
+        # A 4xx other than 429 will not go away by asking again
+        permanent = getattr(response, "status_code", None) is not None
+        if self._place_breaker(feature_id).record_failure(force=permanent):
+            print(f"Giving up on {feature_id} for now")
+
+
+_retry_policy: Optional[RetryPolicy] = None
+_retry_policy_lock = threading.Lock()
+
+
+def get_retry_policy() -> RetryPolicy:
+    """Returns the process wide retry policy, creating it on first use"""
+    global _retry_policy
+    with _retry_policy_lock:
+        if _retry_policy is None:
+            _retry_policy = RetryPolicy()
+        return _retry_policy
+
+
+def set_retry_policy(retry_policy: RetryPolicy):
+    """Replaces the process wide retry policy"""
+    global _retry_policy
+    with _retry_policy_lock:
+        _retry_policy = retry_policy
+
+
+class RetryQueue:
+    """
+    Delay queue of the links whose scraping failed. Instead of a worker
+    sleeping on a failed link, the link is scheduled here with its own
+    backoff and the worker moves on; callers scrape the links again once
+    their retry is due.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = default_retry_max_attempts,
+        base_delay: float = default_retry_base_delay,
+        max_delay: float = default_retry_max_delay,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._attempts: Dict[str, int] = {}
+        self._due: Dict[str, float] = {}
+        self._given_up: Set[str] = set()
+        self._condition = threading.Condition()
+
+    def schedule(self, key: str) -> Optional[float]:
+        """Schedules a retry of `key`. Returns the delay, or None once
+        `key` has used up its attempts"""
+        with self._condition:
+            attempt = self._attempts.get(key, 0) + 1
+            if attempt > self.max_attempts:
+                self._attempts.pop(key, None)
+                self._given_up.add(key)
+                return None
+            self._attempts[key] = attempt
+            delay = backoff_delay(attempt, self.max_delay, self.base_delay)
+            self._due[key] = time.monotonic() + delay
+            self._condition.notify_all()
+            return delay
+
+    def record_success(self, key: str):
+        with self._condition:
+            self._attempts.pop(key, None)
+            self._due.pop(key, None)
+            self._given_up.discard(key)
+
+    def pop_given_up(self, keys: Iterable[str]) -> List[str]:
+        """Returns, and forgets, the keys among `keys` that ran out of
+        attempts"""
+        with self._condition:
+            given_up = [key for key in dict.fromkeys(keys) if key in self._given_up]
+            self._given_up.difference_update(given_up)
+            return given_up
+
+    def pop_due(self, keys: Iterable[str]) -> List[str]:
+        """Waits for the earliest retry among `keys` and returns every one of
+        them that is due, in the order of `keys`, or an empty list when none
+        is scheduled"""
+        keys = list(dict.fromkeys(keys))
+        with self._condition:
+            while True:
+                scheduled = {key: self._due[key] for key in keys if key in self._due}
+                if not scheduled:
+                    return []
+                now = time.monotonic()
+                due = [key for key, due_at in scheduled.items() if due_at <= now]
+                if due:
+                    for key in due:
+                        del self._due[key]
+                    return due
+                self._condition.wait(min(scheduled.values()) - now)
+
+
+_retry_queue: Optional[RetryQueue] = None
+
+
+def get_retry_queue() -> RetryQueue:
+    """Returns the process wide queue of failed links, creating it on first
+    use"""
+    global _retry_queue
+    with _retry_policy_lock:
+        if _retry_queue is None:
+            _retry_queue = RetryQueue()
+        return _retry_queue
+
+
+def set_retry_queue(retry_queue: RetryQueue):
+    """Replaces the process wide queue of failed links"""
+    global _retry_queue
+    with _retry_policy_lock:
+        _retry_queue = retry_queue
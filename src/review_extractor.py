@@ -0,0 +1,84 @@
+from typing import Iterator, Optional
+
+from lxml import etree, html
+
+
+def _has_class(name: str) -> str:
+    # Same as BeautifulSoup's class_="name" for a single class
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+def _class_is(value: str) -> str:
+    # Same as BeautifulSoup's class_="a b", which matches the whole attribute
+    return f"normalize-space(@class) = '{value}'"
+
+
+METADATA = etree.XPath("//*[@data-google-review-count]")
+REVIEWS = etree.XPath(f"//*[{_has_class('gws-localreviews__google-review')}]")
+
+FULL_TEXT = etree.XPath(f".//*[{_has_class('review-full-text')}]")
+EXPANDABLE_SECTION = etree.XPath(".//*[@data-expandable-section]")
+RATING = etree.XPath(f".//*[{_class_is('lTi8oc z3HNkc')}]")
+OTHER_RATINGS = etree.XPath(f".//*[{_has_class('k8MTF')}]")
+RELATIVE_DATE = etree.XPath(f".//*[{_class_is('dehysf lTi8oc')}]")
+USER_NAME = etree.XPath(f".//*[{_has_class('TSUbDb')}]")
+USER_NODE = etree.XPath(f".//*[{_has_class('Msppse')}]")
+LOCAL_GUIDE = etree.XPath(f".//*[{_has_class('QV3IV')}]")
+REVIEW_LINK = etree.XPath(f".//*[{_has_class('RvU3D')}]")
+LIKES = etree.XPath(".//*[@jsname='CMh1ye']")
+RESPONSE = etree.XPath(f".//*[{_has_class('d6SCIc')}]")
+RESPONSE_DATE = etree.XPath(f".//*[{_has_class('pi8uOe')}]")
+TRIP_TYPE = etree.XPath(f".//*[{_has_class('PV7e7')}]")
+
+TEXT_NODES = etree.XPath("descendant::text()")
+
+
+def parse_page(response_text: str) -> html.HtmlElement:
+    """Builds the one and only tree of a reviewSort page"""
+    return html.document_fromstring(response_text)
+
+
+def first(xpath: etree.XPath, node) -> Optional[html.HtmlElement]:
+    """First match of a compiled xpath, like BeautifulSoup's find"""
+    matches = xpath(node)
+    return matches[0] if matches else None
+
+
+def get_text(node) -> str:
+    """Same as BeautifulSoup's .text"""
+    return str(node.text_content())
+
+
+def stripped_strings(node) -> Iterator[str]:
+    """Same as BeautifulSoup's .stripped_strings"""
+    for text in TEXT_NODES(node):
+        text = text.strip()
+        if text:
+            yield text
+
+
+def contents(node) -> Iterator:
+    """Same as BeautifulSoup's .contents, text nodes being plain strings"""
+    if node.text:
+        yield node.text
+    for child in node:
+        yield child
+        if child.tail:
+            yield child.tail
+
+
+def is_tag_with_class(item) -> bool:
+    # Comments are elements in lxml, but their tag is not a string
+    return (
+        isinstance(item, etree._Element)
+        and isinstance(item.tag, str)
+        and item.get("class") is not None
+    )
+
+
+def join_stripped_strings(node) -> str:
+    return " ".join(stripped_strings(node))
+
+
+def to_markup(node) -> str:
+    return html.tostring(node, encoding="unicode")
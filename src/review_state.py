@@ -0,0 +1,236 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+default_state_path = "review_state.db"
+default_busy_timeout = 30
+# Ids kept per place, so the watermark survives a few deleted reviews
+default_max_review_ids = 50
+# Relative dates are coarse, only reviews clearly older than the watermark
+# count as known
+default_date_margin = timedelta(days=1)
+
+# Path of the sqlite file holding the watermark of every place
+review_state_db_env = "REVIEW_STATE_DB"
+
+
+def review_date(review: Dict) -> Optional[datetime]:
+    """Date derived from the relative date of a review, if any"""
+    text_date = review.get("text_date")
+    if isinstance(text_date, datetime):
+        return text_date
+    try:
+        return datetime.fromisoformat(text_date)
+    except (TypeError, ValueError):
+        return None
+
+
+class Watermark:
+    """Newest reviews of a place seen by the previous runs"""
+
+    def __init__(self, review_ids: Iterable[str], published: Optional[datetime]):
+        self.review_ids = list(review_ids)
+        self.published = published
+        self._known = set(self.review_ids)
+
+    def reached(self, review: Dict) -> bool:
+        """Tells if a review, in newest first order, is already known"""
+        if review.get("review_id") in self._known:
+            return True
+        # All the known ids may have been deleted, fall back to the dates
+        published = review_date(review)
+        return (
+            self.published is not None
+            and published is not None
+            and published < self.published - default_date_margin
+        )
+
+
+class ReviewStateStore:
+    """
+    Review state of every place, in a local sqlite file:
+
+    - its watermark, for incremental review scraping: a run with
+      sort_by="newest" stops paginating as soon as it reaches a review the
+      previous runs already stored.
+    - its review count and rating histogram at the last review scrape, so
+      places whose reviews did not move can be skipped altogether.
+    """
+
+    def __init__(
+        self,
+        path: str = default_state_path,
+        max_review_ids: int = default_max_review_ids,
+    ):
+        self.path = path
+        self.max_review_ids = max_review_ids
+        self._local = threading.local()
+        # Watermarks and snapshots waiting for commit_updates, by place
+        self._pending: Dict[str, Tuple[List[str], Optional[datetime]]] = {}
+        self._pending_snapshots: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        db = self._connection()
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS review_watermarks ("
+                " place_id TEXT PRIMARY KEY,"
+                " review_ids TEXT NOT NULL,"
+                " published TEXT,"
+                " updated_at REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS review_snapshots ("
+                " place_id TEXT PRIMARY KEY,"
+                " reviews INTEGER,"
+                " reviews_per_rating TEXT,"
+                " updated_at REAL NOT NULL)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=default_busy_timeout)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    def get(self, place_id: str) -> Optional[Watermark]:
+        row = self._connection().execute(
+            "SELECT review_ids, published FROM review_watermarks WHERE place_id = ?",
+            (place_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        review_ids, published = row
+        return Watermark(
+            json.loads(review_ids),
+            datetime.fromisoformat(published) if published else None,
+        )
+
+    def update(self, place_id: str, reviews: List[Dict]):
+        """Moves the watermark of a place to its newest reviews, `reviews`
+        being in newest first order"""
+        if reviews:
+            self._move(place_id, *self._newest(reviews))
+
+    def defer_update(self, place_id: str, reviews: List[Dict]):
+        """Same as update, but the watermark only moves on
+        commit_updates(), once the reviews are saved. A run that dies
+        before leaves it where it was, and the next run scrapes them again"""
+        if not reviews:
+            return
+        newest = self._newest(reviews)
+        with self._lock:
+            self._pending[place_id] = newest
+
+    def commit_updates(self):
+        """Moves the watermarks and saves the snapshots of every deferred
+        update"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            snapshots, self._pending_snapshots = self._pending_snapshots, {}
+        for place_id, (review_ids, published) in pending.items():
+            self._move(place_id, review_ids, published)
+        for place in snapshots.values():
+            self.save_snapshot(place)
+
+    def discard_updates(self):
+        """Forgets the deferred updates, as when their reviews weren't saved"""
+        with self._lock:
+            self._pending = {}
+            self._pending_snapshots = {}
+
+    def _newest(self, reviews: List[Dict]) -> Tuple[List[str], Optional[datetime]]:
+        review_ids = [review["review_id"] for review in reviews]
+        dates = [review_date(review) for review in reviews]
+        dates = [date for date in dates if date is not None]
+        return review_ids[: self.max_review_ids], max(dates) if dates else None
+
+    def _move(
+        self, place_id: str, review_ids: List[str], published: Optional[datetime]
+    ):
+        previous = self.get(place_id)
+        if previous is not None:
+            review_ids = review_ids + [
+                review_id
+                for review_id in previous.review_ids
+                if review_id not in review_ids
+            ]
+            if previous.published is not None and (
+                published is None or previous.published > published
+            ):
+                published = previous.published
+
+        db = self._connection()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO review_watermarks"
+                " (place_id, review_ids, published, updated_at) VALUES (?, ?, ?, ?)",
+                (
+                    place_id,
+                    json.dumps(review_ids[: self.max_review_ids]),
+                    published.isoformat() if published else None,
+                    time.time(),
+                ),
+            )
+
+    def _snapshot(self, place: Dict):
+        return (
+            place.get("reviews"),
+            json.dumps(place.get("reviews_per_rating"), sort_keys=True),
+        )
+
+    def is_unchanged(self, place: Dict) -> bool:
+        """Tells if the review count and rating histogram of a place are
+        the same as at its last review scrape"""
+        row = self._connection().execute(
+            "SELECT reviews, reviews_per_rating FROM review_snapshots"
+            " WHERE place_id = ?",
+            (place["place_id"],),
+        ).fetchone()
+        return row is not None and tuple(row) == self._snapshot(place)
+
+    def defer_snapshot(self, place: Dict):
+        """Same as save_snapshot, but the snapshot is only saved on
+        commit_updates(), once the reviews are saved"""
+        with self._lock:
+            self._pending_snapshots[place["place_id"]] = place
+
+    def save_snapshot(self, place: Dict):
+        """Remembers the review count and rating histogram of a place whose
+        reviews were just scraped"""
+        db = self._connection()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO review_snapshots"
+                " (place_id, reviews, reviews_per_rating, updated_at)"
+                " VALUES (?, ?, ?, ?)",
+                (place["place_id"], *self._snapshot(place), time.time()),
+            )
+
+
+_review_state: Optional[ReviewStateStore] = None
+_review_state_lock = threading.Lock()
+
+
+def get_review_state() -> ReviewStateStore:
+    """Returns the process wide state store, creating it on first use"""
+    global _review_state
+    with _review_state_lock:
+        if _review_state is None:
+            _review_state = ReviewStateStore(
+                os.getenv(review_state_db_env, default_state_path)
+            )
+        return _review_state
+
+
+def set_review_state(review_state: ReviewStateStore):
+    """Replaces the process wide state store"""
+    global _review_state
+    with _review_state_lock:
+        _review_state = review_state
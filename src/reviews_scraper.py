@@ -3,19 +3,45 @@ import re
 import time
 import traceback
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Any, Dict, List, Tuple
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
 
 import regex
-import requests
 from bs4 import BeautifulSoup, Tag
 from lxml import html
 
+from . import review_extractor as rx
+from .parse_pool import get_parse_pool
+from .rate_limiter import AdaptiveRateLimiter, ThrottledError, get_rate_limiter
+from .replay import record_response
+from .response_cache import cached_response, get_response_cache, page_cache_key
+from .retry_policy import (
+    PlaceCircuitOpenError,
+    RetryPolicy,
+    backoff_delay,
+    get_retry_policy,
+)
+from .review_state import Watermark
+from .run_journal import RunJournal, get_run_journal
 from .time_utils import parse_relative_date
+from .transport import Transport, get_google_base_url, get_transport
 
-default_request_interval = 0.2
+# Pacing is left to the rate limiter, which starts at 5 requests/s
+default_request_interval = 0
 default_n_retries = 10
-default_retry_time = 30
+default_retry_time = 30  # longest backoff between two attempts
+default_review_parser = "lxml"
+default_pipeline = True
+
+# Tag holding the pagination data, and its token, read from the raw bytes
+pagination_tag_regex = re.compile(rb'<[^>]*\bdata-google-review-count="(\d+)"[^>]*>')
+next_page_token_regex = re.compile(rb'\bdata-next-page-token="([^"&]*)"')
+# Review nodes, to tell a page with reviews from one they are missing from
+review_node_regex = re.compile(
+    rb"""class=["'][^"']*\bgws-localreviews__google-review\b"""
+)
 
 sort_by_enum = {
     "most_relevant": "qualityScore",  # the most relevant reviews
@@ -23,6 +49,8 @@ sort_by_enum = {
     "highest_rating": "ratingHigh",  # the highest rating reviews
     "lowest_rating": "ratingLow",  # the lowest rating reviews
 }
+# _parse_sort_by defaults to "1", the newest reviews too
+newest_sort_ids = (sort_by_enum["newest"], "1")
 
 
 review_default_result: Dict[str, Any] = {
@@ -110,11 +138,28 @@ class GoogleMapsAPIScraper:
         request_interval: float = default_request_interval,
         n_retries: int = default_n_retries,
         retry_time: float = default_retry_time,
+        transport: Optional[Transport] = None,
+        review_parser: str = default_review_parser,
+        pipeline: bool = default_pipeline,
+        rate_limiter: Optional[AdaptiveRateLimiter] = None,
+        retry_policy: Optional[RetryPolicy] = None,
     ):
 
         self.request_interval = request_interval
         self.n_retries = n_retries
         self.retry_time = retry_time
+        # "lxml" parses each page once, "bs4" is the former BeautifulSoup path
+        self.review_parser = review_parser
+        # Request the next page while a worker parses the current one
+        self.pipeline = pipeline
+        # All instances share one pooled keep-alive transport by default
+        self.transport = transport or get_transport()
+        # and one rate limiter, so together they stay under google's limits
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        # and circuit breakers, so an outage pauses all of them at once
+        self.retry_policy = retry_policy or get_retry_policy()
+        # and the cache of reviewSort pages, when one is configured
+        self.response_cache = get_response_cache()
         self._reset_logger_filter()
 
     def __enter__(self):
@@ -170,6 +215,33 @@ class GoogleMapsAPIScraper:
         return "<html><body>" + text + "</body></html>"
 
     def _format_response_text(self, response_text: str):
+        """Transforms text into a tree and extract list of reviews"""
+        if self.review_parser == "bs4":
+            return self._format_response_soup(response_text)
+
+        tree = reviews = review_count = next_token = None
+        try:
+            tree = rx.parse_page(response_text)
+            metadata_node = rx.METADATA(tree)[0]
+            review_count = int(metadata_node.attrib["data-google-review-count"])
+            next_token = metadata_node.attrib["data-next-page-token"]
+
+            reviews = rx.REVIEWS(tree)
+
+        except Exception:
+
+            if next_token is None:
+                next_token = self._get_response_token(response_text)
+
+        return (
+            response_text,
+            tree,
+            reviews,
+            review_count,
+            next_token,
+        )
+
+    def _format_response_soup(self, response_text: str):
         """Transforms text into soup and extract list of reviews"""
         response_soup = reviews_soup = review_count = next_token = None
         try:
@@ -218,18 +290,80 @@ class GoogleMapsAPIScraper:
         sort_by_id: str = "",
         associated_topic: str = "",
         token: str = "",
-    ) -> Tuple[BeautifulSoup, List[BeautifulSoup], int, str]:
+    ) -> Tuple[str, BeautifulSoup, List[BeautifulSoup], int, str]:
         """Makes and formats get request in google's api"""
-        query = (
-            f"https://www.google.com/async/reviewSort?"
+        # Make request
+        response = self._fetch_page(feature_id, hl, sort_by_id, token)
+
+        # Format response into list of reviews
+        return self._process_response(response)
+
+    def _fetch_page(
+        self,
+        feature_id: str,
+        hl: str = "",
+        sort_by_id: str = "",
+        token: str = "",
+    ):
+        """Fetches one reviewSort page, from the response cache if it has
+        it. The first page of the newest reviews is never cached, it gets
+        every new review"""
+        query = self._build_query(feature_id, hl, sort_by_id, token)
+        if self.response_cache is None or (
+            token == "" and sort_by_id in newest_sort_ids
+        ):
+            return self._fetch(query)
+
+        key = page_cache_key(feature_id, hl, sort_by_id, token)
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            return cached_response(query, *cached)
+
+        response = self._fetch(query)
+        # Throttled pages never get here, _fetch raised already. The page is
+        # only cached once it parsed, see _cache_once_parsed
+        if response.status_code == 200:
+            response.cache_key = key
+        return response
+
+    def _fetch(self, query: str):
+        """Makes the request once the rate limiter allows it, and reports
+        the outcome back to it"""
+        host = urllib.parse.urlparse(query).netloc
+        self.rate_limiter.acquire(host)
+        try:
+            response = self.transport.get(query)
+        except Exception:
+            self.rate_limiter.on_error(host)
+            raise
+        throttled = self.rate_limiter.on_response(host, response)
+        if throttled and response.status_code < 400:
+            raise ThrottledError(f"Got a captcha or empty page: {query}")
+        # Error pages would be replayed in place of the real ones
+        if response.status_code == 200:
+            record_response(query, response)
+        return response
+
+    def _build_query(
+        self,
+        feature_id: str,
+        hl: str = "",
+        sort_by_id: str = "",
+        token: str = "",
+    ) -> str:
+        """Builds the reviewSort url for one page of reviews"""
+        return (
+            f"{get_google_base_url()}/async/reviewSort?"
             f"authuser=0&hl={hl}&yv=3&cs=1&async=feature_id:{feature_id},"
             f"review_source:All%20reviews,sort_by:{sort_by_id},"
             f"is_owner:false,filter_text:,associated_topic:,"
             f"next_page_token:{token},_pms:s,_fmt:pc"
         )
 
-        # Make request
-        response = requests.get(query)
+    def _process_response(
+        self, response
+    ) -> Tuple[str, BeautifulSoup, List[BeautifulSoup], int, str]:
+        """Checks, decodes and formats a reviewSort response"""
         response.raise_for_status()
         # Decode response
         response_text = self._decode_response(response)
@@ -240,6 +374,90 @@ class GoogleMapsAPIScraper:
         # Format response into list of reviews
         return self._format_response_text(response_text)
 
+    def _peek_pagination(self, content: bytes) -> Optional[Tuple[int, str]]:
+        """Reads review count and next page token straight from the raw
+        bytes, without parsing the page"""
+        tag = pagination_tag_regex.search(content)
+        if not tag:
+            return None
+        token = next_page_token_regex.search(tag.group(0))
+        if not token:
+            return None
+        return int(tag.group(1)), token.group(1).decode()
+
+    def _get_page(
+        self,
+        feature_id: str,
+        hl: str = "",
+        sort_by_id: str = "",
+        token: str = "",
+    ):
+        """Makes get request in google's api, leaving the parsing for later"""
+        return self._read_page(
+            self._fetch_page(feature_id, hl, sort_by_id, token), hl
+        )
+
+    def _read_page(self, response, hl):
+        """Returns (response_text, review_count, next_token, parse_page),
+        parse_page being the call that parses the reviews of the page, or
+        None when the page has no reviews list"""
+        response.raise_for_status()
+        pagination = self._peek_pagination(response.content)
+        if pagination is not None:
+            review_count, next_token = pagination
+            # Raised before the page is parsed, so it is requested again
+            if review_count and not review_node_regex.search(response.content):
+                raise ValueError(f"No reviews on a page of {review_count}")
+            parse_pool = get_parse_pool()
+            if parse_pool is not None:
+                parse_page = partial(
+                    parse_pool.review_page,
+                    response,
+                    hl,
+                    next_token,
+                    self.review_parser,
+                )
+            else:
+                parse_page = partial(self._parse_page, response, hl, next_token)
+            parse_page = self._cache_once_parsed(response, parse_page)
+            return "", review_count, next_token, parse_page
+
+        # Fall back to parsing the page right away
+        (
+            response_text,
+            _,
+            reviews_soup,
+            review_count,
+            next_token,
+        ) = self._process_response(response)
+        parse_page = None
+        if isinstance(reviews_soup, list) and (reviews_soup or not review_count):
+            parse_page = partial(self._parse_reviews, reviews_soup, hl, next_token)
+            parse_page = self._cache_once_parsed(response, parse_page)
+        return response_text, review_count, next_token, parse_page
+
+    def _cache_once_parsed(self, response, parse_page):
+        """Wraps parse_page so it stores a fetched page in the response
+        cache after its reviews parsed. A page that doesn't parse is then
+        requested again, rather than replayed until it expires"""
+        key = getattr(response, "cache_key", None)
+        if key is None:
+            return parse_page
+        return partial(self._parse_and_cache, response, key, parse_page)
+
+    def _parse_and_cache(self, response, key, parse_page) -> List[dict]:
+        reviews = parse_page()
+        self.response_cache.put(key, response.content, response.encoding)
+        return reviews
+
+    def _parse_page(self, response, hl, token) -> List[dict]:
+        """Decodes, formats and parses every review of a page. Raises when
+        the page has a review count but its reviews can't be found"""
+        _, _, reviews_soup, review_count, _ = self._process_response(response)
+        if not isinstance(reviews_soup, list) or (review_count and not reviews_soup):
+            raise ValueError(f"Reviews of a page of {review_count} not found")
+        return self._parse_reviews(reviews_soup, hl, token)
+
     def _parse_place(
         self,
         response: BeautifulSoup,
@@ -449,6 +667,10 @@ class GoogleMapsAPIScraper:
         except Exception:
             self._handle_review_exception(result, review, "trip_type_travel_group")
 
+        return self._finalize_review(result, hl)
+
+    def _finalize_review(self, result: dict, hl) -> dict:
+        """Derives dates and normalizes empty values of a parsed review"""
         if "en" in hl:
             if result["relative_date"]:
                 try:
@@ -486,6 +708,178 @@ class GoogleMapsAPIScraper:
 
         return result
 
+    def _parse_review_text_lxml(self, text_block) -> str:
+        """Same as _parse_review_text, for lxml elements"""
+        text = ""
+        for e, s in zip(rx.contents(text_block), rx.stripped_strings(text_block)):
+            if rx.is_tag_with_class(e):
+                break
+            text += s + " "
+
+        text = re.sub(r"\s", " ", text)
+        text = re.sub("'|\"", "", text)
+        text = text.strip()
+        return text
+
+    def _parse_review_lxml(self, review, hl) -> dict:
+        """Same as _parse_review, with precompiled xpaths over the page tree"""
+        result = review_default_result.copy()
+        markup = None
+
+        def handle_exception(name):
+            nonlocal markup
+            if markup is None:
+                markup = rx.to_markup(review)
+            self._handle_review_exception(result, markup, name)
+
+        # Make timestamp
+        result["retrieval_date"] = str(datetime.now())
+
+        # Parse text
+        text_blocks = []
+        try:
+            text_blocks = rx.FULL_TEXT(review)
+            if not text_blocks:
+                text_blocks = rx.EXPANDABLE_SECTION(review)
+            if text_blocks:
+                result["text"] = self._parse_review_text_lxml(text_blocks[0])
+        except Exception:
+            handle_exception("text")
+        try:
+            if len(text_blocks) > 1:
+                result["translated_text"] = self._parse_review_text_lxml(
+                    text_blocks[1]
+                )
+        except Exception:
+            handle_exception("translated_text")
+
+        # Parse review rating
+        try:
+            rating_text = rx.first(rx.RATING, review).get("aria-label")
+            rating_text = re.sub(",", ".", rating_text)
+            rating = re.findall("[0-9]+[.][0-9]*", rating_text)
+            result["rating"] = float(rating[0])
+            result["rating_max"] = None
+        except Exception:
+            handle_exception("rating")
+
+        # Parse other ratings
+        try:
+            other_ratings = rx.first(rx.OTHER_RATINGS, review)
+            if other_ratings is not None:
+                s = rx.join_stripped_strings(other_ratings)
+                result["other_ratings"] = re.sub(r"\s+", " ", s)
+        except Exception:
+            handle_exception("other_ratings")
+
+        # Parse relative date
+        try:
+            result["relative_date"] = rx.get_text(rx.first(rx.RELATIVE_DATE, review))
+        except Exception:
+            handle_exception("relative_date")
+
+        # Parse user name
+        try:
+            result["user_name"] = rx.get_text(rx.first(rx.USER_NAME, review))
+        except Exception:
+            handle_exception("user_name")
+
+        # Parse user metadata
+        try:
+            user_node = rx.first(rx.USER_NODE, review)
+            if user_node is not None:
+                result["user_url"] = user_node.get("href")
+                result["user_is_local_guide"] = bool(rx.LOCAL_GUIDE(user_node))
+                fixed_text = rx.get_text(user_node).replace(",", "").replace(".", "")
+                user_reviews, user_photos = extract_reviews_and_photos(fixed_text)
+                result["user_reviews"] = user_reviews
+                result["user_photos"] = user_photos
+        except Exception:
+            handle_exception("user_data")
+
+        # Parse review id
+        try:
+            review_id = rx.first(rx.REVIEW_LINK, review).get("href")
+            result["review_id"] = re.findall("(?<=postId=).*?(?=&)", review_id)[0]
+        except Exception:
+            handle_exception("review_id")
+
+        # Parse review likes
+        try:
+            review_likes = rx.first(rx.LIKES, review)
+            if review_likes is not None:
+                result["likes"] = int(rx.get_text(review_likes))
+        except Exception:
+            handle_exception("likes")
+
+        # Parse review response
+        responses = []
+        try:
+            responses = rx.RESPONSE(review)
+            if responses:
+                result["response_text"] = self._parse_review_text_lxml(responses[0])
+            response_date = rx.first(rx.RESPONSE_DATE, review)
+            if response_date is not None:
+                result["response_relative_date"] = rx.get_text(response_date)
+        except Exception:
+            handle_exception("response")
+
+        try:
+            if responses:
+                result["translated_response_text"] = self._parse_review_text_lxml(
+                    responses[1]
+                )
+        except Exception:
+            handle_exception("response")
+
+        # Parse trip_type_travel_group
+        try:
+            trip_type_travel_group = rx.first(rx.TRIP_TYPE, review)
+            if trip_type_travel_group is not None:
+                s = rx.join_stripped_strings(trip_type_travel_group)
+                result["trip_type_travel_group"] = re.sub(r"\s+", " ", s)
+        except Exception:
+            handle_exception("trip_type_travel_group")
+
+        return self._finalize_review(result, hl)
+
+    def _on_page_failure(
+        self, error, feature_id, attempt, next_token, response_text, url_name, i
+    ) -> Optional[float]:
+        """Decides what to do after a failed page request. Returns the delay
+        before the next attempt, or None to skip the page. Raises when the
+        place can't be scraped. Must be called while handling `error`"""
+        self.retry_policy.record_failure(feature_id, error)
+        place_open = self.retry_policy.is_place_open(feature_id)
+        if attempt < self.n_retries and not place_open:
+            return backoff_delay(attempt, self.retry_time)
+
+        # Dump the page once, when giving up on it
+        self._handle_place_exception(response_text, url_name, i)
+        if place_open:
+            raise PlaceCircuitOpenError(f"Giving up on {url_name}") from error
+        if next_token == "":
+            raise error
+        return None
+
+    def _parse_reviews(self, reviews_soup, hl, token) -> List[dict]:
+        """Parses every review of a page, tagging them with the page token"""
+        if self.review_parser == "bs4":
+            parse_review = self._parse_review
+        else:
+            parse_review = self._parse_review_lxml
+        results = []
+        try:
+            # print("reviews_soup", len(reviews_soup))
+            for review in reviews_soup:
+                result = parse_review(review, hl)
+                result["token"] = token
+
+                results.append(result)
+        except Exception:
+            traceback.print_exc()
+        return results
+
     def scrape_reviews(
         self,
         url: str,
@@ -493,9 +887,69 @@ class GoogleMapsAPIScraper:
         hl: str = "en",
         sort_by: str = "",
         token: str = "",
+        watermark: Optional[Watermark] = None,
     ):
         """Scrape specified amount of reviews of a place, appending
-        results in csv"""
+        results in csv. With a `watermark` and sort_by="newest", stops at
+        the first review the previous runs already stored"""
+        parser = ThreadPoolExecutor(max_workers=1) if self.pipeline else None
+
+        def run(step, argument):
+            if step == "sleep":
+                time.sleep(argument)
+            elif step == "fetch":
+                return self._get_page(*argument)
+            elif step == "parse":
+                # The next page is requested while this one is being parsed
+                return parser.submit(argument) if parser else argument()
+            elif step == "wait":
+                return argument.result() if parser else argument
+
+        steps = self._paginate(url, n_reviews, hl, sort_by, token, watermark)
+        try:
+            outcome, error = None, None
+            while True:
+                try:
+                    step, argument = self._next_step(steps, outcome, error)
+                except StopIteration as stop:
+                    return stop.value
+                outcome, error = None, None
+                try:
+                    outcome = run(step, argument)
+                except Exception as e:
+                    error = e
+        finally:
+            if parser is not None:
+                parser.shutdown(cancel_futures=True)
+
+    def _next_step(self, steps, outcome, error):
+        """Hands the outcome of the former step to _paginate, or the error
+        it raised, and returns the next step"""
+        if error is not None:
+            return steps.throw(error)
+        return steps.send(outcome)
+
+    def _paginate(
+        self,
+        url: str,
+        n_reviews: int,
+        hl: str,
+        sort_by: str,
+        token: str,
+        watermark: Optional[Watermark],
+    ):
+        """
+        Pagination of scrape_reviews, shared by the sync and async scrapers.
+        It yields the steps that block as (step, argument) pairs, gets their
+        outcome back, and returns the reviews:
+
+        - ("sleep", seconds)
+        - ("fetch", (feature_id, hl, sort_by_id, token)): the _get_page
+          tuple, or the error the request raised
+        - ("parse", parse_page): the reviews of the page, or a future of
+          them when pages are parsed in the background
+        - ("wait", page): the reviews of a page the parse step returned
+        """
         url_name = re.findall("(?<=place/).*?(?=/)", url)[0]
         url_name = urllib.parse.unquote_plus(url_name)
         self._reset_logger_filter(url_name)
@@ -503,74 +957,137 @@ class GoogleMapsAPIScraper:
         feature_id = self._parse_url_to_feature_id(url)
         sort_by_id = self._parse_sort_by(sort_by)
 
-        results = []
-        j = 0
+        self.retry_policy.check_place(feature_id)
 
+        journal = get_run_journal()
+        page_key = self._page_key(feature_id, hl, sort_by_id, token)
+        resumed, token = self._resume_pages(journal, page_key, url_name, token)
+
+        pages = []
         n_requests = math.ceil((n_reviews) / 10)
-        for i in range(n_requests):
+        if token is None:
+            n_requests = 0
+        for i in range(len(resumed), n_requests):
 
-            n = self.n_retries
-            while n > 0:
+            attempt = 0
+            skipped = False
+            while True:
                 next_token = ""
+                # Every worker waits out an outage together
+                yield "sleep", self.retry_policy.outage_delay()
                 try:
                     response_text = ""
 
                     (
                         response_text,
-                        response_soup,
-                        reviews_soup,
                         review_count,
                         next_token,
-                    ) = self._get_request(  # type: ignore[misc]
-                        feature_id,
-                        hl=hl,
-                        sort_by_id=sort_by_id,
-                        token=token,
-                    )
+                        parse_page,
+                    ) = yield "fetch", (feature_id, hl, sort_by_id, token)
 
-                    assert isinstance(reviews_soup, list)
+                    assert parse_page is not None
+                    self.retry_policy.record_success(feature_id)
                     break
                 except Exception as e:
-                    # traceback.print_exc()
-                    n -= 1
-                    self._handle_place_exception(response_text, url_name, i)
-                    if n == 0 and next_token == "":
-
-                        raise e
-                    elif n == 0:
-
+                    attempt += 1
+                    delay = self._on_page_failure(
+                        e,
+                        feature_id,
+                        attempt,
+                        next_token,
+                        response_text,
+                        url_name,
+                        i,
+                    )
+                    if delay is None:
+                        skipped = True
                         break
-                    else:
-
-                        time.sleep(self.retry_time)
+                    yield "sleep", delay
             token = next_token
-            if n == 0:
+            if skipped:
                 continue
 
-            try:
-                # print("reviews_soup", len(reviews_soup))
-                for review in reviews_soup:
-                    #
-                    result = self._parse_review(review, hl)
-                    result["token"] = token
-
-                    results.append(result)
-                    #
-                    j += 1
-            except Exception:
-                traceback.print_exc()
+            pages.append((yield "parse", parse_page))
+            if journal is not None:
+                index = len(resumed) + len(pages) - 1
+                self._journal_page(journal, page_key, index, token, pages[-1])
 
             if review_count < 10 or token == "":
 
                 break
 
+            # Known reviews only get older, no need for the next page
+            if watermark is not None:
+                last_page = yield "wait", pages[-1]
+                if any(map(watermark.reached, last_page)):
+                    break
+
             # Waiting so google wont block this scraper
-            time.sleep(self.request_interval)
+            yield "sleep", self.request_interval
+
+        parsed = []
+        for page in pages:
+            parsed.append((yield "wait", page))
+        results = self._collect_reviews(resumed + parsed, watermark)
 
         if n_reviews is not None and n_reviews >= 1:
             return results[:n_reviews]
         return results
 
+    def _page_key(self, feature_id: str, hl: str, sort_by_id: str, token: str):
+        return f"{feature_id}:{hl}:{sort_by_id}:{token}"
+
+    def _resume_pages(
+        self,
+        journal: Optional[RunJournal],
+        page_key: str,
+        url_name: str,
+        token: str,
+    ) -> Tuple[List[List[dict]], Optional[str]]:
+        """Pages the journal kept from a run that died, and the token to go
+        on from. The token is None when the pagination had already ended"""
+        if journal is None:
+            return [], token
+        resumed, next_token = journal.get_pages(page_key)
+        if not resumed:
+            return [], token
+        print(f"Resuming reviews of {url_name} after {len(resumed)} pages")
+        return resumed, next_token or None
+
+    def _journal_page(
+        self, journal: RunJournal, page_key: str, index: int, next_token: str, page
+    ):
+        """Saves a page to the journal once it is parsed"""
+        if isinstance(page, list):
+            journal.save_page(page_key, index, next_token, page)
+            return
+
+        def save(future):
+            if not future.cancelled() and future.exception() is None:
+                journal.save_page(page_key, index, next_token, future.result())
+
+        page.add_done_callback(save)
+
+    def _collect_reviews(
+        self, pages: List[List[dict]], watermark: Optional[Watermark] = None
+    ) -> List[dict]:
+        """Joins the reviews of every page, up to the watermark. Drops the
+        reviews seen twice when new reviews shifted the pages mid run. Reviews
+        without an id can't be told apart, they are all kept"""
+        results = []
+        seen_ids = set()
+        for reviews in pages:
+            for review in reviews:
+                if watermark is not None and watermark.reached(review):
+                    return results
+                review_id = review.get("review_id")
+                if review_id:
+                    if review_id in seen_ids:
+                        continue
+                    seen_ids.add(review_id)
+                results.append(review)
+        return results
+
     def scrape_place(
         self,
         url: str,
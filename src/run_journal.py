@@ -0,0 +1,191 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+default_busy_timeout = 30
+
+# Path of the sqlite file journaling the progress of runs. Runs are not
+# journaled when it is not set
+run_journal_db_env = "RUN_JOURNAL_DB"
+# Id of the Airflow run, e.g. "{{ run_id }}" in the environment of the
+# DockerOperator. The retries of a task share it, the next runs don't
+airflow_run_id_env = "AIRFLOW_RUN_ID"
+# Logical date of the run, e.g. "{{ ds }}", in place of the Airflow run id.
+# The current date when neither is set
+run_date_env = "RUN_DATE"
+# Attraction scraped by the task, several tasks of a run scrape at once
+attraction_id_env = "ATTRACTION_ID"
+
+
+class RunJournal:
+    """
+    On disk journal of a run, so a restarted run resumes where the former
+    one died instead of starting from zero. It records:
+
+    - finished queries, with their result
+    - finished places, with their processed reviews
+    - every parsed review page of the places in progress, with the token of
+      the next page
+
+    Entries belong to `run_id`, a retry of the same run picks them up.
+    clear() forgets them once the run succeeded.
+    """
+
+    def __init__(self, path: str, run_id: str):
+        self.path = path
+        self.run_id = run_id
+        self._local = threading.local()
+        db = self._connection()
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS finished_queries ("
+                " run_id TEXT NOT NULL,"
+                " query TEXT NOT NULL,"
+                " result TEXT NOT NULL,"
+                " finished_at REAL NOT NULL,"
+                " PRIMARY KEY (run_id, query))"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS finished_places ("
+                " run_id TEXT NOT NULL,"
+                " place_id TEXT NOT NULL,"
+                " reviews TEXT NOT NULL,"
+                " finished_at REAL NOT NULL,"
+                " PRIMARY KEY (run_id, place_id))"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS review_pages ("
+                " run_id TEXT NOT NULL,"
+                " page_key TEXT NOT NULL,"
+                " page INTEGER NOT NULL,"
+                " next_token TEXT NOT NULL,"
+                " reviews TEXT NOT NULL,"
+                " PRIMARY KEY (run_id, page_key, page))"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=default_busy_timeout)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    def _get(self, sql: str, *params) -> Optional[Any]:
+        row = self._connection().execute(sql, (self.run_id, *params)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def _put(self, sql: str, *params):
+        db = self._connection()
+        with db:
+            db.execute(sql, (self.run_id, *params))
+
+    def get_query(self, query: str) -> Optional[Dict]:
+        return self._get(
+            "SELECT result FROM finished_queries WHERE run_id = ? AND query = ?",
+            query,
+        )
+
+    def finish_query(self, query: str, result: Dict):
+        self._put(
+            "INSERT OR REPLACE INTO finished_queries VALUES (?, ?, ?, ?)",
+            query,
+            json.dumps(result, default=str),
+            time.time(),
+        )
+
+    def get_place(self, place_id: str) -> Optional[List[Dict]]:
+        return self._get(
+            "SELECT reviews FROM finished_places WHERE run_id = ? AND place_id = ?",
+            place_id,
+        )
+
+    def finish_place(self, place_id: str, reviews: List[Dict]):
+        self._put(
+            "INSERT OR REPLACE INTO finished_places VALUES (?, ?, ?, ?)",
+            place_id,
+            json.dumps(reviews, default=str),
+            time.time(),
+        )
+
+    def get_pages(self, page_key: str) -> Tuple[List[List[Dict]], Optional[str]]:
+        """Review pages already parsed for `page_key`, and the token of the
+        page to resume from. The token is None when nothing was journaled"""
+        rows = self._connection().execute(
+            "SELECT page, next_token, reviews FROM review_pages"
+            " WHERE run_id = ? AND page_key = ? ORDER BY page",
+            (self.run_id, page_key),
+        ).fetchall()
+        pages = []
+        next_token = None
+        # Pages are parsed in the background, one may be missing
+        for expected, (page, token, reviews) in enumerate(rows):
+            if page != expected:
+                break
+            pages.append(json.loads(reviews))
+            next_token = token
+        return pages, next_token
+
+    def save_page(
+        self, page_key: str, page: int, next_token: str, reviews: List[Dict]
+    ):
+        self._put(
+            "INSERT OR REPLACE INTO review_pages VALUES (?, ?, ?, ?, ?)",
+            page_key,
+            page,
+            next_token,
+            json.dumps(reviews, default=str),
+        )
+
+    def clear(self):
+        """Forgets the whole run, once it succeeded"""
+        db = self._connection()
+        with db:
+            for table in ("finished_queries", "finished_places", "review_pages"):
+                db.execute(f"DELETE FROM {table} WHERE run_id = ?", (self.run_id,))
+
+
+_run_journal: Optional[RunJournal] = None
+_run_journal_lock = threading.Lock()
+
+
+def current_run_id(output: str) -> str:
+    """
+    Id under which the run writing to `output` is journaled: the output,
+    the attraction of the task, and the Airflow run id or else the logical
+    date of the run. Retries of a task resume its journal, while the other
+    tasks and the runs of the next days get their own.
+    """
+    run = (
+        os.getenv(airflow_run_id_env)
+        or os.getenv(run_date_env)
+        or datetime.now().strftime("%Y-%m-%d")
+    )
+    return "/".join([output, os.getenv(attraction_id_env, ""), run])
+
+
+def start_run_journal(run_id: str) -> Optional[RunJournal]:
+    """Opens the journal of `run_id` as the process wide journal, if
+    journaling is turned on"""
+    path = os.getenv(run_journal_db_env)
+    set_run_journal(RunJournal(path, run_id) if path else None)
+    return get_run_journal()
+
+
+def get_run_journal() -> Optional[RunJournal]:
+    """Returns the process wide journal, or None when runs aren't
+    journaled"""
+    with _run_journal_lock:
+        return _run_journal
+
+
+def set_run_journal(run_journal: Optional[RunJournal]):
+    """Replaces the process wide journal, None turning journaling off"""
+    global _run_journal
+    with _run_journal_lock:
+        _run_journal = run_journal
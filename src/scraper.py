@@ -1,7 +1,10 @@
 import logging
+import os
+import threading
 from hashlib import md5
 from time import sleep, time
-from typing import Any, List
+from typing import Any, List, Optional
+from urllib.parse import urlparse
 
 from botasaurus import AntiDetectDriver, AntiDetectRequests, bt, cl
 from botasaurus.cache import DontCache
@@ -10,12 +13,92 @@ from botasaurus.decorators import AsyncQueueResult, browser, request
 from botasaurus.utils import retry_if_is_error
 from selenium.common.exceptions import StaleElementReferenceException
 
-from src.extract_data import extract_data, perform_extract_possible_map_link
+from src.browser_pool import add_browser_arguments
+from src.extract_data import (
+    extract_place_page,
+    initialization_state,
+    initialization_state_end,
+    initialization_state_start,
+    perform_extract_possible_map_link,
+)
+from src.hedging import get_hedger
+from src.parse_pool import get_parse_pool
+from src.rate_limiter import get_rate_limiter
+from src.replay import record_response
+from src.result_cache import cached
+from src.retry_policy import get_retry_queue
+from src.review_state import get_review_state
+from src.run_journal import get_run_journal
 from src.scraper_utils import create_search_link, perform_visit
+from src.transport import get_transport, rebase_url
 from src.utils import convert_unicode_dict_to_ascii_dict, unique_strings
 
 from .reviews_scraper import GoogleMapsAPIScraper
 
+# Set to 1 to stream place pages through the pooled transport and stop
+# reading them once APP_INITIALIZATION_STATE is in, instead of downloading
+# them whole with the stealth client
+place_streaming_env = "PLACE_STREAMING"
+place_page_markers = (
+    initialization_state_start.encode(),
+    initialization_state_end.encode(),
+)
+
+
+# Place links of the search results
+feed_link_selector = '[role="feed"] >  div > div > a'
+
+
+# Instances of the request tasks of every thread, see thread_task
+_thread_tasks = threading.local()
+
+
+def _instantiable(decorator, options):
+    """`decorator` (request or browser) with `options`, whose tasks get their
+    `options` and a create_instance(**overrides) creating more instances of
+    them, with the same options but for `overrides`"""
+
+    def decorate(func):
+        task = decorator(**options)(func)
+        task.options = options
+        task.create_instance = lambda **overrides: decorator(
+            **{**options, **overrides}
+        )(func)
+        return task
+
+    return decorate
+
+
+def request_task(**options):
+    """request decorator whose tasks thread_task can create more instances
+    of"""
+    return _instantiable(request, options)
+
+
+def browser_task(**options):
+    """browser decorator whose tasks the browser pool can create more
+    instances of, one per driver"""
+    return _instantiable(browser, options)
+
+
+def thread_task(task):
+    """
+    Instance of the request task `task` of the calling thread, created on
+    its first call.
+
+    botasaurus keeps the options and metadata of the last call of a task in
+    variables shared by all its callers, so threads calling the same task
+    at once would mix up their calls. Each gets an instance of its own.
+    """
+    tasks = _thread_tasks.__dict__.setdefault("tasks", {})
+    if task not in tasks:
+        tasks[task] = task.create_instance()
+    return tasks[task]
+
+
+def is_place_streaming():
+    return os.getenv(place_streaming_env, "") not in ("", "0")
+
 
 def process_reviews(reviews, convert_to_english):
     processed_reviews = []
@@ -60,10 +143,43 @@ def process_reviews(reviews, convert_to_english):
         return processed_reviews
 
 
-@request(
+def get_review_watermark(data):
+    """Watermark of the place when scraping its reviews incrementally"""
+    if not data.get("incremental"):
+        return None
+    if data["reviews_sort"] != "newest":
+        print("Incremental reviews need reviews_sort='newest', scraping them all.")
+        return None
+    return get_review_state().get(data["place_id"])
+
+
+def update_review_watermark(data, reviews):
+    """Moves the watermark of the place to `reviews` once the output of the
+    run is written, see Gmaps.places"""
+    if data.get("incremental") and data["reviews_sort"] == "newest":
+        get_review_state().defer_update(data["place_id"], reviews)
+
+
+def get_finished_reviews(place_id):
+    """Reviews of a place that a former attempt of the run already scraped"""
+    journal = get_run_journal()
+    return journal.get_place(place_id) if journal is not None else None
+
+
+def finish_reviews(place_id, processed):
+    journal = get_run_journal()
+    if journal is not None:
+        journal.finish_place(place_id, processed)
+
+
+@request_task(
     close_on_crash=True,
     output=None,
 )
+@cached(
+    ttl=24 * 60 * 60,
+    depends_on=["src.reviews_scraper", "src.review_extractor", "src.time_utils"],
+)
 def scrape_reviews(requests: AntiDetectRequests, data):
 
     place_id = data["place_id"]
@@ -75,15 +191,34 @@ def scrape_reviews(requests: AntiDetectRequests, data):
     lang = data["lang"]
     convert_to_english = data["convert_to_english"]
 
+    finished = get_finished_reviews(place_id)
+    if finished is not None:
+        # The attempt that scraped them died before moving the watermark
+        update_review_watermark(data, finished)
+        return {"place_id": place_id, "reviews": finished, "finished": True}
+
     logging.info(f"Scrapping reviews for place_id: {place_id}")
 
     processed = []
+    # The scraper prints and swallows the exception of a failed place
+    finished = False
     with GoogleMapsAPIScraper() as scraper:
 
-        result = scraper.scrape_reviews(link, max_r, lang, sort_by=reviews_sort)
+        result = scraper.scrape_reviews(
+            link,
+            max_r,
+            lang,
+            sort_by=reviews_sort,
+            watermark=get_review_watermark(data),
+        )
         processed = process_reviews(result, convert_to_english)
+        update_review_watermark(data, result)
+        finish_reviews(place_id, processed)
+        finished = True
 
-    return {"place_id": place_id, "reviews": processed}
+    result = {"place_id": place_id, "reviews": processed, "finished": finished}
+    # A failed place is scraped again by the next run rather than cached
+    return result if finished else DontCache(result)
 
 
 cookies = None
@@ -99,53 +234,127 @@ def set_cookies(ck):
     cookies = ck
 
 
-@request(
+@request_task(
     parallel=5,
     async_queue=True,
     close_on_crash=True,
     output=None,
     use_stealth=True,
-    max_retry=5,
 )
-def scrape_place(requests: AntiDetectRequests, link):
+@cached(ttl=7 * 24 * 60 * 60, depends_on=["src.extract_data"])
+def scrape_place(requests: AntiDetectRequests, link, metadata=None):
+    # Only the selected fields are extracted, all of them when None
+    fields = metadata.get("fields") if metadata else None
     cookies = get_cookies()
+    # Place pages and reviews share the same budget with google
+    rate_limiter = get_rate_limiter()
+    url = rebase_url(link)
+    host = urlparse(url).netloc
+
+    def send():
+        # The request alone, once the rate limiter let it through
+        try:
+            if is_place_streaming():
+                response = get_transport().get(
+                    url, until=place_page_markers, cookies=cookies
+                )
+            else:
+                response = requests.get(url, cookies=cookies)
+        except Exception:
+            rate_limiter.on_error(host)
+            raise
+        throttled = rate_limiter.on_response(host, response)
+        # Error pages would be replayed in place of the real ones
+        if not throttled and response.status_code == 200:
+            record_response(url, response)
+        return response
+
+    def fetch():
+        rate_limiter.acquire(host)
+        return send()
+
+    hedger = get_hedger()
     try:
-        html = requests.get(link, cookies=cookies).text
-        # Splitting HTML to get the part
-        # after 'window.APP_INITIALIZATION_STATE='
-        initialization_state_part = html.split(";window.APP_INITIALIZATION_STATE=")[1]
-
-        # Further splitting to isolate the APP_INITIALIZATION_STATE content
-        app_initialization_state = initialization_state_part.split(";window.APP_FLAGS")[
-            0
-        ]
-
-        # Extracting data from the APP_INITIALIZATION_STATE
-        data = extract_data(app_initialization_state, link)
+        if hedger is not None:
+            # Waiting for the rate limiter is left out of the hedged latency,
+            # so a queue at the limiter doesn't look like a slow google. A
+            # hedge waits for a token of its own
+            rate_limiter.acquire(host)
+            response = hedger.fetch(send, hedge=fetch)
+        else:
+            response = fetch()
+        if getattr(response, "cut_short", False):
+            logging.info(
+                f"Place page cut short at {len(response.content)} bytes, "
+                f"{response.bytes_saved} bytes saved: {link}"
+            )
+        # Extracting data from the payload in APP_INITIALIZATION_STATE, in
+        # a worker process when there is a parse pool
+        parse_pool = get_parse_pool()
+        if parse_pool is not None:
+            data = parse_pool.place(response, link, fields)
+        else:
+            data = extract_place_page(response.text, link, fields)
         data["is_spending_on_ads"] = False
         cleaned = data
 
+        get_retry_queue().record_success(link)
         return cleaned
     except Exception:
-        print(f"Failed to scrape place: {link}. Retrying after a minute.")
-        sleep(63)
-        raise
+        logging.exception(f"Failed to scrape place: {link}")
+        # Don't hold the worker, it can move on to the next link
+        delay = get_retry_queue().schedule(link)
+        if delay is None:
+            print(f"Failed to scrape place: {link}. Giving up.")
+        else:
+            print(f"Failed to scrape place: {link}. Retrying in {delay:.0f}s.")
+        return DontCache(None)
+
+
+def retry_failed_places(links, places, cache=False, fields=None):
+    """Scrapes the failed links among `links` again as their retries come
+    due, until they succeed or run out of attempts. `places` are the results
+    of the unique `links`, in order, and the retried places take the place
+    of their None. Links that never succeeded keep a None in the result"""
+    retry_queue = get_retry_queue()
+    links = unique_strings(links)
+    places = list(places)
+    while True:
+        due_links = retry_queue.pop_due(links)
+        if not due_links:
+            break
+        # A new queue, the former one drops links it has already seen
+        scrape_place_obj: AsyncQueueResult = thread_task(scrape_place)(
+            metadata={"cache": cache, "fields": fields}
+        )
+        scrape_place_obj.put(due_links)
+        retried = dict(zip(due_links, scrape_place_obj.get()))
+        for index, link in enumerate(links):
+            if retried.get(link) is not None:
+                places[index] = retried[link]
+
+    failed_links = retry_queue.pop_given_up(links)
+    return bt.remove_nones(places) + [None] * len(failed_links)
+
+
+def scrape_place_batch(links, fields=None, cache=False, convert_to_english=False):
+    """Scrapes the place pages of `links`, as scrape_places does for the
+    links of its search. Places that failed every retry are left out"""
+    scrape_place_obj: AsyncQueueResult = thread_task(scrape_place)(
+        metadata={"cache": cache, "fields": fields}
+    )
+    scrape_place_obj.put(links)
+    places = scrape_place_obj.get()
+    places = bt.remove_nones(retry_failed_places(links, places, cache, fields))
+    if convert_to_english:
+        places = convert_unicode_dict_to_ascii_dict(places)
+    return places
 
 
 def extract_possible_map_link(html):
     try:
-        # Splitting HTML to get the part after
-        # 'window.APP_INITIALIZATION_STATE='
-        initialization_state_part = html.split(";window.APP_INITIALIZATION_STATE=")[1]
-
-        # Further splitting to isolate the APP_INITIALIZATION_STATE content
-        app_initialization_state = initialization_state_part.split(";window.APP_FLAGS")[
-            0
-        ]
         # Extracting data from the APP_INITIALIZATION_STATE
-        link = perform_extract_possible_map_link(
-            app_initialization_state,
-        )
+        link = perform_extract_possible_map_link(initialization_state(html))
         # print(link)
         if link and cl.extract_path_from_link(link).startswith("/maps/place"):
             return link
@@ -178,6 +387,7 @@ def add_arguments(data, options):
 @browser(
     create_driver=create_stealth_driver(
         start_url=None,
+        add_arguments=add_browser_arguments,
     ),
     block_resources=[".css", ".jpg", ".jpeg", ".png", ".svg", ".gif"],
     block_images=True,
@@ -194,12 +404,16 @@ def scrape_places_by_links(driver: AntiDetectDriver, data):
 
     links = data["links"]
     cache = data["cache"]
+    fields = data.get("fields")
 
-    scrape_place_obj: AsyncQueueResult = scrape_place(cache=cache)
+    scrape_place_obj: AsyncQueueResult = thread_task(scrape_place)(
+        metadata={"cache": cache, "fields": fields}
+    )
     convert_to_english = data["convert_to_english"]
 
     scrape_place_obj.put(links)
     places = scrape_place_obj.get()
+    places = retry_failed_places(links, places, cache, fields)
 
     hasnone = False
     for place in places:
@@ -225,9 +439,10 @@ class StuckInGmapsException(Exception):
     pass
 
 
-@browser(
+@browser_task(
     create_driver=create_stealth_driver(
         start_url=None,
+        add_arguments=add_browser_arguments,
     ),
     block_resources=[".css", ".jpg", ".jpeg", ".png", ".svg", ".gif"],
     reuse_driver=True,
@@ -238,14 +453,32 @@ class StuckInGmapsException(Exception):
     headless=True,
     output=None,
 )
+@cached(ttl=7 * 24 * 60 * 60, depends_on=["src.extract_data", "src.scraper_utils"])
 def scrape_places(driver: AntiDetectDriver, data):
 
     # This fixes consent Issues in Countries like Spain
     max_results = data["max"]
     is_spending_on_ads = data["is_spending_on_ads"]
     convert_to_english = data["convert_to_english"]
+    fields = data.get("fields")
+    # Only search, leaving the place pages to the caller
+    links_only = data.get("links_only", False)
+
+    scrape_place_obj: Optional[AsyncQueueResult] = None
+    if not links_only:
+        scrape_place_obj = thread_task(scrape_place)(
+            metadata={"cache": False, "fields": fields}
+        )
+    # Every link is queued once, in the order the feed shows it
+    queued_links = []
+    seen_links = set()
 
-    scrape_place_obj: AsyncQueueResult = scrape_place()
+    def put_place_links(links):
+        links = [link for link in unique_strings(links) if link not in seen_links]
+        seen_links.update(links)
+        queued_links.extend(links)
+        if scrape_place_obj is not None and links:
+            scrape_place_obj.put(links)
 
     sponsored_links = None
 
@@ -267,31 +500,40 @@ def scrape_places(driver: AntiDetectDriver, data):
                     link = extract_possible_map_link(driver.page_source)
                     if link:
                         rst = [link]
-                        scrape_place_obj.put(rst)
+                        put_place_links(rst)
                     rst = []
                 elif driver.is_in_page("/maps/place/"):
                     rst = [driver.current_url]
-                    scrape_place_obj.put(rst)
+                    put_place_links(rst)
                 return
             else:
                 did_element_scroll = driver.scroll_element(el)
 
-                links = None
-
-                if max_results is None:
-                    links = driver.links('[role="feed"] >  div > div > a', bt.Wait.LONG)
-                else:
-                    links = unique_strings(
-                        driver.links('[role="feed"] >  div > div > a', bt.Wait.LONG)
-                    )[:max_results]
+                if not queued_links:
+                    # Waits for the first results to render
+                    driver.get_element_or_none_by_selector(
+                        feed_link_selector, bt.Wait.LONG
+                    )
 
                 if is_spending_on_ads:
-                    scrape_place_obj.put(get_sponsored_links())
+                    put_place_links(get_sponsored_links())
                     return
 
-                scrape_place_obj.put(links)
+                # Only the results the feed added since the former scroll, the
+                # script buffers them with a MutationObserver
+                links = [
+                    link
+                    for link in driver.execute_file(
+                        "src/harvest_feed_links.js", feed_link_selector
+                    )
+                    if link not in seen_links
+                ]
+                if max_results is not None:
+                    links = links[: max_results - len(queued_links)]
+
+                put_place_links(links)
 
-                if max_results is not None and len(links) >= max_results:
+                if max_results is not None and len(queued_links) >= max_results:
                     return
 
                 end_el_wait = bt.Wait.SHORT
@@ -360,7 +602,16 @@ def scrape_places(driver: AntiDetectDriver, data):
         else:
             raise e
 
+    if links_only:
+        result = {
+            "query": data["query"],
+            "links": unique_strings(queued_links),
+            "sponsored_links": get_sponsored_links(),
+        }
+        return DontCache(result) if failed_to_scroll else result
+
     places = scrape_place_obj.get()
+    places = retry_failed_places(queued_links, places, fields=fields)
 
     hasnone = False
     for place in places:
@@ -0,0 +1,153 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from .rate_limiter import AdaptiveRateLimiter
+
+default_busy_timeout = 30
+
+
+class SqliteTokenBucket:
+    """
+    Token bucket stored in a sqlite file, so every process of the machine
+    pointing at the same file draws from one budget. Each operation runs in
+    an immediate transaction, which sqlite serializes across processes.
+    Times are wall clock, the only clock processes share.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        host: str,
+        rate: float,
+        capacity: Optional[float] = None,
+    ):
+        self.path = path
+        self.host = host
+        self._local = threading.local()
+        with self._transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                " host TEXT PRIMARY KEY,"
+                " rate REAL NOT NULL,"
+                " capacity REAL NOT NULL,"
+                " tokens REAL NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " paused_until REAL NOT NULL DEFAULT 0,"
+                " last_decrease REAL NOT NULL DEFAULT 0)"
+            )
+            # The first process to see the host sets it up, the others join
+            capacity = capacity or max(rate, 1.0)
+            db.execute(
+                "INSERT OR IGNORE INTO buckets"
+                " (host, rate, capacity, tokens, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (host, rate, capacity, capacity, time.time()),
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(
+                self.path, timeout=default_busy_timeout, isolation_level=None
+            )
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _refill(self, db, now: float):
+        """Adds the tokens earned since the last update, returns the row"""
+        rate, capacity, tokens, updated_at, paused_until, last_decrease = db.execute(
+            "SELECT rate, capacity, tokens, updated_at, paused_until, last_decrease"
+            " FROM buckets WHERE host = ?",
+            (self.host,),
+        ).fetchone()
+        tokens = min(capacity, tokens + max(now - updated_at, 0) * rate)
+        return rate, tokens, paused_until, last_decrease
+
+    @property
+    def rate(self) -> float:
+        return self._connection().execute(
+            "SELECT rate FROM buckets WHERE host = ?", (self.host,)
+        ).fetchone()[0]
+
+    def acquire(self) -> float:
+        """Takes a token, sleeping until it is available. Returns the time
+        waited"""
+        with self._transaction() as db:
+            now = time.time()
+            rate, tokens, paused_until, _ = self._refill(db, now)
+            # Tokens may go negative, which queues the callers up in order
+            tokens -= 1
+            db.execute(
+                "UPDATE buckets SET tokens = ?, updated_at = ? WHERE host = ?",
+                (tokens, now, self.host),
+            )
+        wait = -tokens / rate if tokens < 0 else 0.0
+        wait = max(wait, paused_until - now)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def increase_rate(self, increase: float, max_rate: float):
+        with self._transaction() as db:
+            now = time.time()
+            rate, tokens, _, _ = self._refill(db, now)
+            db.execute(
+                "UPDATE buckets SET rate = ?, tokens = ?, updated_at = ?"
+                " WHERE host = ?",
+                (min(max_rate, rate + increase), tokens, now, self.host),
+            )
+
+    def decrease_rate(
+        self, factor: float, min_rate: float, cooldown: float
+    ) -> Optional[float]:
+        """Multiplies the rate by `factor`, unless any process already
+        decreased it less than `cooldown` seconds ago. Returns the new rate,
+        if any"""
+        with self._transaction() as db:
+            now = time.time()
+            rate, tokens, _, last_decrease = self._refill(db, now)
+            if now - last_decrease < cooldown:
+                return None
+            rate = max(min_rate, rate * factor)
+            db.execute(
+                "UPDATE buckets SET rate = ?, tokens = ?, updated_at = ?,"
+                " last_decrease = ? WHERE host = ?",
+                (rate, tokens, now, now, self.host),
+            )
+            return rate
+
+    def pause(self, seconds: float):
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE buckets SET paused_until = MAX(paused_until, ?)"
+                " WHERE host = ?",
+                (time.time() + seconds, self.host),
+            )
+
+
+def create_shared_rate_limiter(path: str, **kwargs) -> AdaptiveRateLimiter:
+    """
+    Rate limiter whose budget is shared by every process using `path`.
+
+    :param path: sqlite file, on a volume mounted in every container.
+    :param kwargs: AdaptiveRateLimiter options.
+    """
+    return AdaptiveRateLimiter(
+        bucket_factory=lambda host, rate: SqliteTokenBucket(path, host, rate),
+        **kwargs,
+    )
@@ -0,0 +1,386 @@
+import argparse
+import json
+import random
+import re
+import time
+from hashlib import md5
+from html import escape
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote_plus, unquote, urlsplit
+
+from src.replay import Latency, StandInHandler, StandInServer, default_content_type
+
+default_port = 8766
+default_min_reviews = 0
+default_max_reviews = 500
+default_page_size = 10
+default_page_padding = 100 * 1024
+default_retry_after = 1
+
+feature_id_regex = re.compile(r"0[xX][0-9a-fA-F]+:0[xX][0-9a-fA-F]+")
+token_regex = re.compile(r"next_page_token:([^,]*)")
+throttled_body = b"<html><body>Our systems have detected unusual traffic</body></html>"
+
+# Size of data[6] in the place payload, the extractor reads up to index 226
+place_payload_size = 230
+
+
+def place_link(index: int, base_url: str = "https://www.google.com") -> str:
+    """Link of the synthetic place number `index`, in the format of the
+    links the search collects"""
+    low = int(md5(str(index).encode("utf-8")).hexdigest()[:16], 16)
+    return (
+        f"{base_url}/maps/place/Synthetic+Place+{index}/"
+        f"data=!4m7!3m6!1s0x{index:x}:0x{low:x}!8m2!3d0!4d0!16s?hl=en"
+    )
+
+
+def relative_date(days: int) -> str:
+    if days == 0:
+        return "a day ago"
+    if days < 7:
+        return f"{days} days ago"
+    if days < 30:
+        return f"{days // 7} weeks ago"
+    if days < 365:
+        return f"{days // 30} months ago"
+    return f"{days // 365} years ago"
+
+
+class SyntheticPlace:
+    """A place made up out of its feature id, the same on every request"""
+
+    def __init__(
+        self, feature_id: str, min_reviews: int, max_reviews: int, seed: int
+    ):
+        self.feature_id = feature_id
+        self.seed = seed
+        self.random = random.Random(f"{seed}:{feature_id}")
+        self.review_count = self.random.randint(min_reviews, max_reviews)
+        self.rating = round(self.random.uniform(3, 5), 1)
+        self.reviews_per_rating = self._histogram()
+
+    def _histogram(self) -> List[int]:
+        ratings = [self.rating_of(index) for index in range(self.review_count)]
+        return [ratings.count(rating) for rating in range(1, 6)]
+
+    def rating_of(self, index: int) -> int:
+        digest = md5(f"{self.feature_id}:{index}".encode())
+        return int(digest.hexdigest(), 16) % 5 + 1
+
+    def chance(self, name: str, page: int) -> float:
+        """Number in [0, 1) for the decisions made on a page, the same on
+        every request"""
+        digest = md5(f"{self.seed}:{self.feature_id}:{name}:{page}".encode())
+        return int(digest.hexdigest()[:8], 16) / 16**8
+
+
+class SyntheticSite:
+    """
+    Place pages and reviewSort pages of as many places as requested, made
+    up instead of recorded. Every place comes out of the feature id of its
+    link, so a link always gets the same place and the same reviews.
+
+    :param min_reviews: Fewest reviews of a place.
+    :param max_reviews: Most reviews of a place.
+    :param page_size: Reviews per reviewSort page. The scraper stops at the
+    first page with less than 10 reviews.
+    :param page_padding: Bytes of markup around the payload of a place page,
+    real ones weigh hundreds of kilobytes.
+    :param repeat_ratio: Share of the reviewSort pages whose next token
+    points back at the same page, like google sometimes does.
+    :param early_end_ratio: Share of the reviewSort pages that end the
+    pagination before all the reviews were served.
+    :param seed: Changes every place.
+    """
+
+    def __init__(
+        self,
+        min_reviews: int = default_min_reviews,
+        max_reviews: int = default_max_reviews,
+        page_size: int = default_page_size,
+        page_padding: int = default_page_padding,
+        repeat_ratio: float = 0.0,
+        early_end_ratio: float = 0.0,
+        seed: int = 0,
+    ):
+        self.min_reviews = min_reviews
+        self.max_reviews = max_reviews
+        self.page_size = page_size
+        self.page_padding = page_padding
+        self.repeat_ratio = repeat_ratio
+        self.early_end_ratio = early_end_ratio
+        self.seed = seed
+
+    def get_place(self, feature_id: str) -> SyntheticPlace:
+        return SyntheticPlace(
+            feature_id, self.min_reviews, self.max_reviews, self.seed
+        )
+
+    def place_page(self, path: str) -> Optional[bytes]:
+        """Place page with the payload extract_data reads, between
+        ;window.APP_INITIALIZATION_STATE= and ;window.APP_FLAGS"""
+        feature_id = feature_id_regex.search(path)
+        if feature_id is None:
+            return None
+        place = self.get_place(feature_id.group(0))
+        name = unquote(path.split("/maps/place/")[1].split("/")[0])
+        name = name.replace("+", " ")
+
+        payload: List = [None] * place_payload_size
+        payload[4] = [
+            None,
+            None,
+            "$$",
+            [f"https://search.google.com/local/reviews?placeid={place.feature_id}"],
+            None,
+            None,
+            None,
+            place.rating,
+            place.review_count,
+        ]
+        payload[7] = [f"https://example.com/{quote_plus(name)}"]
+        payload[9] = [None, None, 40.0 + place.random.random(), -74.0]
+        payload[10] = place.feature_id
+        payload[11] = name
+        payload[13] = ["Tourist attraction", "Museum"]
+        payload[34] = [
+            None,
+            [
+                [day, ["9 AM–5 PM"] if day != "Monday" else ["Closed"]]
+                for day in (
+                    "Tuesday",
+                    "Wednesday",
+                    "Thursday",
+                    "Friday",
+                    "Saturday",
+                    "Sunday",
+                    "Monday",
+                )
+            ],
+        ]
+        payload[39] = "1 Synthetic St, New York, NY 10001"
+        payload[78] = f"ChIJ{md5(place.feature_id.encode()).hexdigest()[:23]}"
+        payload[175] = [None, None, None, place.reviews_per_rating]
+        payload[178] = [["(212) 555-0100"]]
+        payload[183] = [
+            None,
+            ["Midtown", "1 Synthetic St", None, "New York", "10001", "NY", "US"],
+        ]
+        data = ")]}'\n" + json.dumps([None] * 6 + [payload])
+        state = [None, None, None, [None] * 6 + [data]]
+        padding = "<div></div>" * (self.page_padding // 22)
+        html = (
+            f"<html><head><title>{escape(name)}</title></head><body>{padding}"
+            f"<script>window.APP_OPTIONS=[];window.APP_INITIALIZATION_STATE="
+            f"{json.dumps(state)};window.APP_FLAGS=[];</script>{padding}</body></html>"
+        )
+        return html.encode("utf-8")
+
+    def review_page(self, query: str) -> Optional[bytes]:
+        """reviewSort page of the feature id and page token in the query.
+        Tokens are p<number of the page>"""
+        feature_id = feature_id_regex.search(query)
+        if feature_id is None:
+            return None
+        place = self.get_place(feature_id.group(0))
+        token = token_regex.search(query)
+        token = unquote(token.group(1)) if token else ""
+        page = int(token[1:]) if token.startswith("p") and token[1:].isdigit() else 0
+
+        start = page * self.page_size
+        end = min(start + self.page_size, place.review_count)
+        ends_early = place.chance("end", page) < self.early_end_ratio
+        if end >= place.review_count or ends_early:
+            next_token = ""
+        elif place.chance("repeat", page) < self.repeat_ratio:
+            next_token = token
+        else:
+            next_token = f"p{page + 1}"
+
+        reviews = "".join(self.review(place, index) for index in range(start, end))
+        return (
+            ")]}'\n<style>.z{display:none}</style><div>"
+            f'<div data-google-review-count="{max(end - start, 0)}"'
+            f' data-next-page-token="{next_token}"></div>'
+            f"{reviews}</div><script>window.x=1</script>"
+        ).encode("utf-8")
+
+    def review(self, place: SyntheticPlace, index: int) -> str:
+        """Markup of one review, with the nodes the review parsers read"""
+        review_id = f"Ch{md5(f'{place.feature_id}:{index}'.encode()).hexdigest()}"
+        rating = place.rating_of(index)
+        response = ""
+        if index % 3 == 0:
+            response = (
+                f'<div class="d6SCIc">Thank you for visiting, reviewer {index}!</div>'
+                f'<div class="d6SCIc">Thank you for visiting, reviewer {index}!</div>'
+                f'<span class="pi8uOe">{relative_date(index // 2)}</span>'
+            )
+        return (
+            '<div class="gws-localreviews__google-review WMbnJf">'
+            f'<a class="Msppse" href="https://www.google.com/maps/contrib/{index}">'
+            f'<div class="TSUbDb"><a>Reviewer {index}</a></div>'
+            f'<span class="QV3IV">Local Guide</span> · {index % 90 + 2} reviews'
+            f" · {index % 40 + 2} photos</a>"
+            f'<span class="lTi8oc z3HNkc" aria-label="Rated {rating}.0 out of 5,">'
+            "</span>"
+            f'<span class="dehysf lTi8oc">{relative_date(index)}</span>'
+            f'<div class="k8MTF">Service: {rating} <span>Food: {rating}</span></div>'
+            '<div class="PV7e7"><span>Trip type</span> Family</div>'
+            f'<span class="review-full-text">Review {index} of a synthetic place.'
+            " Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do"
+            " eiusmod tempor incididunt ut labore et dolore magna aliqua.</span>"
+            f'<span jsname="CMh1ye">{index % 7}</span>'
+            '<a class="RvU3D" href="https://www.google.com/maps/reviews/data=x'
+            f'?postId={review_id}&entry=ttu"></a>'
+            f"{response}</div>"
+        )
+
+
+class SyntheticServer(StandInServer):
+    """
+    Stand-in for the place pages and the reviewSort endpoint of google,
+    serving the pages of a SyntheticSite. The parameters not listed are the
+    ones of SyntheticSite.
+
+    :param throttle_ratio: Share of the requests answered with a 429.
+    :param retry_after: Retry-After of the 429s, None to leave it out.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = default_port,
+        latency: Optional[Latency] = None,
+        min_reviews: int = default_min_reviews,
+        max_reviews: int = default_max_reviews,
+        page_size: int = default_page_size,
+        page_padding: int = default_page_padding,
+        throttle_ratio: float = 0.0,
+        retry_after: Optional[float] = default_retry_after,
+        repeat_ratio: float = 0.0,
+        early_end_ratio: float = 0.0,
+        seed: int = 0,
+    ):
+        super().__init__(SyntheticHandler, host, port, latency or Latency())
+        self.site = SyntheticSite(
+            min_reviews,
+            max_reviews,
+            page_size,
+            page_padding,
+            repeat_ratio,
+            early_end_ratio,
+            seed,
+        )
+        self.throttle_ratio = throttle_ratio
+        self.retry_after = retry_after
+        self.place_pages = 0
+        self.review_pages = 0
+        self.throttled = 0
+        self.not_found = 0
+        self.bytes_sent = 0
+
+    def is_throttled(self) -> bool:
+        return bool(self.throttle_ratio) and random.random() < self.throttle_ratio
+
+    def stats(self) -> Dict[str, int]:
+        with self._stats_lock:
+            return {
+                "place_pages": self.place_pages,
+                "review_pages": self.review_pages,
+                "throttled": self.throttled,
+                "not_found": self.not_found,
+                "bytes_sent": self.bytes_sent,
+            }
+
+
+class SyntheticHandler(StandInHandler):
+    server: SyntheticServer
+
+    def do_GET(self):
+        time.sleep(self.server.latency.sample())
+        if self.server.is_throttled():
+            self.server.count("throttled")
+            headers = {}
+            if self.server.retry_after is not None:
+                headers["Retry-After"] = str(self.server.retry_after)
+            self.send_body(429, default_content_type, throttled_body, headers)
+            return
+
+        status, body = self._route()
+        self.server.count("bytes_sent", len(body))
+        self.send_body(status, default_content_type, body)
+
+    def _route(self) -> Tuple[int, bytes]:
+        parts = urlsplit(self.path)
+        body = None
+        if parts.path.startswith("/maps/place/"):
+            body = self.server.site.place_page(parts.path)
+            counter = "place_pages"
+        elif parts.path == "/async/reviewSort":
+            body = self.server.site.review_page(unquote(parts.query))
+            counter = "review_pages"
+        if body is None:
+            self.server.count("not_found")
+            return 404, b"Not found"
+        self.server.count(counter)
+        return 200, body
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Options of the synthetic server, shared with the load test"""
+    parser.add_argument("--min-reviews", type=int, default=default_min_reviews)
+    parser.add_argument("--max-reviews", type=int, default=default_max_reviews)
+    parser.add_argument("--page-size", type=int, default=default_page_size)
+    parser.add_argument(
+        "--page-padding", type=int, default=default_page_padding, help="Bytes"
+    )
+    parser.add_argument("--throttle-ratio", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=default_retry_after)
+    parser.add_argument("--repeat-ratio", type=float, default=0.0)
+    parser.add_argument("--early-end-ratio", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    Latency.add_arguments(parser)
+
+
+def from_arguments(args, host: str, port: int) -> SyntheticServer:
+    return SyntheticServer(
+        host,
+        port,
+        Latency.from_arguments(args),
+        min_reviews=args.min_reviews,
+        max_reviews=args.max_reviews,
+        page_size=args.page_size,
+        page_padding=args.page_padding,
+        throttle_ratio=args.throttle_ratio,
+        retry_after=args.retry_after,
+        repeat_ratio=args.repeat_ratio,
+        early_end_ratio=args.early_end_ratio,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve synthetic place pages and reviews in place of google"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=default_port)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = from_arguments(args, args.host, args.port)
+    print(f"Serving synthetic places on {server.base_url}, e.g.")
+    print(place_link(1, server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats()))
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import os
+import threading
+import time
+from typing import Dict, Iterable, Optional, Sequence
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+try:
+    import h2  # noqa: F401  httpx needs it for http2
+    import httpx
+except ImportError:
+    httpx = None
+
+default_pool_maxsize = 32
+default_connect_timeout = 10
+default_read_timeout = 30
+default_stall_timeout = 60
+default_chunk_size = 64 * 1024
+default_google_base_url = "https://www.google.com"
+
+# Points the place and review requests somewhere else than google, e.g. to
+# the replay server
+google_base_url_env = "GOOGLE_BASE_URL"
+
+# Errors raised when the request never got a response
+network_errors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+if httpx is not None:
+    network_errors += (httpx.TransportError,)
+
+
+def get_google_base_url() -> str:
+    return os.getenv(google_base_url_env, default_google_base_url).rstrip("/")
+
+
+def rebase_url(url: str) -> str:
+    """Moves a google url to the base url, when it is overridden"""
+    base_url = os.getenv(google_base_url_env)
+    if not base_url:
+        return url
+    base = urlsplit(base_url)
+    parts = urlsplit(url)
+    return urlunsplit((base.scheme, base.netloc, parts.path, parts.query, ""))
+
+
+class StalledResponseError(requests.exceptions.Timeout):
+    """Raised when a response body keeps trickling in for longer than the
+    stall timeout. The read timeout only catches sockets that go silent."""
+
+
+class TransportStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.timeouts = 0
+        self.stalls = 0
+        self.bytes_received = 0
+        self.cut_short = 0
+        self.bytes_saved = 0
+
+    def add(self, name: str, value: int = 1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": max(self.requests - self.new_connections, 0),
+                "timeouts": self.timeouts,
+                "stalls": self.stalls,
+                "bytes_received": self.bytes_received,
+                "cut_short": self.cut_short,
+                "bytes_saved": self.bytes_saved,
+            }
+
+
+class _CountingAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools report every new connection"""
+
+    def __init__(self, stats: TransportStats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        stats = self.stats
+
+        class CountingHTTPConnectionPool(HTTPConnectionPool):
+            def _new_conn(self):
+                stats.add("new_connections")
+                return super()._new_conn()
+
+        class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+            def _new_conn(self):
+                stats.add("new_connections")
+                return super()._new_conn()
+
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+
+class Transport:
+    """
+    Keep-alive HTTP client shared by every scraper instance.
+
+    Uses a pooled requests.Session, or an httpx.Client when http2 is asked
+    for and httpx (with h2) is installed. Every request gets connect/read
+    timeouts, and the body must arrive within `stall_timeout` seconds.
+    """
+
+    def __init__(
+        self,
+        pool_maxsize: int = default_pool_maxsize,
+        http2: bool = False,
+        connect_timeout: float = default_connect_timeout,
+        read_timeout: float = default_read_timeout,
+        stall_timeout: Optional[float] = default_stall_timeout,
+    ):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.stall_timeout = stall_timeout
+        self.stats = TransportStats()
+        self.http2 = http2 and httpx is not None
+
+        if self.http2:
+            self._client = httpx.Client(
+                http2=True,
+                follow_redirects=True,
+                timeout=httpx.Timeout(
+                    read_timeout, connect=connect_timeout, pool=connect_timeout
+                ),
+                limits=httpx.Limits(
+                    max_connections=pool_maxsize,
+                    max_keepalive_connections=pool_maxsize,
+                ),
+            )
+        else:
+            self._client = requests.Session()
+            adapter = _CountingAdapter(
+                self.stats,
+                pool_connections=pool_maxsize,
+                pool_maxsize=pool_maxsize,
+            )
+            self._client.mount("https://", adapter)
+            self._client.mount("http://", adapter)
+
+    def _on_trace(self, event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            self.stats.add("new_connections")
+
+    def _check_stall(self, started_at: float, response):
+        if self.stall_timeout is None:
+            return
+        if time.monotonic() - started_at > self.stall_timeout:
+            response.close()
+            self.stats.add("stalls")
+            raise StalledResponseError(
+                f"Response body took more than {self.stall_timeout}s: "
+                f"{response.url}"
+            )
+
+    def get(self, url: str, until: Optional[Sequence[bytes]] = None, **kwargs):
+        """
+        GET `url`, returning a response with its body already read.
+
+        :param until: Markers to stop reading the body at. Once all of them
+        were read, in this order, the connection is closed and the body ends
+        with the last one. The response then has `cut_short` set and
+        `bytes_saved`, the bytes of the body that were not downloaded, when
+        the server sent a Content-Length.
+        """
+        self.stats.add("requests")
+        started_at = time.monotonic()
+        try:
+            if self.http2:
+                return self._get_httpx(url, started_at, until, **kwargs)
+            return self._get_requests(url, started_at, until, **kwargs)
+        except (requests.exceptions.Timeout, *self._httpx_timeouts()):
+            self.stats.add("timeouts")
+            raise
+
+    def _httpx_timeouts(self):
+        return (httpx.TimeoutException,) if httpx is not None else ()
+
+    def _read_body(self, response, chunks: Iterable[bytes], started_at, until):
+        body = bytearray()
+        markers = list(until or ())
+        # Where the next marker may start, markers can straddle two chunks
+        position = 0
+        for chunk in chunks:
+            body += chunk
+            self._check_stall(started_at, response)
+            while markers:
+                found = body.find(markers[0], position)
+                if found == -1:
+                    position = max(position, len(body) - len(markers[0]) + 1)
+                    break
+                position = found + len(markers.pop(0))
+            if until and not markers:
+                del body[position:]
+                response.cut_short = True
+                break
+        else:
+            response.cut_short = False
+        response._content = bytes(body)
+        self.stats.add("bytes_received", len(body))
+        return response
+
+    def _record_cut_short(self, response, wire_bytes: int):
+        response.bytes_saved = None
+        if not response.cut_short:
+            return
+        self.stats.add("cut_short")
+        length = response.headers.get("Content-Length")
+        if length and length.isdigit():
+            response.bytes_saved = max(int(length) - wire_bytes, 0)
+            self.stats.add("bytes_saved", response.bytes_saved)
+
+    def _get_requests(self, url, started_at, until, **kwargs):
+        response = self._client.get(
+            url,
+            timeout=(self.connect_timeout, self.read_timeout),
+            stream=True,
+            **kwargs,
+        )
+        self._read_body(
+            response, response.iter_content(default_chunk_size), started_at, until
+        )
+        # The body is fully read, so the connection is already back in the
+        # pool, unless it was cut short and has to be dropped
+        wire_bytes = response.raw.tell()
+        if response.cut_short:
+            response.close()
+        self._record_cut_short(response, wire_bytes)
+        return response
+
+    def _get_httpx(self, url, started_at, until, **kwargs):
+        request = self._client.build_request(
+            "GET", url, extensions={"trace": self._on_trace}, **kwargs
+        )
+        response = self._client.send(request, stream=True)
+        try:
+            self._read_body(
+                response, response.iter_bytes(default_chunk_size), started_at, until
+            )
+        finally:
+            response.close()
+        self._record_cut_short(response, response.num_bytes_downloaded)
+        return response
+
+    def close(self):
+        self._client.close()
+
+
+_transport: Optional[Transport] = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> Transport:
+    """Returns the process wide transport, creating it on first use"""
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = Transport()
+        return _transport
+
+
+def set_transport(transport: Transport):
+    """Replaces the process wide transport, e.g. to turn on http2"""
+    global _transport
+    with _transport_lock:
+        previous = _transport
+        _transport = transport
+    if previous is not None and previous is not transport:
+        previous.close()
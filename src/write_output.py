@@ -1,4 +1,5 @@
 import os
+import threading
 from datetime import datetime
 
 from botasaurus import bt
@@ -12,7 +13,58 @@ import pandas as pd
 import io
 from google.cloud import storage
 
-STORAGE_CLIENT = storage.Client()
+_storage_client = None
+_storage_client_lock = threading.Lock()
+
+
+def get_storage_client():
+    """Returns the process wide storage client, creating it on first use
+    since creating it looks up the credentials"""
+    global _storage_client
+    with _storage_client_lock:
+        if _storage_client is None:
+            _storage_client = storage.Client()
+        return _storage_client
+
+
+def set_storage_client(storage_client):
+    """Replaces the process wide storage client, e.g. with a
+    LocalStorageClient"""
+    global _storage_client
+    with _storage_client_lock:
+        _storage_client = storage_client
+
+
+class LocalBlob:
+    def __init__(self, path: str):
+        self.path = path
+
+    def upload_from_file(self, file, content_type=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = file.read()
+        mode = "w" if isinstance(data, str) else "wb"
+        with open(self.path, mode) as out:
+            out.write(data)
+
+
+class LocalBucket:
+    def __init__(self, path: str):
+        self.path = path
+
+    def blob(self, blob_name: str) -> LocalBlob:
+        return LocalBlob(os.path.join(self.path, blob_name))
+
+
+class LocalStorageClient:
+    """Stands in for the storage client, writing the blobs under
+    `directory`/<bucket name>/"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def bucket(self, bucket_name: str) -> LocalBucket:
+        return LocalBucket(os.path.join(self.directory, bucket_name))
+
 
 def can_create_places_csv(selected_fields):
     return True
@@ -181,7 +233,7 @@ def upload_df_to_gcs(data, bucket_name, dest_blob_name, file_format='parquet') -
     else:
         raise ValueError("Unsupported file format. Use 'parquet' or 'jsonl'.")
 
-    bucket = STORAGE_CLIENT.bucket(bucket_name)
+    bucket = get_storage_client().bucket(bucket_name)
     blob = bucket.blob(dest_blob_name)
 
     buffer.seek(0)
@@ -0,0 +1,32 @@
+import pytest
+
+from src import rate_limiter, retry_policy
+from src.synthetic_server import SyntheticServer
+from src.transport import google_base_url_env
+
+
+@pytest.fixture(scope="session")
+def synthetic_server():
+    """Synthetic google serving places with 15 to 60 reviews"""
+    server = SyntheticServer(
+        port=0, min_reviews=15, max_reviews=60, page_padding=4 * 1024
+    )
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def google(synthetic_server, monkeypatch):
+    """Points the place and review requests at the synthetic server, with
+    fresh rate limiter and circuit breakers"""
+    monkeypatch.setenv(google_base_url_env, synthetic_server.base_url)
+    monkeypatch.setattr(
+        rate_limiter,
+        "_rate_limiter",
+        rate_limiter.AdaptiveRateLimiter(initial_rate=1000, max_rate=1000),
+    )
+    monkeypatch.setattr(retry_policy, "_retry_policy", retry_policy.RetryPolicy())
+    monkeypatch.setattr(retry_policy, "_retry_queue", retry_policy.RetryQueue())
+    return synthetic_server
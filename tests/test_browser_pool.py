@@ -0,0 +1,100 @@
+import itertools
+import threading
+import time
+
+from src import browser_pool
+from src.browser_pool import BrowserPool
+
+
+class FakeTask:
+    """Browser task whose instances fail when two searches call them at
+    once, with strings for drivers"""
+
+    def __init__(self):
+        self.options = {"create_driver": self.create_driver}
+        self.instances = []
+        self.closed = []
+        self.drivers = itertools.count()
+
+    def create_driver(self, data, options, desired_capabilities):
+        return f"chrome-{next(self.drivers)}"
+
+    def create_instance(self, create_driver):
+        instance = FakeInstance(self, create_driver)
+        self.instances.append(instance)
+        return instance
+
+
+class FakeInstance:
+    def __init__(self, task, create_driver):
+        self.task = task
+        self.create_driver = create_driver
+        self.driver = None
+        self.busy = threading.Lock()
+
+    def __call__(self, data, metadata=None):
+        assert self.busy.acquire(blocking=False), "instance called concurrently"
+        try:
+            if self.driver is None:
+                self.driver = self.create_driver(data, None, None)
+            time.sleep(0.01)
+            return {"query": data, "driver": self.driver}
+        finally:
+            self.busy.release()
+
+    def close(self):
+        self.task.closed.append(self.driver)
+        self.driver = None
+
+
+def test_searches_never_share_an_instance():
+    task = FakeTask()
+    pool = BrowserPool(drivers=3)
+
+    results = list(pool.map(task, range(12), metadata={"cache": False}))
+
+    assert [result["query"] for result in results] == list(range(12))
+    assert len(task.instances) == 3
+    # Every instance kept its Chrome
+    assert {result["driver"] for result in results} == {
+        "chrome-0",
+        "chrome-1",
+        "chrome-2",
+    }
+    assert pool.stats()["searches"] == 12
+
+
+def test_map_searches_at_most_drivers_items_ahead():
+    task = FakeTask()
+    pool = BrowserPool(drivers=2)
+    taken = []
+
+    def items():
+        for item in range(10):
+            taken.append(item)
+            yield item
+
+    results = pool.map(task, items())
+    assert next(results)["query"] == 0
+    assert len(taken) <= 3
+    assert [result["query"] for result in results] == list(range(1, 10))
+
+
+def test_chromes_over_the_cap_are_closed(monkeypatch):
+    task = FakeTask()
+    pool = BrowserPool(drivers=1, memory_mb=1000)
+    memory = {"chrome-0": 1500.0, "chrome-1": 500.0}
+    monkeypatch.setattr(browser_pool, "chrome_memory_mb", memory.get)
+
+    first = pool.search(task, "cafes")
+    second = pool.search(task, "bars")
+    third = pool.search(task, "pubs")
+
+    assert first["driver"] == "chrome-0"
+    assert second["driver"] == third["driver"] == "chrome-1"
+    assert task.closed == ["chrome-0"]
+    assert pool.stats()["recycled"] == 1
+    assert pool.stats()["peak_mb"] == 1500
+
+    pool.close()
+    assert task.closed == ["chrome-0", "chrome-1"]
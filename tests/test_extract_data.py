@@ -0,0 +1,33 @@
+import json
+
+from src.extract_data import (
+    decode_place_payload,
+    initialization_state_end,
+    initialization_state_start,
+)
+
+
+def place_page(state):
+    return (
+        f"<script>{initialization_state_start}{json.dumps(state)}"
+        f"{initialization_state_end}={{}};</script>"
+    )
+
+
+def payload_string(payload):
+    return ")]}'\n" + json.dumps(payload)
+
+
+def test_payload_is_decoded_from_the_state():
+    payload = [None, "0x1", None, None, None, None, ["Place", [4.5, 10]]]
+    state = [None, None, None, [None] * 6 + [payload_string(payload)]]
+
+    assert decode_place_payload(place_page(state)) == payload
+
+
+def test_decoy_payload_earlier_in_the_state_is_skipped():
+    payload = [None, "0x1", None, None, None, None, ["Place", [4.5, 10]]]
+    decoy = [None, "0x2", None, None, None, None, ["Decoy", [1.0, 1]]]
+    state = [payload_string(decoy), None, None, [None] * 6 + [payload_string(payload)]]
+
+    assert decode_place_payload(place_page(state)) == payload
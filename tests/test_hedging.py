@@ -0,0 +1,77 @@
+import time
+
+from src import hedging, rate_limiter, scraper
+from src.hedging import HedgedFetcher, latency_percentile
+from src.synthetic_server import place_link
+
+
+def test_latency_percentile():
+    assert latency_percentile([], 99) is None
+    assert latency_percentile([3, 1, 2, 5, 4], 50) == 3
+    assert latency_percentile([3, 1, 2, 5, 4], 99) == 5
+
+
+def test_slow_request_is_hedged_and_the_first_answer_kept():
+    hedger = HedgedFetcher(percentile=50, max_hedge_ratio=1, min_samples=5)
+    for _ in range(5):
+        assert hedger.fetch(lambda: "fast") == "fast"
+
+    def slow():
+        time.sleep(0.2)
+        return "slow"
+
+    assert hedger.fetch(slow, hedge=lambda: "hedge") == "hedge"
+    # The latency of the first request is only known once it answers
+    time.sleep(0.3)
+    stats = hedger.stats()
+    assert stats["hedges"] == 1
+    assert stats["hedge_wins"] == 1
+    assert stats["p99"] < stats["p99_without_hedging"]
+
+
+def test_hedges_are_capped():
+    hedger = HedgedFetcher(percentile=50, max_hedge_ratio=0.1, min_samples=1)
+    for _ in range(10):
+        hedger.fetch(lambda: None)
+
+    def slow():
+        time.sleep(0.05)
+        return "slow"
+
+    results = [hedger.fetch(slow, hedge=lambda: "hedge") for _ in range(9)]
+    assert results.count("hedge") == 1
+    assert hedger.stats()["hedges"] == 1
+
+
+def test_failed_request_falls_back_to_the_hedge():
+    hedger = HedgedFetcher(percentile=50, max_hedge_ratio=1, min_samples=1)
+    hedger.fetch(lambda: None)
+
+    def failing():
+        time.sleep(0.05)
+        raise ConnectionError()
+
+    assert hedger.fetch(failing, hedge=lambda: "hedge") == "hedge"
+
+
+def test_stats_are_printed(capsys):
+    hedger = HedgedFetcher(stats_interval=0)
+    hedger.fetch(lambda: None)
+    assert "Hedged requests:" in capsys.readouterr().out
+
+
+def test_rate_limiter_wait_is_not_hedged_latency(google, monkeypatch):
+    monkeypatch.setenv(scraper.place_streaming_env, "1")
+    # Two place pages a second, the others queue at the limiter
+    limiter = rate_limiter.AdaptiveRateLimiter(initial_rate=2, max_rate=2)
+    monkeypatch.setattr(rate_limiter, "_rate_limiter", limiter)
+    hedger = HedgedFetcher(min_samples=100)
+    monkeypatch.setattr(hedging, "_hedger", hedger)
+    monkeypatch.setattr(hedging, "_hedger_created", True)
+
+    scrape_place_obj = scraper.scrape_place(metadata={"cache": False})
+    scrape_place_obj.put([place_link(index) for index in range(5)])
+    assert None not in scrape_place_obj.get()
+
+    assert limiter.stats()[google.base_url.split("//")[1]]["requests"] == 5
+    assert hedger.stats()["p99_without_hedging"] < 0.4
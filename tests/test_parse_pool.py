@@ -0,0 +1,73 @@
+import json
+
+import pytest
+import requests
+
+from src.extract_data import extract_place_page, place_path_tree
+from src.parse_pool import ParsePool
+from src.reviews_scraper import GoogleMapsAPIScraper
+from src.synthetic_server import place_link
+
+feature_id_of = GoogleMapsAPIScraper._parse_url_to_feature_id
+
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = ParsePool(1)
+    yield pool
+    pool.close()
+
+
+# Dates worked out from the time the page is parsed
+parse_time_keys = ("retrieval_date", "text_date", "response_text_date")
+
+
+def comparable(value):
+    # NaN fields would differ from themselves
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def without_parse_time(reviews):
+    return [
+        {key: value for key, value in review.items() if key not in parse_time_keys}
+        for review in reviews
+    ]
+
+
+def place_page(server, index):
+    link = place_link(index, server.base_url)
+    return link, requests.get(link)
+
+
+def test_place_is_parsed_as_inline(google, pool):
+    for index in range(3):
+        link, response = place_page(google, index)
+        assert comparable(pool.place(response, link, None)) == comparable(
+            extract_place_page(response.text, link)
+        )
+    assert pool.stats()["place_pages"] >= 3
+
+
+def test_review_page_is_parsed_as_inline(google, pool):
+    scraper = GoogleMapsAPIScraper()
+    query = scraper._build_query(feature_id_of(None, place_link(0)), "en")
+    response = scraper._fetch(query)
+    _, token = scraper._peek_pagination(response.content)
+
+    reviews = pool.review_page(response, "en", token, scraper.review_parser)
+    assert reviews
+    assert without_parse_time(reviews) == without_parse_time(
+        scraper._parse_page(response, "en", token)
+    )
+    assert pool.stats()["review_pages"] >= 1
+
+
+def test_path_counts_are_merged_back(google, pool):
+    link, response = place_page(google, 4)
+    place_path_tree.reset_stats()
+    extract_place_page(response.text, link)
+    inline_counts = place_path_tree.take_counts()
+
+    pool.place(response, link, None)
+    assert place_path_tree.take_counts() == inline_counts
+    assert any(inline_counts[0])
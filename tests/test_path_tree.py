@@ -0,0 +1,107 @@
+import copy
+import random
+
+import pytest
+import requests
+
+from src.extract_data import decode_place_payload, place_paths, safe_get
+from src.path_tree import PathTree
+from src.synthetic_server import place_link
+
+
+@pytest.fixture(scope="module")
+def payloads(synthetic_server):
+    """Payloads of place pages of the synthetic server"""
+    return [
+        decode_place_payload(
+            requests.get(place_link(index, synthetic_server.base_url)).text
+        )
+        for index in range(20)
+    ]
+
+
+def damaged(payload, seed):
+    """Payload with some of its lists cut short or replaced, as when google
+    moves things around"""
+    payload = copy.deepcopy(payload)
+    generator = random.Random(seed)
+    for path in generator.sample(sorted(place_paths.values()), 10):
+        depth = generator.randrange(len(path))
+        parent = safe_get(payload, *path[:depth])
+        if isinstance(parent, list) and len(parent) > path[depth]:
+            if generator.random() < 0.5:
+                del parent[path[depth]:]
+            else:
+                parent[path[depth]] = "moved"
+    return payload
+
+
+def walked(paths, data):
+    """Every path walked on its own, as the extractors used to"""
+    return {name: safe_get(data, *path) for name, path in paths.items()}
+
+
+def test_resolves_every_path_like_safe_get(payloads):
+    tree = PathTree(place_paths)
+    for seed, payload in enumerate(payloads):
+        for data in (payload, damaged(payload, seed)):
+            assert tree.resolve(data) == walked(place_paths, data)
+    assert any(tree.miss_rates().values())
+
+
+def test_resolver_of_some_paths(payloads):
+    tree = PathTree(place_paths)
+    names = ["hours", "place_id", "latitude", "images"]
+    resolve = tree.resolver(names)
+    assert tree.resolver(reversed(names)) is resolve
+    paths = {name: place_paths[name] for name in names}
+    for seed, payload in enumerate(payloads):
+        data = damaged(payload, seed)
+        assert resolve(data) == walked(paths, data)
+
+
+def test_paths_sharing_a_prefix():
+    tree = PathTree(
+        {"a": (0, 1), "b": (0, 1, 2), "c": (0, 2, "x", 0), "d": (), "e": (1,)}
+    )
+    data = [[None, [0, 1, 2], {"x": ["y"]}], "z"]
+    assert tree.resolve(data) == {
+        "a": [0, 1, 2],
+        "b": 2,
+        "c": "y",
+        "d": data,
+        "e": "z",
+    }
+    assert tree.resolve([[None, 5]]) == {
+        "a": 5,
+        "b": None,
+        "c": None,
+        "d": [[None, 5]],
+        "e": None,
+    }
+
+
+def test_misses_are_counted_per_path():
+    tree = PathTree({"a": (0, 0), "b": (0, 1, 0), "c": (1,)})
+    tree.resolve([[1, [2]], 3])
+    tree.resolve([[1]])
+    tree.resolve(None)
+    tree.resolver(["c"])([])
+
+    assert tree.stats() == {
+        "a": {"lookups": 3, "misses": 1, "miss_rate": 0.3333},
+        "b": {"lookups": 3, "misses": 2, "miss_rate": 0.6667},
+        "c": {"lookups": 4, "misses": 3, "miss_rate": 0.75},
+    }
+    assert list(tree.miss_rates(0.5)) == ["c", "b"]
+
+
+def test_counts_move_between_trees():
+    worker = PathTree({"a": (0,), "b": (1,)})
+    main = PathTree({"a": (0,), "b": (1,)})
+    worker.resolve([1])
+    main.add_counts(*worker.take_counts())
+    main.resolve([1, 2])
+
+    assert worker.stats()["b"] == {"lookups": 0, "misses": 0, "miss_rate": None}
+    assert main.stats()["b"] == {"lookups": 2, "misses": 1, "miss_rate": 0.5}
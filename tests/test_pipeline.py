@@ -0,0 +1,137 @@
+import asyncio
+import threading
+import time
+
+from src import scraper
+from src.async_reviews_scraper import EventLoopThread
+from src.pipeline import Pipeline, Stage
+
+
+def collect(results):
+    def output(item, emit):
+        results.append(item)
+
+    return output
+
+
+def test_items_go_through_every_stage():
+    results = []
+    pipeline = Pipeline(
+        [
+            Stage("double", lambda item, emit: emit(item * 2), workers=3),
+            Stage("split", lambda item, emit: [emit(item), emit(item + 1)]),
+            Stage("output", collect(results)),
+        ]
+    )
+    with pipeline:
+        for item in range(10):
+            pipeline.put(item)
+
+    assert sorted(results) == sorted(
+        value for item in range(10) for value in (item * 2, item * 2 + 1)
+    )
+    assert pipeline.stats()["double"]["done"] == 10
+    assert pipeline.stats()["output"]["done"] == 20
+
+
+def test_slow_stage_holds_back_the_former_ones():
+    results = []
+
+    def slow(item, emit):
+        time.sleep(0.01)
+        results.append(item)
+
+    pipeline = Pipeline(
+        [
+            Stage("fast", lambda item, emit: emit(item), queue_size=2),
+            Stage("slow", slow, queue_size=2),
+        ]
+    )
+    with pipeline:
+        for item in range(20):
+            pipeline.put(item)
+
+    assert results == list(range(20))
+    for stats in pipeline.stats().values():
+        assert stats["peak_queued"] <= 2
+
+
+def test_failing_stage_drops_its_items_and_shuts_down():
+    results = []
+    failures = []
+
+    def fail_on_odd(item, emit):
+        if item % 2:
+            raise ValueError(item)
+        emit(item)
+
+    pipeline = Pipeline(
+        [
+            Stage(
+                "fail",
+                fail_on_odd,
+                workers=2,
+                on_failure=lambda item, error: failures.append((item, error)),
+            ),
+            Stage("output", collect(results)),
+        ]
+    )
+
+    def run():
+        with pipeline:
+            for item in range(10):
+                pipeline.put(item)
+
+    running = threading.Thread(target=run)
+    running.start()
+    running.join(10)
+
+    assert not running.is_alive()
+    assert sorted(results) == [0, 2, 4, 6, 8]
+    assert sorted(item for item, error in failures) == [1, 3, 5, 7, 9]
+    assert all(isinstance(error, ValueError) for item, error in failures)
+    assert pipeline.stats()["fail"]["failed"] == 5
+    assert pipeline.stats()["fail"]["busy"] == 0
+    for stage in pipeline.stages:
+        assert not any(thread.is_alive() for thread in stage._threads)
+
+
+def test_workers_get_tasks_of_their_own():
+    tasks = []
+    # Every worker takes one of every three items
+    barrier = threading.Barrier(3)
+
+    def take_task(item, emit):
+        tasks.append(scraper.thread_task(scraper.scrape_reviews))
+        barrier.wait(10)
+        tasks.append(scraper.thread_task(scraper.scrape_reviews))
+
+    with Pipeline([Stage("reviews", take_task, workers=3)]) as pipeline:
+        for item in range(6):
+            pipeline.put(item)
+
+    assert len(set(tasks)) == 3
+    assert scraper.scrape_reviews not in tasks
+
+
+def test_threads_share_the_event_loop():
+    loops = []
+
+    async def current_loop():
+        await asyncio.sleep(0.01)
+        return asyncio.get_running_loop()
+
+    event_loop = EventLoopThread()
+
+    def run():
+        loops.append(event_loop.run(current_loop()))
+
+    with event_loop:
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert loops == [event_loop.loop] * 4
+    assert event_loop.loop.is_closed()
@@ -0,0 +1,94 @@
+import socket
+from types import SimpleNamespace
+
+from src import rate_limiter, scraper
+from src.rate_limiter import AdaptiveRateLimiter, TokenBucket, is_throttled
+from src.retry_policy import RetryQueue
+from src.synthetic_server import place_link
+
+host = "www.google.com"
+
+
+def response(status_code=200, content=b")]}'\n[]", headers=None):
+    return SimpleNamespace(
+        status_code=status_code, content=content, headers=headers or {}
+    )
+
+
+def test_throttling_responses():
+    assert not is_throttled(response())
+    assert is_throttled(response(429))
+    assert is_throttled(response(503))
+    assert is_throttled(response(content=b"  "))
+    assert is_throttled(response(content=b"<form id='captcha-form'>"))
+    assert not is_throttled(response(404, content=b""))
+
+
+def test_client_errors_leave_the_rate_alone():
+    limiter = AdaptiveRateLimiter(initial_rate=5, increase=1)
+    for status_code in (400, 403, 404):
+        assert not limiter.on_response(host, response(status_code))
+    stats = limiter.stats()[host]
+    assert stats["rate"] == 5
+    assert stats["throttled"] == 0
+
+
+def test_rate_grows_with_healthy_responses():
+    limiter = AdaptiveRateLimiter(initial_rate=5, increase=1, max_rate=7)
+    for _ in range(3):
+        assert not limiter.on_response(host, response())
+    assert limiter.stats()[host]["rate"] == 7
+
+
+def test_rate_halved_once_per_throttling_episode():
+    limiter = AdaptiveRateLimiter(initial_rate=8, decrease_cooldown=60)
+    assert limiter.on_response(host, response(429))
+    assert limiter.on_response(host, response(429))
+    limiter.on_error(host)
+    stats = limiter.stats()[host]
+    assert stats["rate"] == 4
+    assert stats["throttled"] == 3
+    assert stats["errors"] == 1
+
+
+def test_retry_after_pauses_the_host():
+    limiter = AdaptiveRateLimiter()
+    limiter.on_response(host, response(429, headers={"Retry-After": "30"}))
+    bucket = limiter._host(host).bucket
+    assert bucket.paused_until - bucket.last_decrease >= 29
+
+
+def test_bucket_queues_callers_past_its_burst():
+    bucket = TokenBucket(rate=100, capacity=2)
+    waits = [bucket.acquire() for _ in range(4)]
+    assert waits[:2] == [0.0, 0.0]
+    assert 0 < waits[2] <= 0.011
+    assert 0 < waits[3] <= 0.011
+
+
+def test_history_is_printed(capsys):
+    limiter = AdaptiveRateLimiter(initial_rate=1000, stats_interval=0)
+    limiter.acquire(host)
+    assert limiter.history[0]["host"] == host
+    assert "Rate limiter:" in capsys.readouterr().out
+
+
+def test_network_errors_of_place_pages_slow_down(monkeypatch):
+    # Nothing listens on that port
+    with socket.socket() as free:
+        free.bind(("127.0.0.1", 0))
+        port = free.getsockname()[1]
+    monkeypatch.setenv("GOOGLE_BASE_URL", f"http://127.0.0.1:{port}")
+    monkeypatch.setenv(scraper.place_streaming_env, "1")
+    limiter = rate_limiter.AdaptiveRateLimiter(initial_rate=1000)
+    monkeypatch.setattr(rate_limiter, "_rate_limiter", limiter)
+    queue = RetryQueue(max_attempts=0)
+    monkeypatch.setattr("src.retry_policy._retry_queue", queue)
+
+    scrape_place_obj = scraper.scrape_place(metadata={"cache": False})
+    scrape_place_obj.put([place_link(0)])
+
+    assert scrape_place_obj.get() == [None]
+    stats = limiter.stats()[f"127.0.0.1:{port}"]
+    assert stats["errors"] == 1
+    assert stats["rate"] == 500
@@ -0,0 +1,22 @@
+import os
+
+from src.replay import fixture_key, record_dir_env
+from src.reviews_scraper import GoogleMapsAPIScraper
+from src.synthetic_server import place_link
+
+feature_id_of = GoogleMapsAPIScraper._parse_url_to_feature_id
+
+
+def test_only_pages_served_fine_are_recorded(google, tmp_path, monkeypatch):
+    monkeypatch.setenv(record_dir_env, str(tmp_path))
+    scraper = GoogleMapsAPIScraper()
+    page = scraper._build_query(feature_id_of(None, place_link(0)), "en")
+    missing = f"{google.base_url}/nothing"
+
+    assert scraper._fetch(page).status_code == 200
+    assert scraper._fetch(missing).status_code == 404
+
+    assert sorted(os.listdir(tmp_path)) == [
+        f"{fixture_key(page)}.body",
+        f"{fixture_key(page)}.json",
+    ]
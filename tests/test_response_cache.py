@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+from src import response_cache
+from src.response_cache import ResponseCache, cached_response, page_cache_key
+from src.reviews_scraper import GoogleMapsAPIScraper, review_node_regex
+from src.synthetic_server import place_link
+
+feature_id_of = GoogleMapsAPIScraper._parse_url_to_feature_id
+
+
+# A page whose reviews google left out
+page_without_reviews = (
+    b'<div><div data-google-review-count="10" data-next-page-token="p1"></div></div>'
+)
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = ResponseCache(str(tmp_path / "pages.db"))
+    monkeypatch.setattr(response_cache, "_response_cache", cache)
+    monkeypatch.setattr(response_cache, "_response_cache_created", True)
+    return cache
+
+
+def scrape(link, n_reviews, sort_by, **kwargs):
+    with GoogleMapsAPIScraper(retry_time=0, **kwargs) as scraper:
+        return scraper.scrape_reviews(link, n_reviews, "en", sort_by)
+
+
+@pytest.mark.parametrize("pipeline", [True, False])
+def test_page_is_cached_once_it_parsed(google, cache, pipeline):
+    link = place_link(4)
+    feature_id = feature_id_of(None, link)
+    n_reviews = google.site.get_place(feature_id).review_count
+
+    with GoogleMapsAPIScraper(pipeline=pipeline, retry_time=0) as scraper:
+        fetch = scraper._fetch
+        broken = []
+
+        def fetch_once_broken(query):
+            response = fetch(query)
+            if broken:
+                return response
+            broken.append(query)
+            return cached_response(query, page_without_reviews, "utf-8")
+
+        scraper._fetch = fetch_once_broken
+        reviews = scraper.scrape_reviews(link, n_reviews, "en", "most_relevant")
+
+    assert len(broken) == 1
+    assert len(reviews) == n_reviews
+    content, _ = cache.get(page_cache_key(feature_id, "en", "qualityScore", ""))
+    assert review_node_regex.search(content)
+
+
+def test_first_page_of_the_newest_reviews_is_not_cached(google, cache):
+    link = place_link(7)
+    n_reviews = google.site.get_place(feature_id_of(None, link)).review_count
+    n_pages = -(-n_reviews // 10)
+
+    for sort_by, requested_again in [("newest", 1), ("most_relevant", 0)]:
+        scrape(link, n_reviews, sort_by)
+        pages_before = google.stats()["review_pages"]
+        assert len(scrape(link, n_reviews, sort_by)) == n_reviews
+        assert google.stats()["review_pages"] - pages_before == requested_again
+
+    assert cache.stats()["entries"] == 2 * n_pages - 1
+
+
+def test_size_is_only_read_to_evict(tmp_path, monkeypatch):
+    cache = ResponseCache(str(tmp_path / "pages.db"), max_bytes=20 * 1024)
+    reads = []
+    evict = cache._evict
+
+    def counted_evict():
+        reads.append(cache._size)
+        evict()
+
+    monkeypatch.setattr(cache, "_evict", counted_evict)
+    for index in range(10):
+        cache.put(f"page-{index}", os.urandom(1024), "utf-8")
+    # Only the first put reads the size
+    assert reads == [None]
+
+    for index in range(10, 20):
+        cache.put(f"page-{index}", os.urandom(1024), "utf-8")
+    stats = cache.stats()
+    assert len(reads) > 1
+    assert stats["evictions"] > 0
+    assert stats["size"] <= cache.max_bytes
+    assert cache.get("page-19") is not None
@@ -0,0 +1,114 @@
+import os
+import time
+
+import pytest
+from botasaurus.cache import DontCache
+
+from src import result_cache
+from src.result_cache import ResultCache, cached
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(str(tmp_path / "results.db"))
+
+
+def put(cache, key, result, ttl=None):
+    cache.put("scrape", "v1", key, result, ttl)
+
+
+def test_result_round_trip(cache):
+    put(cache, "a", {"place_id": "0x1", "reviews": [{"rating": 5}]})
+    assert cache.get("scrape", "a") == {"place_id": "0x1", "reviews": [{"rating": 5}]}
+    assert cache.get("scrape", "b") is None
+    assert cache.stats()["scrape"]["hits"] == 1
+    assert cache.stats()["scrape"]["misses"] == 1
+
+
+def test_expired_results_are_misses(cache):
+    put(cache, "short", 1, ttl=0.05)
+    put(cache, "long", 2, ttl=60)
+    put(cache, "forever", 3)
+    time.sleep(0.1)
+    assert cache.get("scrape", "short") is None
+    assert cache.get("scrape", "long") == 2
+    assert cache.get("scrape", "forever") == 3
+    assert cache.stats()["scrape"]["entries"] == 2
+
+
+def test_least_recently_used_results_are_evicted(cache):
+    results = {key: os.urandom(200).hex() for key in "abcd"}
+    for key, result in results.items():
+        put(cache, key, result)
+        time.sleep(0.01)
+    cache.get("scrape", "a")
+    size = cache.stats()["scrape"]["size"]
+    # Room for about three of them
+    cache.max_bytes = size * 3 // 4 + 10
+    put(cache, "e", os.urandom(200).hex())
+
+    assert cache.get("scrape", "b") is None
+    assert cache.get("scrape", "a") == results["a"]
+    assert cache.get("scrape", "e") is not None
+    assert cache.stats()["scrape"]["size"] <= cache.max_bytes
+
+
+def test_expired_results_are_evicted_first(cache):
+    put(cache, "expired", os.urandom(200).hex(), ttl=0.01)
+    time.sleep(0.02)
+    put(cache, "a", os.urandom(200).hex())
+    cache.max_bytes = cache.stats()["scrape"]["size"] - 1
+    put(cache, "b", "b")
+    assert cache.get("scrape", "a") is not None
+    assert cache.stats()["scrape"]["entries"] == 2
+
+
+def test_size_is_only_read_to_evict(cache, monkeypatch):
+    reads = []
+    evict = cache._evict
+
+    def counted_evict():
+        reads.append(cache._size)
+        evict()
+
+    monkeypatch.setattr(cache, "_evict", counted_evict)
+    for key in "abcd":
+        put(cache, key, os.urandom(200).hex())
+    # Only the first put reads the size
+    assert reads == [None]
+
+    cache.max_bytes = cache.stats()["scrape"]["size"]
+    put(cache, "e", os.urandom(200).hex())
+    assert len(reads) == 2
+    assert cache.stats()["scrape"]["size"] <= cache.max_bytes
+
+
+def test_unreadable_result_is_a_miss(cache, monkeypatch):
+    put(cache, "zstd", "result")
+    put(cache, "truncated", "result")
+    db = cache._connection()
+    with db:
+        db.execute("UPDATE results SET codec = 'zstd' WHERE key = 'zstd'")
+        db.execute("UPDATE results SET body = x'0102' WHERE key = 'truncated'")
+    assert cache.get("scrape", "truncated") is None
+    # As where zstandard is not installed
+    monkeypatch.setattr(result_cache, "zstandard", None)
+    assert cache.get("scrape", "zstd") is None
+    assert "scrape" not in cache.stats()
+
+
+def test_cached_function(cache, monkeypatch):
+    monkeypatch.setattr(result_cache, "_result_cache", cache)
+    calls = []
+
+    @cached(ttl=60)
+    def scrape(driver, data):
+        calls.append(data)
+        return DontCache({"failed": data}) if data == "broken" else {"ok": data}
+
+    assert scrape(None, "a", {"cache": True}) == {"ok": "a"}
+    assert scrape(None, "a", {"cache": True}) == {"ok": "a"}
+    assert scrape(None, "a") == {"ok": "a"}
+    scrape(None, "broken", {"cache": True})
+    scrape(None, "broken", {"cache": True})
+    assert calls == ["a", "a", "broken", "broken"]
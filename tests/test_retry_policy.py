@@ -0,0 +1,144 @@
+import time
+
+import pytest
+import requests
+
+from src import scraper
+from src.rate_limiter import ThrottledError
+from src.retry_policy import (
+    CircuitBreaker,
+    PlaceCircuitOpenError,
+    RetryPolicy,
+    RetryQueue,
+    is_outage_error,
+)
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(response=response)
+
+
+def test_outage_errors():
+    assert is_outage_error(ThrottledError())
+    assert is_outage_error(requests.exceptions.ConnectionError())
+    assert is_outage_error(http_error(503))
+    assert not is_outage_error(http_error(404))
+    assert not is_outage_error(KeyError())
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    assert not breaker.record_failure()
+    assert not breaker.record_failure()
+    assert breaker.record_failure()
+    assert breaker.is_open
+    # Requests that were in flight don't open it again
+    assert not breaker.record_failure()
+    breaker.record_success()
+    assert not breaker.is_open
+    assert not breaker.record_failure()
+
+
+def test_breaker_backs_off_when_failing_after_the_pause():
+    breaker = CircuitBreaker(1, reset_timeout=0.01, max_reset_timeout=0.03)
+    assert breaker.record_failure()
+    time.sleep(0.02)
+    assert breaker.record_failure()
+    assert breaker.reset_timeout == 0.02
+    time.sleep(0.03)
+    assert breaker.record_failure()
+    assert breaker.reset_timeout == 0.03
+    breaker.record_success()
+    assert breaker.reset_timeout == 0.01
+
+
+def test_policy_gives_up_on_a_broken_place():
+    policy = RetryPolicy(place_failure_threshold=2, outage_failure_threshold=2)
+    policy.record_failure("0x1", KeyError())
+    policy.check_place("0x1")
+    policy.record_failure("0x1", KeyError())
+    with pytest.raises(PlaceCircuitOpenError):
+        policy.check_place("0x1")
+    # A 404 won't go away by asking again
+    policy.record_failure("0x2", http_error(404))
+    assert policy.is_place_open("0x2")
+    assert policy.outage_delay() == 0
+
+
+def test_policy_pauses_everyone_on_outages():
+    policy = RetryPolicy(outage_failure_threshold=2, outage_pause=60)
+    policy.record_failure("0x1", ThrottledError())
+    policy.record_failure("0x2", ThrottledError())
+    assert policy.outage_delay() > 59
+    assert not policy.is_place_open("0x1")
+
+
+def test_queue_returns_due_keys_in_order():
+    queue = RetryQueue(base_delay=0.01, max_delay=0.01)
+    for key in ["c", "a", "b"]:
+        queue.schedule(key)
+    time.sleep(0.02)
+    assert queue.pop_due(["a", "b", "c", "a"]) == ["a", "b", "c"]
+    assert queue.pop_due(["a", "b", "c"]) == []
+
+
+def test_queue_waits_for_the_earliest_retry():
+    queue = RetryQueue(base_delay=0.05, max_delay=0.05)
+    queue.schedule("a")
+    started_at = time.monotonic()
+    assert queue.pop_due(["a"]) == ["a"]
+    assert time.monotonic() - started_at <= 0.1
+    assert queue.pop_due(["b"]) == []
+
+
+def test_queue_gives_up_after_max_attempts():
+    queue = RetryQueue(max_attempts=2, base_delay=0, max_delay=0)
+    assert queue.schedule("a") is not None
+    assert queue.schedule("a") is not None
+    assert queue.schedule("a") is None
+    queue.schedule("b")
+    queue.record_success("b")
+    assert queue.pop_given_up(["b", "a"]) == ["a"]
+    assert queue.pop_given_up(["a"]) == []
+
+
+class FakeQueue:
+    def __init__(self, scrape):
+        self.scrape = scrape
+        self.links = []
+
+    def put(self, links):
+        self.links = links
+
+    def get(self):
+        return [self.scrape(link) for link in self.links]
+
+
+def test_retried_places_keep_the_order_of_the_links(monkeypatch):
+    queue = RetryQueue(base_delay=0, max_delay=0)
+    monkeypatch.setattr("src.retry_policy._retry_queue", queue)
+    links = ["a", "b", "c", "d"]
+    attempts = {"b": 0, "c": 0}
+
+    def scrape(link):
+        # b succeeds on its first retry, c never does
+        attempts[link] += 1
+        if link == "b":
+            queue.record_success(link)
+            return {"link": link}
+        queue.schedule(link)
+        return None
+
+    monkeypatch.setattr(
+        scraper, "thread_task", lambda task: lambda metadata: FakeQueue(scrape)
+    )
+    queue.schedule("c")
+    queue.schedule("b")
+    places = [{"link": "a"}, None, None, {"link": "d"}]
+
+    places = scraper.retry_failed_places(links, places)
+
+    assert places == [{"link": "a"}, {"link": "b"}, {"link": "d"}, None]
+    assert attempts == {"b": 1, "c": 5}
@@ -0,0 +1,165 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import src.review_state
+from src import scraper
+from src.async_reviews_scraper import scrape_reviews_async
+from src.gmaps import (
+    create_reviews_data,
+    filter_changed_places,
+    save_review_snapshots,
+)
+from src.review_state import ReviewStateStore, Watermark
+from src.reviews_scraper import GoogleMapsAPIScraper
+from src.synthetic_server import place_link
+
+feature_id_of = GoogleMapsAPIScraper._parse_url_to_feature_id
+
+
+@pytest.fixture
+def review_state(tmp_path):
+    return ReviewStateStore(str(tmp_path / "review_state.db"), max_review_ids=4)
+
+
+def review(review_id, text_date=None):
+    return {"review_id": review_id, "text_date": text_date}
+
+
+def test_watermark_reached_at_a_known_review():
+    watermark = Watermark(["r2", "r3"], None)
+    assert not watermark.reached(review("r1"))
+    assert watermark.reached(review("r3"))
+
+
+def test_watermark_falls_back_to_the_dates():
+    watermark = Watermark(["deleted"], datetime(2024, 5, 10))
+    assert not watermark.reached(review("r1", "2024-05-09T12:00:00"))
+    assert watermark.reached(review("r2", "2024-05-08T00:00:00"))
+    assert not watermark.reached(review("r3", "a month ago"))
+
+
+def test_unknown_place_has_no_watermark(review_state):
+    assert review_state.get("0x1") is None
+    review_state.update("0x1", [])
+    assert review_state.get("0x1") is None
+
+
+def test_watermark_moves_to_the_newest_reviews(review_state):
+    review_state.update(
+        "0x1", [review("r3", "2024-05-03"), review("r2", "2024-05-02")]
+    )
+    review_state.update("0x1", [review("r5", "2024-05-05"), review("r4")])
+
+    watermark = review_state.get("0x1")
+    # Newest first, capped to max_review_ids
+    assert watermark.review_ids == ["r5", "r4", "r3", "r2"]
+    assert watermark.published == datetime(2024, 5, 5)
+    assert review_state.get("0x2") is None
+
+
+def test_deferred_watermark_moves_on_commit(review_state):
+    review_state.update("0x1", [review("r1")])
+    review_state.defer_update("0x1", [review("r2", "2024-05-02")])
+    review_state.defer_update("0x2", [review("r3")])
+    assert review_state.get("0x1").review_ids == ["r1"]
+    assert review_state.get("0x2") is None
+
+    review_state.commit_updates()
+    assert review_state.get("0x1").review_ids == ["r2", "r1"]
+    assert review_state.get("0x2").review_ids == ["r3"]
+
+    review_state.defer_update("0x2", [review("r4")])
+    review_state.discard_updates()
+    review_state.commit_updates()
+    assert review_state.get("0x2").review_ids == ["r3"]
+
+
+def test_watermark_keeps_the_newest_date(review_state):
+    review_state.update("0x1", [review("r2", "2024-05-02")])
+    review_state.update("0x1", [review("r1")])
+    assert review_state.get("0x1").published == datetime(2024, 5, 2)
+
+
+def place(place_id, reviews=10, reviews_per_rating=None):
+    return {
+        "place_id": place_id,
+        "reviews": reviews,
+        "reviews_per_rating": reviews_per_rating or {"5": reviews},
+    }
+
+
+def test_snapshot_tells_unchanged_places(review_state):
+    assert not review_state.is_unchanged(place("0x1"))
+    review_state.save_snapshot(place("0x1", 10, {"5": 7, "4": 3}))
+
+    assert review_state.is_unchanged(place("0x1", 10, {"4": 3, "5": 7}))
+    assert not review_state.is_unchanged(place("0x1", 11, {"5": 8, "4": 3}))
+    assert not review_state.is_unchanged(place("0x1", 10, {"5": 6, "4": 4}))
+    assert not review_state.is_unchanged(place("0x2", 10, {"5": 7, "4": 3}))
+
+
+def scraped_place(server, index, link=None):
+    link = link or place_link(index)
+    synthetic = server.site.get_place(feature_id_of(None, place_link(index)))
+    return {
+        "place_id": f"place-{index}",
+        "link": link,
+        "reviews": synthetic.review_count,
+        "reviews_per_rating": {"5": synthetic.review_count},
+    }
+
+
+@pytest.mark.parametrize("max_in_flight", [None, 4])
+def test_failed_place_is_scraped_again_next_run(
+    google, monkeypatch, review_state, max_in_flight
+):
+    monkeypatch.setattr(src.review_state, "_review_state", review_state)
+    # No feature id in its link, its reviews can't be scraped
+    broken = scraped_place(google, 1, link="https://www.google.com/maps/place/x")
+    places = [scraped_place(google, 0), broken]
+
+    def run():
+        changed = filter_changed_places(places)
+        reviews_data = create_reviews_data(changed, 5, "newest", False, "en")
+        if max_in_flight:
+            reviews = asyncio.run(scrape_reviews_async(reviews_data, max_in_flight))
+        else:
+            reviews = scraper.scrape_reviews(reviews_data, metadata={"cache": False})
+        save_review_snapshots(changed, reviews)
+        review_state.commit_updates()
+        return {review["place_id"]: review["finished"] for review in reviews}
+
+    assert run() == {"place-0": True, "place-1": False}
+    assert run() == {"place-1": False}
+
+
+@pytest.mark.parametrize("max_in_flight", [None, 4])
+def test_watermark_waits_for_the_output(
+    google, monkeypatch, review_state, max_in_flight
+):
+    monkeypatch.setattr(src.review_state, "_review_state", review_state)
+    place = scraped_place(google, 2)
+    reviews_data = create_reviews_data([place], 60, "newest", False, "en", True)
+
+    if max_in_flight:
+        asyncio.run(scrape_reviews_async(reviews_data, max_in_flight))
+    else:
+        scraper.scrape_reviews(reviews_data, metadata={"cache": False})
+    # As when the container dies before the output is written
+    assert review_state.get(place["place_id"]) is None
+
+    review_state.commit_updates()
+    assert review_state.get(place["place_id"]) is not None
+
+
+def test_snapshot_waits_for_the_output(review_state, monkeypatch):
+    monkeypatch.setattr(src.review_state, "_review_state", review_state)
+    scraped = place("0x1", 10, {"5": 7, "4": 3})
+    save_review_snapshots([scraped], [{"place_id": "0x1", "finished": True}])
+    # As when the container dies before the output is written
+    assert not review_state.is_unchanged(scraped)
+
+    review_state.commit_updates()
+    assert review_state.is_unchanged(scraped)
@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+from src.async_reviews_scraper import AsyncGoogleMapsAPIScraper, scrape_reviews_async
+from src.gmaps import create_reviews_data
+from src.response_cache import cached_response
+from src.review_state import Watermark
+from src.reviews_scraper import GoogleMapsAPIScraper
+from src.synthetic_server import place_link
+
+feature_id_of = GoogleMapsAPIScraper._parse_url_to_feature_id
+
+
+# A page whose reviews google left out
+page_without_reviews = (
+    b'<div><div data-google-review-count="10" data-next-page-token="p1"></div></div>'
+)
+
+
+def review_ids(reviews):
+    return [review["review_id"] for review in reviews]
+
+
+def scrape_async(link, n_reviews, **kwargs):
+    async def scrape():
+        async with AsyncGoogleMapsAPIScraper(max_in_flight=4) as scraper:
+            return await scraper.scrape_reviews(link, n_reviews, "en", **kwargs)
+
+    return asyncio.run(scrape())
+
+
+@pytest.mark.parametrize("pipeline", [True, False])
+def test_scrapes_every_review_of_a_place(google, pipeline):
+    link = place_link(3)
+    place = google.site.get_place(feature_id_of(None, link))
+
+    with GoogleMapsAPIScraper(pipeline=pipeline) as scraper:
+        reviews = scraper.scrape_reviews(link, place.review_count, "en")
+
+    assert len(reviews) == place.review_count
+    assert len(set(review_ids(reviews))) == place.review_count
+
+
+def test_async_scraper_gets_the_same_reviews(google):
+    for index in range(4):
+        link = place_link(index)
+        n_reviews = google.site.get_place(feature_id_of(None, link)).review_count
+        with GoogleMapsAPIScraper() as scraper:
+            expected = scraper.scrape_reviews(link, n_reviews, "en")
+
+        assert review_ids(scrape_async(link, n_reviews)) == review_ids(expected)
+
+
+def test_stops_at_n_reviews(google):
+    with GoogleMapsAPIScraper() as scraper:
+        reviews = scraper.scrape_reviews(place_link(5), 12, "en")
+
+    assert len(reviews) == 12
+    assert review_ids(scrape_async(place_link(5), 12)) == review_ids(reviews)
+
+
+def test_stops_paginating_at_the_watermark(google):
+    link = place_link(6)
+    n_reviews = google.site.get_place(feature_id_of(None, link)).review_count
+    with GoogleMapsAPIScraper() as scraper:
+        every_review = scraper.scrape_reviews(link, n_reviews, "en")
+    watermark = Watermark([every_review[13]["review_id"]], None)
+    pages_before = google.stats()["review_pages"]
+
+    with GoogleMapsAPIScraper(pipeline=False) as scraper:
+        reviews = scraper.scrape_reviews(link, n_reviews, "en", watermark=watermark)
+
+    assert review_ids(reviews) == review_ids(every_review[:13])
+    # The watermark sits on the second page, the third one is not asked for
+    assert google.stats()["review_pages"] - pages_before == 2
+    assert review_ids(
+        scrape_async(link, n_reviews, watermark=watermark)
+    ) == review_ids(every_review[:13])
+
+
+def test_cancelled_async_scrape_is_not_swallowed(google):
+    places = [
+        {"place_id": f"place-{index}", "link": place_link(index), "reviews": 60}
+        for index in range(20)
+    ]
+    reviews_data = create_reviews_data(places, 60, "newest", False, "en")
+
+    async def scrape():
+        return await asyncio.wait_for(scrape_reviews_async(reviews_data), 0.01)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(scrape())
+
+
+@pytest.mark.parametrize("review_parser", ["lxml", "bs4"])
+def test_page_without_its_reviews_does_not_parse(review_parser):
+    scraper = GoogleMapsAPIScraper(review_parser=review_parser)
+    response = cached_response("", page_without_reviews, "utf-8")
+    with pytest.raises(ValueError):
+        scraper._read_page(response, "en")
+    with pytest.raises(ValueError):
+        scraper._parse_page(response, "en", "p1")
+
+
+@pytest.mark.parametrize("pipeline", [True, False])
+def test_page_without_its_reviews_is_requested_again(google, pipeline):
+    link = place_link(3)
+    place = google.site.get_place(feature_id_of(None, link))
+
+    with GoogleMapsAPIScraper(pipeline=pipeline, retry_time=0) as scraper:
+        fetch_page = scraper._fetch_page
+        broken = []
+
+        def fetch_page_once_broken(*args):
+            response = fetch_page(*args)
+            if broken:
+                return response
+            broken.append(args)
+            return cached_response(response.url, page_without_reviews, "utf-8")
+
+        scraper._fetch_page = fetch_page_once_broken
+        reviews = scraper.scrape_reviews(link, place.review_count, "en")
+
+    assert len(broken) == 1
+    assert len(set(review_ids(reviews))) == place.review_count
+
+
+def test_reviews_without_an_id_are_kept():
+    pages = [
+        [{"review_id": "r1"}, {"review_id": ""}],
+        [{"review_id": "r1"}, {"review_id": ""}, {"review_id": "r2"}],
+    ]
+    reviews = GoogleMapsAPIScraper()._collect_reviews(pages)
+    assert review_ids(reviews) == ["r1", "", "", "r2"]
@@ -0,0 +1,76 @@
+from datetime import datetime
+
+import pytest
+
+from src.run_journal import (
+    RunJournal,
+    airflow_run_id_env,
+    attraction_id_env,
+    current_run_id,
+    run_date_env,
+)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "run_journal.db")
+
+
+@pytest.fixture(autouse=True)
+def no_run_env(monkeypatch):
+    for name in (airflow_run_id_env, run_date_env, attraction_id_env):
+        monkeypatch.delenv(name, raising=False)
+
+
+def test_retry_resumes_the_run(path):
+    journal = RunJournal(path, "run")
+    journal.finish_query("cafes", {"query": "cafes", "places": []})
+    journal.finish_place("0x1", [{"review_id": "r1"}])
+    journal.save_page("0x1:en", 0, "token-1", [{"review_id": "r1"}])
+    journal.save_page("0x1:en", 1, "token-2", [{"review_id": "r2"}])
+    # Pages are parsed in the background, the ones after a gap are redone
+    journal.save_page("0x1:en", 3, "token-4", [{"review_id": "r4"}])
+
+    retry = RunJournal(path, "run")
+    assert retry.get_query("cafes") == {"query": "cafes", "places": []}
+    assert retry.get_query("bars") is None
+    assert retry.get_place("0x1") == [{"review_id": "r1"}]
+    assert retry.get_pages("0x1:en") == (
+        [[{"review_id": "r1"}], [{"review_id": "r2"}]],
+        "token-2",
+    )
+    assert retry.get_pages("0x2:en") == ([], None)
+
+
+def test_clear_only_forgets_its_run(path):
+    first = RunJournal(path, "first")
+    second = RunJournal(path, "second")
+    first.finish_query("cafes", {"places": [1]})
+    second.finish_query("cafes", {"places": [2]})
+
+    first.clear()
+
+    assert first.get_query("cafes") is None
+    assert second.get_query("cafes") == {"places": [2]}
+
+
+def test_run_id_of_an_airflow_task(monkeypatch):
+    monkeypatch.setenv(airflow_run_id_env, "scheduled__2024-05-01T00:00:00")
+    monkeypatch.setenv(attraction_id_env, "42")
+    run_id = current_run_id("bucket/blob")
+    assert run_id == "bucket/blob/42/scheduled__2024-05-01T00:00:00"
+
+    # The other attractions of the same DAG run
+    monkeypatch.setenv(attraction_id_env, "43")
+    assert current_run_id("bucket/blob") != run_id
+    # The next run
+    monkeypatch.setenv(airflow_run_id_env, "scheduled__2024-05-02T00:00:00")
+    monkeypatch.setenv(attraction_id_env, "42")
+    assert current_run_id("bucket/blob") != run_id
+
+
+def test_run_id_falls_back_to_the_run_date(monkeypatch):
+    today = datetime.now().strftime("%Y-%m-%d")
+    assert current_run_id("bucket/blob") == f"bucket/blob//{today}"
+    monkeypatch.setenv(run_date_env, "2024-05-01")
+    assert current_run_id("bucket/blob") == "bucket/blob//2024-05-01"
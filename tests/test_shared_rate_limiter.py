@@ -0,0 +1,60 @@
+import multiprocessing
+
+from src.shared_rate_limiter import SqliteTokenBucket, create_shared_rate_limiter
+
+host = "www.google.com"
+
+
+def drain(path, tokens, waits):
+    bucket = SqliteTokenBucket(path, host, rate=50, capacity=1)
+    waits.put(sum(bucket.acquire() for _ in range(tokens)))
+
+
+def test_first_process_sets_the_bucket_up(tmp_path):
+    path = str(tmp_path / "rate_limiter.db")
+    SqliteTokenBucket(path, host, rate=3)
+    # Joining processes keep the rate the budget already has
+    assert SqliteTokenBucket(path, host, rate=10).rate == 3
+
+
+def test_processes_draw_from_one_budget(tmp_path):
+    path = str(tmp_path / "rate_limiter.db")
+    SqliteTokenBucket(path, host, rate=50, capacity=1)
+    context = multiprocessing.get_context("spawn")
+    waits = context.Queue()
+    processes = [
+        context.Process(target=drain, args=(path, 10, waits)) for _ in range(2)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+    # 20 tokens at 50 per second, one of them in the burst
+    assert sum(waits.get() for _ in processes) >= 19 / 50 * 0.9
+
+
+def test_one_decrease_per_episode_across_buckets(tmp_path):
+    path = str(tmp_path / "rate_limiter.db")
+    first = SqliteTokenBucket(path, host, rate=8)
+    second = SqliteTokenBucket(path, host, rate=8)
+    assert first.decrease_rate(0.5, 0.2, cooldown=60) == 4
+    assert second.decrease_rate(0.5, 0.2, cooldown=60) is None
+    second.increase_rate(1, max_rate=20)
+    assert first.rate == 5
+
+
+def test_pause_holds_every_bucket_of_the_host(tmp_path):
+    path = str(tmp_path / "rate_limiter.db")
+    first = SqliteTokenBucket(path, host, rate=1000)
+    second = SqliteTokenBucket(path, host, rate=1000)
+    first.pause(0.2)
+    assert second.acquire() > 0.1
+
+
+def test_shared_rate_limiter(tmp_path):
+    limiter = create_shared_rate_limiter(
+        str(tmp_path / "rate_limiter.db"), initial_rate=1000
+    )
+    assert limiter.acquire(host) == 0
+    limiter.on_error(host)
+    assert limiter.stats()[host]["rate"] == 500
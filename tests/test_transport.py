@@ -0,0 +1,89 @@
+import io
+import time
+
+import pytest
+import requests
+
+from src.extract_data import decode_place_payload
+from src.scraper import place_page_markers
+from src.synthetic_server import SyntheticServer, place_link
+from src.transport import StalledResponseError, Transport, default_chunk_size
+
+body = b"<html>head;window.STATE=[1,2];window.FLAGS=[];tail</html>"
+markers = (b";window.STATE=", b";window.FLAGS=")
+cut_body = b"<html>head;window.STATE=[1,2];window.FLAGS="
+
+
+def read(chunks, until, started_at=None, **kwargs):
+    response = requests.Response()
+    response.raw = io.BytesIO()
+    started_at = time.monotonic() if started_at is None else started_at
+    Transport(**kwargs)._read_body(response, iter(chunks), started_at, until)
+    return response
+
+
+def split(data, size):
+    return [data[start : start + size] for start in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 13, len(body)])
+def test_stops_at_markers_split_across_chunks(size):
+    response = read(split(body, size), markers)
+    assert response.content == cut_body
+    assert response.cut_short
+
+
+@pytest.mark.parametrize("offset", range(1, len(markers[1])))
+def test_stops_at_a_marker_split_anywhere(offset):
+    end = body.index(markers[1]) + offset
+    response = read([body[:end], body[end:]], markers)
+    assert response.content == cut_body
+
+
+def test_markers_are_found_in_order():
+    # The second marker before the first one doesn't count
+    data = b";window.FLAGS=" + body
+    response = read(split(data, 4), markers)
+    assert response.content == b";window.FLAGS=" + cut_body
+
+
+def test_reads_everything_without_markers():
+    response = read(split(body, 4), None)
+    assert response.content == body
+    assert not response.cut_short
+    response = read(split(body, 4), (b";window.STATE=", b"missing"))
+    assert response.content == body
+    assert not response.cut_short
+
+
+def test_stalled_body():
+    with pytest.raises(StalledResponseError):
+        read(split(body, 4), markers, time.monotonic() - 11, stall_timeout=10)
+
+
+@pytest.fixture(scope="module")
+def heavy_server():
+    """Synthetic google whose place pages weigh 2 MB, like real ones"""
+    server = SyntheticServer(port=0, page_padding=2 * 1024 * 1024)
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_place_page_cut_short(heavy_server):
+    transport = Transport()
+    url = place_link(0, heavy_server.base_url)
+    whole = transport.get(url)
+    response = transport.get(url, until=place_page_markers)
+
+    assert not whole.cut_short
+    assert response.cut_short
+    assert response.content.endswith(place_page_markers[1])
+    # Only the chunk holding the markers was read past them
+    not_read = len(whole.content) - len(response.content)
+    assert not_read - default_chunk_size < response.bytes_saved <= not_read
+    assert decode_place_payload(response.text) == decode_place_payload(whole.text)
+    stats = transport.stats.as_dict()
+    assert stats["cut_short"] == 1
+    assert stats["reused_connections"] == 1